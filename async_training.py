@@ -0,0 +1,181 @@
+import logging
+import queue
+import threading
+from random import randint, uniform, random
+
+import numpy as np
+
+import custom_env
+from dqn import DQN
+from numpy_policy import NumpyPolicy
+from state_encoder import StateEncoder
+from transition_dataset import TransitionDataset
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Actor / learner pipelining ##########
+#######################################
+# Actors simulate while the learner trains: each actor thread runs its own episodes with a
+# NumPy copy of the policy and pushes its transitions in a queue, the learner (main thread)
+# stores them in the replay memory and keeps training, publishing its weights after each update.
+SYNC_INTERVAL = 10  # actor steps between two pulls of the learner's weights
+MAX_REPLAY_RATIO = 4  # learner updates per received transition (at most during the run, reached at the end)
+QUEUE_SIZE = 1000  # actors wait when the learner is this far behind
+#######################################
+
+
+class PolicyStore:
+    # Latest target network weights and input normalization published by the learner
+
+    def __init__(self, weights, encoder_state):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.weights = weights
+        self.encoder_state = encoder_state
+
+    def publish(self, weights, encoder_state):
+        weights = [np.copy(w) for w in weights]
+        encoder_state = {key: np.copy(value) for key, value in encoder_state.items()}
+        with self.lock:
+            self.weights = weights
+            self.encoder_state = encoder_state
+            self.version += 1
+
+    def pull(self):
+        with self.lock:
+            return self.version, self.weights, self.encoder_state
+
+
+class Actor(threading.Thread):
+
+    def __init__(self, actor_id, simulator, store, transitions, episodes, steps, epsilon, epsilon_min, epsilon_decay):
+        super().__init__(name='actor_' + str(actor_id), daemon=True)
+        self.actor_id = actor_id
+        self.simulator = simulator
+        self.store = store
+        self.transitions = transitions
+        self.episodes = episodes
+        self.steps = steps
+        self.epsilon = epsilon
+        self.epsilon_min = epsilon_min
+        self.epsilon_decay = epsilon_decay
+        self.error = None
+
+    def run(self):
+        try:
+            self.run_episodes()
+        except Exception as e:
+            self.error = e
+        finally:
+            # End of this actor for the learner
+            self.transitions.put(None)
+
+    def run_episodes(self):
+        env = custom_env.CustomEnv()
+        version, weights, encoder_state = self.store.pull()
+        policy = NumpyPolicy(weights, StateEncoder(env.INPUT_SHAPE))
+        policy.encoder.set_state(encoder_state)
+        for episode in range(self.episodes):
+            logger.debug("Actor %d starting episode #%d", self.actor_id, episode)
+            nbr_trains = randint(env.MIN_NBR_TRAINS, env.MAX_NBR_TRAINS)
+            v_max = round(uniform(env.MIN_V_MAX, env.MAX_V_MAX), 2)
+            max_dwell = round(uniform(env.MIN_MAX_DWELL, env.MAX_MAX_DWELL), 2)
+            density_max_opt = round(uniform(env.MIN_DENSITY_MAX_OPT, env.MAX_DENSITY_MAX_OPT), 2)
+            current_state = self.simulator.simulate(nbr_trains, v_max, max_dwell, density_max_opt)
+
+            for step in range(self.steps):
+                if step % SYNC_INTERVAL == 0 and self.store.version != version:
+                    version, weights, encoder_state = self.store.pull()
+                    policy.set_weights(weights)
+                    policy.encoder.set_state(encoder_state)
+
+                state_array = env.convert_to_dqn_array(current_state)
+                self.epsilon = max(self.epsilon_min, self.epsilon * self.epsilon_decay)
+                if random() < self.epsilon:
+                    action = randint(0, len(env.ACTIONS) - 1)
+                else:
+                    action = policy.action(state_array)
+
+                new_state, new_params, reward, done, done_reason = env.step(
+                    self.simulator, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action)
+                # DQN transition, and the raw one for the transition dataset
+                self.transitions.put(((state_array, action, reward, env.convert_to_dqn_array(new_state), done),
+                                      ((nbr_trains, v_max, max_dwell, density_max_opt), current_state, action,
+                                       (new_params['nbr_trains'], new_params['v_max'], new_params['max_dwell'],
+                                        new_params['density_max_opt']), new_state, done)))
+
+                current_state = new_state
+                nbr_trains = new_params['nbr_trains']
+                v_max = new_params['v_max']
+                max_dwell = new_params['max_dwell']
+                density_max_opt = new_params['density_max_opt']
+            logger.info("Actor %d ended episode #%d", self.actor_id, episode)
+
+
+def train_async(nbr_actors, create_simulator, episodes=None, steps=None, transitions_fn=None):
+    # create_simulator(env, workers): simulator shared by the actors, it must allow concurrent
+    # simulate calls (SimulatorPool, NumpySimulator, CachedSimulator in front of them)
+    # transitions_fn: TransitionDataset the simulated transitions are appended to
+    logger.info("Started asynchronous training with %d actors", nbr_actors)
+    env = custom_env.CustomEnv()
+    episodes = episodes if episodes is not None else env.MAX_EPISODES
+    steps = steps if steps is not None else env.MAX_STEPS
+    dqn_agent = DQN(env=env)
+    simulator = create_simulator(env, nbr_actors)
+    store = PolicyStore(dqn_agent.policy.get_weights(), dqn_agent.encoder.get_state())
+    transitions = queue.Queue(maxsize=QUEUE_SIZE)
+    dataset = TransitionDataset(transitions_fn) if transitions_fn is not None else None
+
+    # The episodes are shared between the actors
+    actors = []
+    for actor_id in range(nbr_actors):
+        actor_episodes = episodes // nbr_actors + (1 if actor_id < episodes % nbr_actors else 0)
+        actors.append(Actor(actor_id, simulator, store, transitions, actor_episodes, steps,
+                            dqn_agent.epsilon, dqn_agent.epsilon_min, dqn_agent.epsilon_decay))
+    for actor in actors:
+        actor.start()
+
+    running = nbr_actors
+    received = 0
+    updates = 0
+    while running > 0 or not transitions.empty():
+        # Only wait for the actors when there is nothing to learn from
+        can_learn = len(dqn_agent.memory) >= dqn_agent.batch_size and updates < MAX_REPLAY_RATIO * received
+        items = []
+        try:
+            items.append(transitions.get(block=not can_learn, timeout=1 if not can_learn else None))
+            while True:
+                items.append(transitions.get_nowait())
+        except queue.Empty:
+            pass
+        for item in items:
+            if item is None:
+                running -= 1
+                continue
+            transition, record = item
+            dqn_agent.remember(*transition)
+            if dataset is not None:
+                dataset.add(*record)
+            received += 1
+            # The actors decay their own epsilon, the learner's follows all the steps (saved with the agent)
+            dqn_agent.epsilon = max(dqn_agent.epsilon_min, dqn_agent.epsilon * dqn_agent.epsilon_decay)
+
+        if updates < MAX_REPLAY_RATIO * received and dqn_agent.replay():
+            dqn_agent.target_train()
+            updates += 1
+            store.publish(dqn_agent.policy.get_weights(), dqn_agent.encoder.get_state())
+
+    for actor in actors:
+        actor.join()
+        if actor.error is not None:
+            raise actor.error
+    # With fast simulators the actors end long before the learner: it catches up with the replay ratio
+    while updates < MAX_REPLAY_RATIO * received and dqn_agent.replay():
+        dqn_agent.target_train()
+        updates += 1
+    simulator.close()
+    if dataset is not None:
+        dataset.close()
+    logger.info("Ended asynchronous training: %d transitions, %d updates", received, updates)
+    return dqn_agent
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import custom_env
+from octave_adapter import OctaveAdapter
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer
+from seeding import seed_everything
+from stub_simulator import STUB_COMMAND
+
+#######################################
+# Benchmarks ##########################
+#######################################
+# python benchmark.py --output benchmark.json
+# Each benchmark is timed on its own, with fixed seeds, the JSON files of two commits can be compared
+# with python benchmark.py --compare old.json new.json
+SEED = 0
+REPEAT = 200  # timed calls per benchmark (divided by 10 with --quick)
+BATCH_SIZES = (8, 32, 128)
+MEMORY_SIZES = (10000, 100000, 1000000)
+TRAIN_EPISODES = 2
+TRAIN_STEPS = 10
+REGRESSION_THRESHOLD = 1.10  # --compare flags the benchmarks at least 10% slower
+#######################################
+
+# Inside the CustomEnv ranges, away from their bounds (the env.step benchmark moves them)
+STARTING_PARAMS = (80, 20.0, 30.0, 3.0)
+
+
+def measure(function, repeat, warm_up=3, items=1):
+    # function() is called repeat times, items: work items done by each call (e.g. batch size)
+    for _ in range(warm_up):
+        function()
+    durations = np.zeros(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations[i] = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+    return {
+        'repeat': repeat,
+        'mean': float(durations.mean()),
+        'min': float(durations.min()),
+        'p50': float(p50),
+        'p95': float(p95),
+        'p99': float(p99),
+        'items_per_second': items / float(durations.mean())
+    }
+
+
+def bench_xml(context, repeat):
+    # Serialization / parsing alone, no simulator
+    adapter = OctaveAdapter(context, session=False, octave_exec=STUB_COMMAND)
+    adapter.simulate(*STARTING_PARAMS)
+    return {
+        'xml.write_to_octave': measure(lambda: adapter.write_to_octave(*STARTING_PARAMS), repeat),
+        'xml.read_from_octave': measure(adapter.read_from_octave, repeat),
+        'xml.write_batch_to_octave_64': measure(lambda: adapter.write_batch_to_octave([STARTING_PARAMS] * 64),
+                                                repeat, items=64)
+    }
+
+
+def bench_round_trip(context, repeat):
+    results = {}
+    adapter = OctaveAdapter(context, session=True, octave_exec=STUB_COMMAND)
+    results['round_trip.session'] = measure(lambda: adapter.simulate(*STARTING_PARAMS), repeat)
+    results['round_trip.session_batch_16'] = measure(lambda: adapter.simulate_many([STARTING_PARAMS] * 16),
+                                                     max(1, repeat // 10), items=16)
+    adapter.close()
+    # A new process per simulation, much slower: fewer calls
+    adapter = OctaveAdapter(context, session=False, octave_exec=STUB_COMMAND)
+    results['round_trip.process'] = measure(lambda: adapter.simulate(*STARTING_PARAMS), max(1, repeat // 10))
+    return results
+
+
+def bench_env(context, repeat):
+    env = custom_env.CustomEnv()
+    adapter = OctaveAdapter(context, session=True, octave_exec=STUB_COMMAND)
+    state = adapter.simulate(*STARTING_PARAMS)
+    new_state = adapter.simulate(STARTING_PARAMS[0] + 1, *STARTING_PARAMS[1:])
+    actions = np.random.randint(0, len(env.ACTIONS), size=repeat + 3)
+    counter = iter(range(len(actions)))
+    results = {
+        'env.step': measure(lambda: env.step(adapter, state, *STARTING_PARAMS, int(actions[next(counter)])), repeat),
+        'env.calculate_reward': measure(lambda: env.calculate_reward(state, new_state, 20.0, 20.0), repeat),
+        'env.convert_to_dqn_array': measure(lambda: env.convert_to_dqn_array(state), repeat)
+    }
+    adapter.close()
+    return results
+
+
+def bench_replay(repeat, memory_sizes, batch_size=32):
+    # Uniform and prioritized replay memories, filled to capacity
+    env = custom_env.CustomEnv()
+    results = {}
+    for capacity in memory_sizes:
+        for name, memory in (('uniform', ReplayBuffer(capacity, env.INPUT_SHAPE)),
+                             ('prioritized', PrioritizedReplayBuffer(capacity, env.INPUT_SHAPE))):
+            prefix = 'replay.' + name + '_' + str(capacity) + '.'
+            block = min(capacity, 10000)
+            states = np.random.random((block,) + env.INPUT_SHAPE)
+            actions = np.random.randint(0, len(env.ACTIONS), size=block)
+            for _ in range(0, capacity, block):
+                memory.add_batch(states, actions, np.random.random(block), states, np.zeros(block))
+            state = states[0]
+            results[prefix + 'add'] = measure(lambda: memory.add(state, 1, 0.5, state, 0), repeat)
+            results[prefix + 'add_batch_64'] = measure(
+                lambda: memory.add_batch(states[:64], actions[:64], np.zeros(64), states[:64], np.zeros(64)),
+                repeat, items=64)
+            results[prefix + 'sample_' + str(batch_size)] = measure(lambda: memory.sample(batch_size), repeat,
+                                                                    items=batch_size)
+            if name == 'prioritized':
+                indices = np.random.randint(0, capacity, size=batch_size)
+                results[prefix + 'update_priorities_' + str(batch_size)] = measure(
+                    lambda: memory.update_priorities(indices, np.random.random(batch_size)), repeat, items=batch_size)
+    return results
+
+
+def bench_dqn(repeat, batch_sizes):
+    from dqn import DQN
+    env = custom_env.CustomEnv()
+    dqn_agent = DQN(env=env)
+    states = np.random.random((dqn_agent.memory_capacity // 100,) + env.INPUT_SHAPE) * 100
+    for i in range(len(states) - 1):
+        dqn_agent.remember(states[i], np.random.randint(len(env.ACTIONS)), np.random.random(), states[i + 1], False)
+    results = {}
+    # Greedy action (epsilon = 0) of a single state, the latency of one step
+    dqn_agent.epsilon = dqn_agent.epsilon_min = 0
+    results['dqn.action'] = measure(lambda: dqn_agent.action(states[0]), repeat)
+    for batch_size in batch_sizes:
+        dqn_agent.batch_size = batch_size
+        name = 'dqn.replay_' + str(batch_size)
+        results[name] = measure(dqn_agent.replay, repeat, items=batch_size)
+    results['dqn.target_train'] = measure(dqn_agent.target_train, repeat)
+    return results
+
+
+def bench_train(episodes, steps):
+    # Shortened train() with the NumPy simulator and an empty cache, in a scratch folder
+    # (train.py writes its run folder, cache and model in the working directory)
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix='benchmark_train_')
+    os.chdir(scratch)
+    try:
+        import train
+        train.SIMULATOR_BACKEND = "numpy"
+        train.SIMULATION_CACHE_FILE = os.path.join(scratch, "simulation_cache.sqlite")
+        start = time.perf_counter()
+        train.train(episodes, steps)
+        duration = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {'train.end_to_end': {'episodes': episodes, 'steps': steps, 'duration': duration,
+                                 'items_per_second': episodes * steps / duration}}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(benchmarks, repeat, seed):
+    context = tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(os.path.join(context, 'io'))
+    results = {}
+    skipped = {}
+    try:
+        for name in benchmarks:
+            seed_everything(seed)
+            print("Running", name)
+            try:
+                if name == 'xml':
+                    results.update(bench_xml(context, repeat))
+                elif name == 'round_trip':
+                    results.update(bench_round_trip(context, repeat))
+                elif name == 'env':
+                    results.update(bench_env(context, repeat))
+                elif name == 'replay':
+                    results.update(bench_replay(repeat, MEMORY_SIZES))
+                elif name == 'dqn':
+                    results.update(bench_dqn(repeat, BATCH_SIZES))
+                elif name == 'train':
+                    results.update(bench_train(TRAIN_EPISODES, TRAIN_STEPS))
+            except ImportError as e:
+                # TensorFlow missing for dqn / train
+                skipped[name] = str(e)
+                print("Skipped", name + ":", e)
+    finally:
+        shutil.rmtree(context, ignore_errors=True)
+    return {
+        'date': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+        'skipped': skipped
+    }
+
+
+def compare(old_fn, new_fn, threshold=REGRESSION_THRESHOLD):
+    # Mean time per item of the benchmarks of both files, returns the names of the regressions
+    with open(old_fn) as f:
+        old = json.load(f)['results']
+    with open(new_fn) as f:
+        new = json.load(f)['results']
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        ratio = old[name]['items_per_second'] / new[name]['items_per_second']
+        flag = ''
+        if ratio >= threshold:
+            flag = '  <== slower'
+            regressions.append(name)
+        print("%-36s %12.1f/s %12.1f/s %7.2fx%s" % (
+            name, old[name]['items_per_second'], new[name]['items_per_second'], ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    BENCHMARKS = ('xml', 'round_trip', 'env', 'replay', 'dqn', 'train')
+    parser = argparse.ArgumentParser(description="Benchmarks of the simulator adapter, the environment and the DQN")
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help="comma separated list of " + ', '.join(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        sys.exit(1 if compare(*args.compare) else 0)
+    out = run([name for name in args.only.split(',') if name in BENCHMARKS],
+              REPEAT // 10 if args.quick else REPEAT, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=2)
+    print("Results written to", args.output)
@@ -0,0 +1,125 @@
+import logging
+import os
+import pickle
+import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Checkpoints #########################
+#######################################
+# One folder per run in CHECKPOINT_FOLDER (named after the run), holding one folder per checkpoint:
+# state.pkl (training state) and copies of files (e.g. the run record). Written by a background thread
+# into a .tmp folder renamed when complete, so a crash while writing never leaves a truncated checkpoint.
+# Only the last CHECKPOINT_KEEP of each run are kept.
+CHECKPOINT_FOLDER = "checkpoints"
+CHECKPOINT_EVERY = 1  # episodes
+CHECKPOINT_KEEP = 3
+CHECKPOINT_PREFIX = "checkpoint_"
+STATE_FILE = "state.pkl"
+#######################################
+
+
+def rng_state():
+    # random (starting states, async actors) and NumPy (exploration, replay sampling).
+    # TensorFlow draws random numbers only when creating the networks, their weights are saved.
+    return {'python': random.getstate(), 'numpy': np.random.get_state()}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+
+
+class Checkpointer:
+    # folder: the folder of the checkpoints of one run (run_folder), nothing else is written there
+
+    def __init__(self, folder=CHECKPOINT_FOLDER, keep=CHECKPOINT_KEEP):
+        self.folder = folder
+        self.keep = keep
+        os.makedirs(folder, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, name, state, files=None):
+        # state: picklable, not modified afterwards by the caller (copies)
+        # files: {name in the checkpoint: (path, size)}, the first size bytes of path are copied
+        #        (files still being appended to, e.g. the run record once flushed)
+        self.wait()
+        self.pending = self.executor.submit(self._write, name, state, files or {})
+
+    def _write(self, name, state, files):
+        final = os.path.join(self.folder, name)
+        tmp = final + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        with open(os.path.join(tmp, STATE_FILE), 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        for file_name, (path, size) in files.items():
+            with open(path, 'rb') as source, open(os.path.join(tmp, file_name), 'wb') as destination:
+                remaining = size
+                while remaining > 0:
+                    chunk = source.read(min(remaining, 1 << 20))
+                    if len(chunk) == 0:
+                        break
+                    destination.write(chunk)
+                    remaining -= len(chunk)
+                destination.flush()
+                os.fsync(destination.fileno())
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.replace(tmp, final)
+        logger.info("Checkpoint written: %s", final)
+        self.prune()
+
+    def prune(self):
+        for name in list_checkpoints(self.folder)[:-self.keep]:
+            shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+
+    def wait(self):
+        # Raises the error of the last write, if any
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+def list_checkpoints(folder=CHECKPOINT_FOLDER):
+    # Complete checkpoints, oldest first (names are zero padded)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder)
+                  if name.startswith(CHECKPOINT_PREFIX) and not name.endswith('.tmp'))
+
+
+def run_folder(run_name, folder=CHECKPOINT_FOLDER):
+    return os.path.join(folder, run_name)
+
+
+def latest_checkpoint(folder=CHECKPOINT_FOLDER):
+    # Latest checkpoint of a run folder, or of the most recent run of CHECKPOINT_FOLDER having one
+    # (run names start with their starting time)
+    names = list_checkpoints(folder)
+    if len(names) > 0:
+        return os.path.join(folder, names[-1])
+    if not os.path.isdir(folder):
+        return None
+    for name in sorted(os.listdir(folder), reverse=True):
+        names = list_checkpoints(os.path.join(folder, name))
+        if len(names) > 0:
+            return os.path.join(folder, name, names[-1])
+    return None
+
+
+def load_checkpoint(path):
+    with open(os.path.join(path, STATE_FILE), 'rb') as f:
+        return pickle.load(f)
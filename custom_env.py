@@ -1,10 +1,16 @@
+import logging
 import numpy as np
 import math
 
+from octave_adapter import STATE_KEYS
+from timing import span, timed
+
+logger = logging.getLogger(__name__)
+
 class CustomEnv:
 
     def __init__(self):
-        print("<---> New environment initialized")
+        logger.debug("New environment initialized")
         #######################################
         # Environment variables ###############
         #######################################
@@ -68,6 +74,9 @@ class CustomEnv:
         self.DENSITY_MAX_OPT_INDEX = 1
         self.V_MAX_INDEX = 2
         self.DWELL_TIME_INDEX = 3
+
+        # Same mapping as an (81, 4) array of -1 (decrease), 0 (stay), +1 (increase)
+        self.ACTION_DELTAS = np.array([self.MAPPING[a] for a in self.ACTIONS]) - self.STAY
         #######################################
 
         #######################################
@@ -82,6 +91,15 @@ class CustomEnv:
         self.FACTOR_KP_OPT = 0.02
         #######################################
 
+        #######################################
+        # Reward weights ######################
+        #######################################
+        self.ALPHA_COMFORT = 4
+        self.ALPHA_HEADWAY = 10
+        self.ALPHA_WAITING = 0.25
+        # self.ALPHA_VMAX = 1
+        #######################################
+
         #######################################
         # Environment related #################
         #######################################
@@ -89,7 +107,7 @@ class CustomEnv:
         #######################################
 
     def reset(self):
-        print("----> Environment reset")
+        logger.debug("Environment reset")
         self.currentState = np.zeros(self.INPUT_SHAPE)
         return self.currentState
 
@@ -126,6 +144,7 @@ class CustomEnv:
         print("FACTOR_KP_OPT = " + str(self.FACTOR_KP_OPT))
         print("<---- Environment")
 
+    @timed('env.convert_to_dqn_array')
     def convert_to_dqn_array(self, current_state):
         # Current state:
         # A dictionary of 14 value for 7 variables (mean and std for each)
@@ -166,18 +185,33 @@ class CustomEnv:
         dqn_input[6, 1] = current_state["dwell_std"]
         return dqn_input
 
-    def step(self, octave_adapter, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action):
-        action_mapping = self.MAPPING[self.ACTIONS[action]]
+    def lattice_indices(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        # Control values are MIN + k * FACTOR, this gives the nearest k of each one
+        # (removes the float drift of the repeated +/- FACTOR, e.g. v_max = 21.999999999999986)
+        return (int(round((nbr_trains - self.MIN_NBR_TRAINS) / self.FACTOR_NBR_TRAINS)),
+                int(round((v_max - self.MIN_V_MAX) / self.FACTOR_V_MAX)),
+                int(round((max_dwell - self.MIN_MAX_DWELL) / self.FACTOR_MAX_DWELL)),
+                int(round((density_max_opt - self.MIN_DENSITY_MAX_OPT) / self.FACTOR_KP_OPT)))
+
+    def lattice_params(self, indices):
+        # Inverse of lattice_indices: (nbr_trains, v_max, max_dwell, density_max_opt)
+        return (int(self.MIN_NBR_TRAINS + indices[0] * self.FACTOR_NBR_TRAINS),
+                round(self.MIN_V_MAX + indices[1] * self.FACTOR_V_MAX, 6),
+                round(self.MIN_MAX_DWELL + indices[2] * self.FACTOR_MAX_DWELL, 6),
+                round(self.MIN_DENSITY_MAX_OPT + indices[3] * self.FACTOR_KP_OPT, 6))
 
+    def snap_to_lattice(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        return self.lattice_params(self.lattice_indices(nbr_trains, v_max, max_dwell, density_max_opt))
+
+    @timed('env.step')
+    def step(self, octave_adapter, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action):
         current_v_max = v_max
 
-        nbr_trains = self.apply_action_to_nbr_trains(action_mapping, nbr_trains)
-        v_max = self.apply_action_to_v_max(action_mapping, v_max)
-        density_max_opt = self.apply_action_to_density_max_opt(action_mapping, density_max_opt)
-        max_dwell = self.apply_action_to_max_dwell(action_mapping, max_dwell)
-        octave_adapter.write_to_octave(nbr_trains, v_max, max_dwell, density_max_opt)
-        octave_adapter.run_octave()
-        new_state = octave_adapter.read_from_octave()
+        nbr_trains, v_max, max_dwell, density_max_opt = self.apply_action(nbr_trains, v_max, max_dwell,
+                                                                          density_max_opt, action)
+        # write_to_octave + run_octave + read_from_octave, for every simulator backend
+        with span('env.simulate'):
+            new_state = octave_adapter.simulate(nbr_trains, v_max, max_dwell, density_max_opt)
 
         reward = self.calculate_reward(current_state, new_state, v_max, current_v_max)
 
@@ -189,9 +223,17 @@ class CustomEnv:
         }
         return (new_state, new_params, reward, False, "")
 
+    def apply_action(self, nbr_trains, v_max, max_dwell, density_max_opt, action):
+        # Parameters after the action, without simulating
+        action_mapping = self.MAPPING[self.ACTIONS[action]]
+        nbr_trains = self.apply_action_to_nbr_trains(action_mapping, nbr_trains)
+        v_max = self.apply_action_to_v_max(action_mapping, v_max)
+        density_max_opt = self.apply_action_to_density_max_opt(action_mapping, density_max_opt)
+        max_dwell = self.apply_action_to_max_dwell(action_mapping, max_dwell)
+        return nbr_trains, v_max, max_dwell, density_max_opt
+
     def calculate_reward(self, current_state, new_state, new_v_max, current_v_max):
         # Rewards
-        print("----> Calculating reward")
         # For very low used capacity, negative value
         # For moderate used capacity (near 70%) max value
         # For highly used capacity, positive but low value
@@ -204,17 +246,16 @@ class CustomEnv:
         #if reward_headway < 0 and reward_waiting > 0:
         #    reward_waiting = -1 * reward_waiting
         # reward_vmax = new_v_max - current_v_max
-        print("<-----> Calculating reward: reward_comfort = " + str(reward_comfort) + " for used (" + str(used_capacity) + ")")
-        print("<-----> Calculating reward: reward_headway = " + str(reward_headway) + " for hout (" + str(new_state["h_out_mean"]) + ")")
-        print("<-----> Calculating reward: reward_waiting = " + str(reward_waiting))
+        logger.debug("Reward: reward_comfort = %s for used (%s), reward_headway = %s for hout (%s), reward_waiting = %s",
+                     reward_comfort, used_capacity, reward_headway, new_state["h_out_mean"], reward_waiting)
 
         # Alphas (Weights of each individual reward)
-        alpha_comfort = 4
-        alpha_headway = 10
-        alpha_waiting = 0.25
-        # alpha_vmax = 1
+        alpha_comfort = self.ALPHA_COMFORT
+        alpha_headway = self.ALPHA_HEADWAY
+        alpha_waiting = self.ALPHA_WAITING
+        # alpha_vmax = self.ALPHA_VMAX
         reward = alpha_comfort * reward_comfort + alpha_headway * reward_headway + alpha_waiting * reward_waiting
-        print("<---- Calculating reward:", str(reward))
+        logger.debug("Reward: %s", reward)
         return reward
 
     def apply_action_to_nbr_trains(self, action_mapping, nbr_trains):
@@ -258,4 +299,67 @@ class CustomEnv:
         return max_dwell
 
 
+class VectorCustomEnv(CustomEnv):
+    # nbr_envs environments stepped together with a batched simulator
+    # (simulate_many, or simulate_array for numpy_simulator.NumpySimulator).
+    # The control parameters are an (nbr_envs, 4) array in the order of the action mapping:
+    # NBR_TRAINS_INDEX, DENSITY_MAX_OPT_INDEX, V_MAX_INDEX, DWELL_TIME_INDEX
+    # and the states are (nbr_envs, 7, 2) DQN arrays.
+
+    def __init__(self, nbr_envs):
+        super().__init__()
+        self.nbr_envs = nbr_envs
+        self.FACTORS = np.array([self.FACTOR_NBR_TRAINS, self.FACTOR_KP_OPT, self.FACTOR_V_MAX, self.FACTOR_MAX_DWELL])
+        self.MINS = np.array([self.MIN_NBR_TRAINS, self.MIN_DENSITY_MAX_OPT, self.MIN_V_MAX, self.MIN_MAX_DWELL])
+        self.MAXS = np.array([self.MAX_NBR_TRAINS, self.MAX_DENSITY_MAX_OPT, self.MAX_V_MAX, self.MAX_MAX_DWELL])
+        # Mapping order <==> simulator order (nbr_trains, v_max, max_dwell, density_max_opt)
+        self.TO_SIMULATOR = [self.NBR_TRAINS_INDEX, self.V_MAX_INDEX, self.DWELL_TIME_INDEX, self.DENSITY_MAX_OPT_INDEX]
+        self.FROM_SIMULATOR = np.argsort(self.TO_SIMULATOR)
+        self.params = np.zeros((nbr_envs, 4))
+        self.currentState = np.zeros((nbr_envs,) + self.INPUT_SHAPE)
+
+    def simulator_params(self, params):
+        return params[:, self.TO_SIMULATOR]
+
+    def states_to_array(self, states):
+        # list of simulator states (dicts) ==> (n, 7, 2), same layout as convert_to_dqn_array
+        return np.array([[state[key] for key in STATE_KEYS] for state in states]).reshape((-1,) + self.INPUT_SHAPE)
+
+    def simulate(self, simulator, params):
+        simulator_params = self.simulator_params(params)
+        if hasattr(simulator, 'simulate_array'):
+            return simulator.simulate_array(simulator_params).reshape((-1,) + self.INPUT_SHAPE)
+        return self.states_to_array(simulator.simulate_many([tuple(p) for p in simulator_params.tolist()]))
+
+    def reset(self, simulator=None, list_of_params=None):
+        # list_of_params: nbr_envs (nbr_trains, v_max, max_dwell, density_max_opt) tuples
+        if simulator is None:
+            self.currentState = np.zeros((self.nbr_envs,) + self.INPUT_SHAPE)
+            return self.currentState
+        self.params = np.array(list_of_params, dtype=np.float64)[:, self.FROM_SIMULATOR]
+        self.currentState = self.simulate(simulator, self.params)
+        return self.currentState
+
+    def apply_actions(self, params, actions):
+        # Same rules as the apply_action_to_* methods, for all the environments at once:
+        # a parameter only changes when it stays in [MIN, MAX]
+        deltas = self.ACTION_DELTAS[np.asarray(actions)]
+        allowed = np.where(deltas < 0, params >= self.MINS + self.FACTORS, params <= self.MAXS - self.FACTORS)
+        return np.where(allowed, params + deltas * self.FACTORS, params)
+
+    def step(self, simulator, actions):
+        new_params = self.apply_actions(self.params, actions)
+        new_states = self.simulate(simulator, new_params)
+        rewards = self.calculate_rewards(new_states)
+        self.params = new_params
+        self.currentState = new_states
+        dones = np.zeros(self.nbr_envs, dtype=bool)
+        return (new_states, self.simulator_params(new_params), rewards, dones, "")
 
+    def calculate_rewards(self, new_states):
+        # Same reward as calculate_reward, new_states: (n, 7, 2) DQN arrays
+        used_capacity = new_states[:, 5, 0] / self.TRAIN_CAPACITY
+        reward_comfort = np.sin((used_capacity - 0.2) * np.pi) - 0.5
+        reward_headway = (600 - new_states[:, 0, 0]) / 1000
+        reward_waiting = 0.5 - new_states[:, 4, 0] / self.PLATFORM_CAPACITY
+        return self.ALPHA_COMFORT * reward_comfort + self.ALPHA_HEADWAY * reward_headway + self.ALPHA_WAITING * reward_waiting
@@ -0,0 +1,457 @@
+import argparse
+import logging
+import os
+import queue
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from random import randint, uniform, random
+
+import numpy as np
+
+import custom_env
+from numpy_policy import NumpyPolicy
+from octave_adapter import OctaveAdapter, OCTAVE_EXEC
+from state_encoder import StateEncoder
+from transition_dataset import TransitionDataset
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Distributed rollouts ################
+#######################################
+# python distributed.py coordinator --port 5555 --episodes 50 --steps 50
+# python distributed.py worker --host <coordinator> --port 5555 --files-context <folder of main.m>
+# python distributed.py local --workers 4  (coordinator + 4 worker processes with the stub simulator)
+# The coordinator owns the DQN learner and the replay memory, the workers (CustomEnv + OctaveAdapter
+# + NumPy policy, no TensorFlow) run the episodes it hands out, pull its weights and push their
+# transitions. Workers can join or leave at any time: the episode of a lost worker is handed out again.
+# Messages: 5 bytes header (type: unsigned char, payload length: unsigned int, network order) + payload,
+# arrays are sent as dtype (3 bytes) + ndim + shape + raw bytes.
+DISTRIBUTED_HOST = "0.0.0.0"
+DISTRIBUTED_PORT = 5555
+SYNC_INTERVAL = 10  # worker steps between two pulls of the weights
+TRANSITION_BATCH = 10  # transitions per push
+WORKER_TIMEOUT = 600  # s without any message before a worker is considered lost (one simulation at most)
+WAIT_INTERVAL = 1.0  # s, workers ask again when all the episodes left are running
+NO_WORKER_TIMEOUT = 600  # s without any connected worker before the learner gives up
+QUEUE_SIZE = 100  # transition batches, the workers wait when the learner is this far behind
+MAX_PAYLOAD = 64 * 1024 * 1024
+#######################################
+
+HELLO = 1  # worker ==> coordinator: worker name
+WELCOME = 2  # coordinator ==> worker: worker id, steps per episode, sync interval
+EPISODE = 3  # worker ==> coordinator: weights version, asks for an episode
+PULL = 4  # worker ==> coordinator: weights version, asks for newer weights
+WEIGHTS = 5  # coordinator ==> worker: version, epsilon, weights and encoder state (none when up to date)
+TRANSITIONS = 6  # worker ==> coordinator: states, actions, rewards, next states, dones, parameters, next parameters
+WAIT = 7  # coordinator ==> worker: no episode to run for now
+STOP = 8  # coordinator ==> worker: training over
+
+HEADER = struct.Struct('!BI')
+ENCODER_KEYS = ('encoder_count', 'encoder_mean', 'encoder_var')
+
+
+def encode_arrays(arrays):
+    parts = [struct.pack('!H', len(arrays))]
+    for array in arrays:
+        array = np.asarray(array)
+        array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+        parts.append(struct.pack('!3sB', array.dtype.str.encode(), array.ndim))
+        parts.append(struct.pack('!%dI' % array.ndim, *array.shape))
+        parts.append(array.tobytes())
+    return b''.join(parts)
+
+
+def decode_arrays(payload, offset=0):
+    # ==> list of arrays (read-only views of payload), offset after them
+    count, = struct.unpack_from('!H', payload, offset)
+    offset += 2
+    arrays = []
+    for _ in range(count):
+        dtype, ndim = struct.unpack_from('!3sB', payload, offset)
+        offset += 4
+        shape = struct.unpack_from('!%dI' % ndim, payload, offset)
+        offset += 4 * ndim
+        dtype = np.dtype(dtype.decode())
+        size = int(np.prod(shape))
+        arrays.append(np.frombuffer(payload, dtype=dtype, count=size, offset=offset).reshape(shape))
+        offset += size * dtype.itemsize
+    return arrays, offset
+
+
+def send_message(connection, message_type, payload=b''):
+    connection.sendall(HEADER.pack(message_type, len(payload)) + payload)
+
+
+def receive_exactly(connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def receive_message(connection):
+    message_type, size = HEADER.unpack(receive_exactly(connection, HEADER.size))
+    if size > MAX_PAYLOAD:
+        raise ConnectionError("Message of %d bytes, larger than MAX_PAYLOAD" % size)
+    return message_type, receive_exactly(connection, size)
+
+
+def expect(message, *message_types):
+    if message[0] not in message_types:
+        raise ConnectionError("Unexpected message type %d" % message[0])
+    return message
+
+
+class Coordinator:
+    # TCP server of the workers, one thread per connection. Received transition batches are put in
+    # transitions (states, actions, rewards, next_states, dones, params, next_params), for the learner.
+    # store: async_training.PolicyStore, the weights sent to the workers, epsilon: set by the learner
+
+    def __init__(self, store, episodes, steps, epsilon, host=DISTRIBUTED_HOST, port=DISTRIBUTED_PORT,
+                 timeout=WORKER_TIMEOUT):
+        self.store = store
+        self.episodes = episodes
+        self.steps = steps
+        self.epsilon = epsilon
+        self.timeout = timeout
+        self.transitions = queue.Queue(maxsize=QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.remaining = episodes  # not handed out yet, or handed out again
+        self.completed = 0
+        self.workers = {}  # worker id ==> address
+        self.idle_since = time.monotonic()  # no worker connected since, None while some are
+        self.joined = 0
+        self.lost = 0
+        self.received = 0
+        self.server = socket.create_server((host, port))
+        self.port = self.server.getsockname()[1]
+        self.closed = False
+        self.thread = threading.Thread(target=self.accept, name='coordinator', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info("Coordinator listening on port %d, %d episodes of %d steps", self.port, self.episodes, self.steps)
+
+    def accept(self):
+        while not self.closed:
+            try:
+                connection, address = self.server.accept()
+            except OSError:
+                # Server socket closed
+                break
+            threading.Thread(target=self.serve, args=(connection, address), daemon=True).start()
+
+    def serve(self, connection, address):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        connection.settimeout(self.timeout)
+        worker_id = None
+        running = False  # an episode is handed out to this worker
+        try:
+            name = expect(receive_message(connection), HELLO)[1].decode()
+            with self.lock:
+                worker_id = self.joined
+                self.joined += 1
+                self.workers[worker_id] = address
+                self.idle_since = None
+            logger.info("Worker %d (%s) joined from %s, %d connected", worker_id, name, address, len(self.workers))
+            send_message(connection, WELCOME, struct.pack('!III', worker_id, self.steps, SYNC_INTERVAL))
+            while True:
+                message_type, payload = expect(receive_message(connection), EPISODE, PULL, TRANSITIONS)
+                if message_type == TRANSITIONS:
+                    batch, _ = decode_arrays(payload)
+                    self.transitions.put(tuple(batch))
+                    with self.lock:
+                        self.received += len(batch[1])
+                    continue
+                version, = struct.unpack('!i', payload)
+                if message_type == EPISODE:
+                    with self.lock:
+                        if running:
+                            # Asking for the next one: the previous episode is over
+                            self.completed += 1
+                            running = False
+                        if self.remaining > 0:
+                            self.remaining -= 1
+                            running = True
+                        finished = self.completed >= self.episodes
+                    if finished:
+                        send_message(connection, STOP)
+                        break
+                    if not running:
+                        send_message(connection, WAIT, struct.pack('!d', WAIT_INTERVAL))
+                        continue
+                send_message(connection, WEIGHTS, self.weights_payload(version))
+        except (OSError, ConnectionError, struct.error, ValueError) as e:
+            if not self.closed:
+                with self.lock:
+                    self.lost += 1
+                logger.warning("Worker %s lost (%s)%s", worker_id, e, ", its episode is handed out again" if running else "")
+        finally:
+            with self.lock:
+                if running:
+                    self.remaining += 1
+                self.workers.pop(worker_id, None)
+                if len(self.workers) == 0 and self.idle_since is None:
+                    self.idle_since = time.monotonic()
+            connection.close()
+            if worker_id is not None:
+                logger.info("Worker %d left, %d connected", worker_id, len(self.workers))
+
+    def weights_payload(self, worker_version):
+        version, weights, encoder_state = self.store.pull()
+        payload = struct.pack('!id', version, self.epsilon)
+        if worker_version == version:
+            return payload + encode_arrays([]) + encode_arrays([])
+        return payload + encode_arrays(weights) + encode_arrays([encoder_state[key] for key in ENCODER_KEYS])
+
+    def finished(self):
+        with self.lock:
+            return self.completed >= self.episodes
+
+    def idle_time(self):
+        # s since the last worker left (or since the start if none joined yet), 0 while workers are connected
+        with self.lock:
+            return time.monotonic() - self.idle_since if self.idle_since is not None else 0.0
+
+    def statistics(self):
+        with self.lock:
+            return {
+                'connected': len(self.workers),
+                'joined': self.joined,
+                'lost': self.lost,
+                'completed_episodes': self.completed,
+                'received_transitions': self.received
+            }
+
+    def close(self):
+        self.closed = True
+        self.server.close()
+
+
+def train_distributed(episodes=None, steps=None, host=DISTRIBUTED_HOST, port=DISTRIBUTED_PORT, on_start=None,
+                      transitions_fn=None, no_worker_timeout=NO_WORKER_TIMEOUT):
+    # Learner of the coordinator, same loop as async_training.train_async with the workers as actors.
+    # on_start(port): called once the coordinator listens (to start local workers)
+    # transitions_fn: TransitionDataset the transitions of the workers are appended to
+    # no_worker_timeout: s without any connected worker before a RuntimeError (the episodes left would never end)
+    from async_training import PolicyStore, MAX_REPLAY_RATIO
+    from dqn import DQN
+    env = custom_env.CustomEnv()
+    episodes = episodes if episodes is not None else env.MAX_EPISODES
+    steps = steps if steps is not None else env.MAX_STEPS
+    dqn_agent = DQN(env=env)
+    store = PolicyStore(dqn_agent.policy.get_weights(), dqn_agent.encoder.get_state())
+    coordinator = Coordinator(store, episodes, steps, dqn_agent.epsilon, host, port)
+    dataset = TransitionDataset(transitions_fn) if transitions_fn is not None else None
+    coordinator.start()
+    if on_start is not None:
+        on_start(coordinator.port)
+
+    received = 0
+    updates = 0
+    try:
+        while not coordinator.finished() or not coordinator.transitions.empty():
+            if not coordinator.finished() and coordinator.idle_time() > no_worker_timeout:
+                raise RuntimeError("No worker connected for %d s, %s" % (no_worker_timeout, coordinator.statistics()))
+            # Only wait for the workers when there is nothing to learn from
+            can_learn = len(dqn_agent.memory) >= dqn_agent.batch_size and updates < MAX_REPLAY_RATIO * received
+            batches = []
+            try:
+                batches.append(coordinator.transitions.get(block=not can_learn, timeout=1 if not can_learn else None))
+                while True:
+                    batches.append(coordinator.transitions.get_nowait())
+            except queue.Empty:
+                pass
+            for batch in batches:
+                states, actions, rewards, next_states, dones, params, next_params = batch
+                dqn_agent.remember(states, actions, rewards, next_states, dones)
+                if dataset is not None:
+                    dataset.add_batch(params, states, actions, next_params, next_states, dones)
+                received += len(batch[1])
+                # Epsilon decays once per transition, as with DQN.action
+                dqn_agent.epsilon = max(dqn_agent.epsilon_min, dqn_agent.epsilon * dqn_agent.epsilon_decay ** len(batch[1]))
+            coordinator.epsilon = dqn_agent.epsilon
+
+            if updates < MAX_REPLAY_RATIO * received and dqn_agent.replay():
+                dqn_agent.target_train()
+                updates += 1
+                store.publish(dqn_agent.policy.get_weights(), dqn_agent.encoder.get_state())
+        # With fast simulators the workers end long before the learner: it catches up with the replay ratio
+        while updates < MAX_REPLAY_RATIO * received and dqn_agent.replay():
+            dqn_agent.target_train()
+            updates += 1
+    finally:
+        coordinator.close()
+        if dataset is not None:
+            dataset.close()
+    logger.info("Ended distributed training: %d transitions, %d updates, workers %s", received, updates,
+                coordinator.statistics())
+    return dqn_agent
+
+
+def run_worker(simulator, host, port, name=''):
+    # Runs the episodes handed out by the coordinator until it stops the training
+    env = custom_env.CustomEnv()
+    with socket.create_connection((host, port)) as connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_message(connection, HELLO, name.encode())
+        worker_id, steps, sync_interval = struct.unpack('!III', expect(receive_message(connection), WELCOME)[1])
+        logger.info("Joined the coordinator %s:%d as worker %d", host, port, worker_id)
+        policy = NumpyPolicy([np.zeros((1, 1)), np.zeros(1)], StateEncoder(env.INPUT_SHAPE))
+        version = -1
+        epsilon = 1.0
+        episodes = 0
+
+        def pull(message_type):
+            nonlocal version, epsilon
+            send_message(connection, message_type, struct.pack('!i', version))
+            message_type, payload = expect(receive_message(connection), WEIGHTS, WAIT, STOP)
+            if message_type != WEIGHTS:
+                return message_type, payload
+            version, epsilon = struct.unpack_from('!id', payload)
+            weights, offset = decode_arrays(payload, struct.calcsize('!id'))
+            encoder_state, _ = decode_arrays(payload, offset)
+            if len(weights) > 0:
+                policy.set_weights(weights)
+                policy.encoder.set_state(dict(zip(ENCODER_KEYS, encoder_state)))
+            return message_type, payload
+
+        while True:
+            message_type, payload = pull(EPISODE)
+            if message_type == STOP:
+                break
+            if message_type == WAIT:
+                time.sleep(struct.unpack('!d', payload)[0])
+                continue
+            nbr_trains = randint(env.MIN_NBR_TRAINS, env.MAX_NBR_TRAINS)
+            v_max = round(uniform(env.MIN_V_MAX, env.MAX_V_MAX), 2)
+            max_dwell = round(uniform(env.MIN_MAX_DWELL, env.MAX_MAX_DWELL), 2)
+            density_max_opt = round(uniform(env.MIN_DENSITY_MAX_OPT, env.MAX_DENSITY_MAX_OPT), 2)
+            current_state = simulator.simulate(nbr_trains, v_max, max_dwell, density_max_opt)
+            batch = []
+            for step in range(steps):
+                if step > 0 and step % sync_interval == 0:
+                    pull(PULL)
+                state_array = env.convert_to_dqn_array(current_state)
+                if random() < epsilon:
+                    action = randint(0, len(env.ACTIONS) - 1)
+                else:
+                    action = policy.action(state_array)
+                new_state, new_params, reward, done, done_reason = env.step(
+                    simulator, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action)
+                batch.append((state_array, action, reward, env.convert_to_dqn_array(new_state), done,
+                              (nbr_trains, v_max, max_dwell, density_max_opt),
+                              (new_params['nbr_trains'], new_params['v_max'], new_params['max_dwell'],
+                               new_params['density_max_opt'])))
+                if len(batch) == TRANSITION_BATCH or step == steps - 1:
+                    states, actions, rewards, next_states, dones, params, next_params = zip(*batch)
+                    # States in float64 for the transition dataset of the coordinator
+                    send_message(connection, TRANSITIONS, encode_arrays([
+                        np.array(states), np.array(actions, dtype=np.int32),
+                        np.array(rewards, dtype=np.float32), np.array(next_states),
+                        np.array(dones, dtype=np.float32), np.array(params, dtype=np.float64),
+                        np.array(next_params, dtype=np.float64)]))
+                    batch = []
+
+                current_state = new_state
+                nbr_trains = new_params['nbr_trains']
+                v_max = new_params['v_max']
+                max_dwell = new_params['max_dwell']
+                density_max_opt = new_params['density_max_opt']
+            episodes += 1
+            logger.info("Worker %d ended its episode #%d", worker_id, episodes)
+    logger.info("Training over, worker %d ran %d episodes", worker_id, episodes)
+    return episodes
+
+
+def create_worker_simulator(env, backend, files_context=None):
+    # ==> simulator, scratch folder to remove (stub)
+    if backend == 'numpy':
+        from numpy_simulator import NumpySimulator
+        return NumpySimulator(env), None
+    if backend == 'stub':
+        from stub_simulator import STUB_COMMAND
+        scratch = tempfile.mkdtemp(prefix='distributed_worker_')
+        os.makedirs(os.path.join(scratch, 'io'))
+        return OctaveAdapter(scratch, octave_exec=STUB_COMMAND), scratch
+    return OctaveAdapter(files_context, octave_exec=OCTAVE_EXEC), None
+
+
+def run_transitions_fn(folder):
+    # One transition file per coordinator run, as the runs of train.py
+    return os.path.join(folder, "distributed_" + datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + ".bin")
+
+
+def start_local_workers(port, count, backend='stub'):
+    # Worker processes on this host, for tests without Octave
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--host', '127.0.0.1',
+                              '--port', str(port), '--backend', backend, '--name', 'local_' + str(i)])
+            for i in range(count)]
+
+
+if __name__ == "__main__":
+    from logs import setup_logging, LOG_LEVELS
+    parser = argparse.ArgumentParser(description="DQN learner coordinating remote rollout workers over TCP")
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    coordinator_parser = subparsers.add_parser('coordinator')
+    coordinator_parser.add_argument('--host', default=DISTRIBUTED_HOST)
+    coordinator_parser.add_argument('--port', type=int, default=DISTRIBUTED_PORT)
+    coordinator_parser.add_argument('--episodes', type=int)
+    coordinator_parser.add_argument('--steps', type=int)
+    coordinator_parser.add_argument('--model', default='model')
+    coordinator_parser.add_argument('--transitions', help="transition dataset of the workers, "
+                                                          "a new file in train.TRANSITIONS_FOLDER if not given")
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('--host', default='127.0.0.1')
+    worker_parser.add_argument('--port', type=int, default=DISTRIBUTED_PORT)
+    worker_parser.add_argument('--backend', choices=('octave', 'numpy', 'stub'), default='octave')
+    worker_parser.add_argument('--files-context', help="folder of main.m for the octave backend")
+    worker_parser.add_argument('--name', default=socket.gethostname())
+    local_parser = subparsers.add_parser('local')
+    local_parser.add_argument('--workers', type=int, default=4)
+    local_parser.add_argument('--backend', choices=('numpy', 'stub'), default='stub')
+    local_parser.add_argument('--episodes', type=int, default=8)
+    local_parser.add_argument('--steps', type=int, default=10)
+    local_parser.add_argument('--model', default='model_distributed')
+    local_parser.add_argument('--transitions', help="transition dataset, a new file in transitions_<backend> if not given")
+    args = parser.parse_args()
+    setup_logging(levels=dict(LOG_LEVELS, **{__name__: 'INFO'}))
+
+    if args.mode == 'worker':
+        simulator, scratch = create_worker_simulator(custom_env.CustomEnv(), args.backend, args.files_context)
+        try:
+            run_worker(simulator, args.host, args.port, args.name)
+        except ConnectionError as e:
+            logger.warning("Coordinator lost: %s", e)
+        finally:
+            simulator.close()
+            if scratch is not None:
+                shutil.rmtree(scratch, ignore_errors=True)
+    elif args.mode == 'coordinator':
+        import train
+        dqn_agent = train_distributed(args.episodes, args.steps, args.host, args.port,
+                                      transitions_fn=args.transitions or run_transitions_fn(train.TRANSITIONS_FOLDER))
+        dqn_agent.save_model(args.model)
+    else:
+        processes = []
+        try:
+            dqn_agent = train_distributed(args.episodes, args.steps, '127.0.0.1', 0,
+                                          on_start=lambda port: processes.extend(
+                                              start_local_workers(port, args.workers, args.backend)),
+                                          transitions_fn=args.transitions or run_transitions_fn('transitions_' + args.backend))
+            dqn_agent.save_model(args.model)
+        finally:
+            for process in processes:
+                process.wait()
@@ -1,14 +1,31 @@
+import tensorflow as tf
 from tensorflow.keras.layers import Dense
 from tensorflow.keras.models import Sequential, load_model
 from tensorflow.keras.optimizers import Adam
+import logging
 import numpy as np
-from random import randint, sample
+import os
 
-from collections import deque
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer
+from numpy_policy import NumpyPolicy
+from state_encoder import StateEncoder
+from timing import span, timed
+
+logger = logging.getLogger(__name__)
+
+
+def optimizer_variables(optimizer):
+    # Iteration count and Adam moments. The optimizers of TF >= 2.11 have no get_weights / set_weights,
+    # their variables are a list (a method before)
+    variables = optimizer.variables
+    return list(variables) if isinstance(variables, (list, tuple)) else list(variables())
 
 
 class DQN:
-    def __init__(self, env):
+    # prioritized: PrioritizedReplayBuffer (sampling by TD error) instead of the uniform ReplayBuffer
+    # double: Double DQN targets, the action of the next state is chosen by model and evaluated by target_model
+    # n_step: returns over the n following transitions of the trajectory (ReplayBuffer.n_step)
+    def __init__(self, env, prioritized=False, double=True, n_step=1):
         self.env = env
         self.gamma = 0.85
         self.epsilon = 1.0
@@ -17,83 +34,175 @@ class DQN:
         self.learning_rate = 0.01  #   0.001
         self.tau = .125
         self.batch_size = 8
-        self.memory = deque(maxlen=self.batch_size)
+        # Transitions are kept and sampled again until they get overwritten
+        self.memory_capacity = 100000
+        self.prioritized = prioritized
+        self.double = double
+        self.n_step = n_step
+        if prioritized:
+            self.memory = PrioritizedReplayBuffer(self.memory_capacity, self.env.INPUT_SHAPE)
+        else:
+            self.memory = ReplayBuffer(self.memory_capacity, self.env.INPUT_SHAPE)
+        # Running mean / std of the states, shared with the policy
+        self.encoder = StateEncoder(self.env.INPUT_SHAPE)
 
         # model is updated instantly
         # target_model updated after each batch
         self.model = self.create_model()
         self.target_model = self.create_model()
+        # NumPy copy of target_model, for the greedy actions
+        self.policy = NumpyPolicy(self.target_model.get_weights(), self.encoder)
 
     # model network weights predictions
     def create_model(self):
         model = Sequential()
         state_shape = self.env.INPUT_SHAPE
 
-        model.add(Dense(state_shape[0] * state_shape[1], input_dim= 1, activation="relu"))
+        # One sample per state: the 14 values of the (7, 2) DQN array
+        model.add(Dense(state_shape[0] * state_shape[1], input_dim=state_shape[0] * state_shape[1], activation="relu"))
         model.add(Dense(48 * 4, activation="relu"))
         model.add(Dense(56 * 4, activation="relu"))
         model.add(Dense(100 * 4, activation="relu"))
         model.add(Dense(56 * 4, activation="relu"))
         model.add(Dense(self.env.OUTPUT_SHAPE))
         model.compile(loss="mean_squared_error",
-                      optimizer=Adam(lr=self.learning_rate))
+                      optimizer=Adam(learning_rate=self.learning_rate))
         return model
 
-    def flatten_state(self, state):
-        return state.flatten()
+    def as_batch(self, states):
+        # One DQN array (7, 2) or a batch of them ==> (batch, 7, 2)
+        return np.asarray(states).reshape((-1,) + tuple(self.env.INPUT_SHAPE))
+
+    def encode_states(self, states):
+        # ==> (batch, 14) normalized network inputs
+        return self.encoder.encode(states)
 
+    @timed('dqn.action')
     def action(self, state):
-        self.epsilon *= self.epsilon_decay
+        # state: one DQN array, returns one action
+        #     or a batch of DQN arrays, returns an array of actions (epsilon decays once per state)
+        single = np.ndim(state) == len(self.env.INPUT_SHAPE)
+        states = self.as_batch(state)
+        count = len(states)
+        self.epsilon *= self.epsilon_decay ** count
         self.epsilon = max(self.epsilon_min, self.epsilon)
-        print("<------> New Epsilon value: " + str(self.epsilon))
-        action = 0
-        if np.random.random() < self.epsilon:
-            # Exploration
-            action = int(self.env.ACTIONS[randint(0, len(self.env.ACTIONS)-1)])
-            print("------> Taking action: Random")
-        else:
+        logger.debug("New Epsilon value: %s", self.epsilon)
+        # Exploration
+        explore = np.random.random(count) < self.epsilon
+        actions = np.random.randint(0, len(self.env.ACTIONS), size=count)
+        if not explore.all():
             # Exploitation
-            predictions = self.target_model.predict(self.flatten_state(state))
-            # predictions[0] ==> because the output shape is (1, 81) meaning one line and 81 column
-            #   so to get the probabilities of taking each of the 81 actions we use the first line (index 0)
-            action = np.argmax(predictions[0])
-            print("------> Taking action: Predicted")
-        print("<------ Taking action: " + str(action) + " => " + str(self.env.MAPPING[self.env.ACTIONS[action]]))
+            with span('dqn.predict'):
+                predictions = self.policy.q_values(states)
+            actions = np.where(explore, actions, np.argmax(predictions, axis=1))
+        if not single:
+            return actions
+        action = int(actions[0])
+        logger.debug("Taking action: %s %d => %s", "Random" if explore[0] else "Predicted",
+                     action, self.env.MAPPING[self.env.ACTIONS[action]])
         return action
 
+    @timed('dqn.remember')
     def remember(self, state, action, reward, new_state, done):
-        self.memory.append([state, action, reward, new_state, done])
+        # One transition, or a batch of transitions (arrays of actions, rewards, dones)
+        if np.ndim(action) == 0:
+            self.memory.add(state, action, reward, new_state, done)
+        else:
+            self.memory.add_batch(self.as_batch(state), action, reward, self.as_batch(new_state), done)
+        self.encoder.update(state)
 
+    @timed('dqn.replay')
     def replay(self):
         # transfer old model of target model after modification after 8 step
         if len(self.memory) < self.batch_size:
             return False
         # each element of memory is cur_state, action, reward, new_state, done(after each step)
-        samples = sample(self.memory, self.batch_size)
-        for _sample in samples:
-            state, action, reward, new_state, done = _sample
-            target = self.target_model.predict(self.flatten_state(state))
-            if done:
-                target[0][action] = reward
+        weights = None
+        if self.prioritized:
+            states, actions, rewards, new_states, dones, indices, weights = self.memory.sample(self.batch_size)
+        else:
+            indices = self.memory.sample_indices(self.batch_size)
+            states, actions, rewards, new_states, dones = self.memory.get(indices)
+        discounts = self.gamma
+        if self.n_step > 1:
+            # rewards: discounted sums, new_states: the states the n-step returns end in
+            rewards, new_states, dones, discounts = self.memory.n_step(indices, self.n_step, self.gamma)
+        # One forward pass of the target model over the states and the new states. The models are called
+        # directly: predict_on_batch costs more than the pass itself at these batch sizes
+        inputs = self.encode_states(states)
+        new_inputs = self.encode_states(new_states)
+        both = np.concatenate([inputs, new_inputs])
+        rows = np.arange(self.batch_size)
+        with span('dqn.predict_on_batch'):
+            target_values = self.target_model(both, training=False).numpy()
+            targets, Q_next = target_values[:self.batch_size], target_values[self.batch_size:]
+            if self.double or self.prioritized:
+                # Online model: current Q values (TD errors) and next actions (Double DQN), in one pass
+                online = self.model(both, training=False).numpy()
+            if self.double:
+                Q_future = Q_next[rows, np.argmax(online[self.batch_size:], axis=1)]
             else:
-                Q_future = max(self.target_model.predict(self.flatten_state(new_state))[0])
-                target[0][action] = reward + Q_future * self.gamma
-            self.model.fit(self.flatten_state(state), target, epochs=1, verbose=0)
-        self.clear_memory()
+                Q_future = Q_next.max(axis=1)
+        # done: reward only, otherwise reward + discounted future Q value
+        new_values = rewards + Q_future * discounts * (1 - dones)
+        if self.prioritized:
+            # Priorities: errors of the model being trained, not of the slower target model
+            td_errors = new_values - online[:self.batch_size][rows, actions]
+        targets[rows, actions] = new_values
+        # A single gradient step for the whole minibatch (importance-sampling weights with priorities)
+        with span('dqn.fit'):
+            self.model.train_on_batch(inputs, targets, sample_weight=weights)
+        if self.prioritized:
+            self.memory.update_priorities(indices, td_errors)
         return True
 
+    @timed('dqn.target_train')
     def target_train(self):
         weights = self.model.get_weights()
         target_weights = self.target_model.get_weights()
         for i in range(len(target_weights)):
             target_weights[i] = weights[i] * self.tau + target_weights[i] * (1 - self.tau)
         self.target_model.set_weights(target_weights)
+        self.policy.set_weights(target_weights)
 
     def clear_memory(self):
         self.memory.clear()
 
+    def get_state(self):
+        # Everything the training depends on (networks, Adam moments, epsilon, replay memory,
+        # input normalization), as copies: the caller can write them while the training goes on
+        return {
+            'model_weights': self.model.get_weights(),
+            'target_weights': self.target_model.get_weights(),
+            'optimizer_weights': [variable.numpy() for variable in optimizer_variables(self.model.optimizer)],
+            'epsilon': self.epsilon,
+            'encoder': {key: np.copy(value) for key, value in self.encoder.get_state().items()},
+            'memory': self.memory.get_state()
+        }
+
+    def set_state(self, state):
+        self.model.set_weights(state['model_weights'])
+        self.target_model.set_weights(state['target_weights'])
+        self.policy.set_weights(state['target_weights'])
+        optimizer = self.model.optimizer
+        if len(optimizer_variables(optimizer)) < len(state['optimizer_weights']):
+            # Adam creates its moments on the first update: zero gradients to create them, overwritten below
+            variables = self.model.trainable_weights
+            optimizer.apply_gradients(zip([tf.zeros_like(variable) for variable in variables], variables))
+        for variable, value in zip(optimizer_variables(optimizer), state['optimizer_weights']):
+            variable.assign(value)
+        self.epsilon = state['epsilon']
+        self.encoder.set_state(state['encoder'])
+        self.memory.set_state(state['memory'])
+
     def save_model(self, fn):
         self.target_model.save(fn)
+        # Also exported for play.py without TensorFlow
+        self.policy.save(fn + '.npz')
 
     def load_model(self, fn):
         self.target_model = load_model(fn)
+        self.policy.set_weights(self.target_model.get_weights())
+        # The normalization of the inputs is only saved with the exported policy
+        if os.path.exists(fn + '.npz'):
+            self.encoder.set_state(NumpyPolicy.load(fn + '.npz').encoder.get_state())
@@ -0,0 +1,199 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+import custom_env
+from octave_adapter import PARAMETER_KEYS, STATE_KEYS
+
+#######################################
+# Precomputed lattice table ###########
+#######################################
+# python lattice_table.py table_folder --strides 8 5 29 15 --backend numpy
+# Simulates a sub-lattice of the control lattice (every stride-th point of each parameter, plus
+# the last one) and stores the 14 values in a memory-mapped table indexed by lattice coordinates.
+# Chunks are marked done as they are written: running the sweep again continues it (with the same strides,
+# a table of other strides needs another folder).
+# LatticeTableSimulator answers from the table, with multilinear interpolation between its points.
+SWEEP_STRIDES = (8, 5, 29, 15)  # nbr_trains, v_max, max_dwell, density_max_opt (lattice steps)
+SWEEP_CHUNK = 256  # points per simulate_many call
+TABLE_FILE = "table.npy"
+DONE_FILE = "done.npy"
+META_FILE = "meta.json"
+#######################################
+
+logger = logging.getLogger(__name__)
+
+
+def lattice_coordinates(env, params):
+    # (n, 4) simulator order parameters ==> (n, 4) lattice coordinates, not rounded
+    # (same as CustomEnv.lattice_indices for the points of the lattice)
+    params = np.asarray(params, dtype=np.float64).reshape(-1, 4)
+    mins = np.array([env.MIN_NBR_TRAINS, env.MIN_V_MAX, env.MIN_MAX_DWELL, env.MIN_DENSITY_MAX_OPT])
+    factors = np.array([env.FACTOR_NBR_TRAINS, env.FACTOR_V_MAX, env.FACTOR_MAX_DWELL, env.FACTOR_KP_OPT])
+    return (params - mins) / factors
+
+
+def lattice_shape(env):
+    return tuple(index + 1 for index in env.lattice_indices(env.MAX_NBR_TRAINS, env.MAX_V_MAX,
+                                                            env.MAX_MAX_DWELL, env.MAX_DENSITY_MAX_OPT))
+
+
+def lattice_axes(env, strides):
+    # Lattice indices of the table points along each parameter
+    return [np.unique(np.append(np.arange(0, size, stride), size - 1)) for size, stride in zip(lattice_shape(env), strides)]
+
+
+class LatticeTable:
+    # folder/table.npy: (n0, n1, n2, n3, 14) float32, folder/done.npy: (n0, n1, n2, n3) bool,
+    # folder/meta.json: the lattice indices of each axis
+    # strides: of a new table (SWEEP_STRIDES if None), those of an existing table must be the same
+
+    def __init__(self, folder, env, strides=None, mode='r+'):
+        self.folder = folder
+        self.env = env
+        meta_fn = os.path.join(folder, META_FILE)
+        if os.path.exists(meta_fn):
+            with open(meta_fn) as f:
+                meta = json.load(f)
+            self.axes = [np.array(axis) for axis in meta['axes']]
+            if strides is not None and any(len(axis) != len(requested) or (axis != requested).any()
+                                           for axis, requested in zip(self.axes, lattice_axes(env, strides))):
+                raise ValueError(folder + " holds a table of other strides than " + str(tuple(strides))
+                                 + ", sweep them into another folder")
+        else:
+            if mode == 'r':
+                raise ValueError(folder + " holds no lattice table")
+            os.makedirs(folder, exist_ok=True)
+            self.axes = lattice_axes(env, strides if strides is not None else SWEEP_STRIDES)
+            shape = tuple(len(axis) for axis in self.axes)
+            np.lib.format.open_memmap(os.path.join(folder, TABLE_FILE), mode='w+', dtype=np.float32,
+                                      shape=shape + (len(STATE_KEYS),)).flush()
+            np.lib.format.open_memmap(os.path.join(folder, DONE_FILE), mode='w+', dtype=np.bool_, shape=shape).flush()
+            with open(meta_fn, 'w') as f:
+                json.dump({'axes': [axis.tolist() for axis in self.axes], 'keys': list(STATE_KEYS)}, f)
+        self.table = np.load(os.path.join(folder, TABLE_FILE), mmap_mode=mode)
+        self.done = np.load(os.path.join(folder, DONE_FILE), mmap_mode=mode)
+        self.shape = self.done.shape
+
+    def progress(self):
+        return int(self.done.sum()), self.done.size
+
+    def params_of(self, positions):
+        # (n, 4) positions in the table ==> (n, 4) simulator order parameters
+        return [self.env.lattice_params([int(self.axes[d][p[d]]) for d in range(4)]) for p in positions]
+
+    def sweep(self, simulator, chunk=SWEEP_CHUNK):
+        # simulator: simulate_many (SimulatorPool for parallel Octave workers) or simulate_array (NumpySimulator)
+        missing = np.argwhere(~np.asarray(self.done))
+        logger.info("Sweep: %d points done, %d to simulate", self.done.size - len(missing), len(missing))
+        start = time.perf_counter()
+        for first in range(0, len(missing), chunk):
+            positions = missing[first:first + chunk]
+            list_of_params = self.params_of(positions)
+            if hasattr(simulator, 'simulate_array'):
+                states = simulator.simulate_array(np.array(list_of_params))
+            else:
+                states = [[state[key] for key in STATE_KEYS] for state in simulator.simulate_many(list_of_params)]
+            index = tuple(positions.T)
+            self.table[index] = states
+            self.table.flush()
+            # Marked done only once the values are on disk
+            self.done[index] = True
+            self.done.flush()
+            done = first + len(positions)
+            elapsed = time.perf_counter() - start
+            logger.info("Sweep: %d / %d points, %.1f points/s, %.0f s left", done, len(missing), done / elapsed,
+                        (len(missing) - done) * elapsed / done)
+
+    def lookup(self, params):
+        # (n, 4) simulator order parameters ==> (n, 14) values (STATE_KEYS order)
+        # multilinear interpolation between the 16 table points around each parameter set
+        coordinates = lattice_coordinates(self.env, params)
+        lows = np.zeros(coordinates.shape, dtype=np.int64)
+        fractions = np.zeros(coordinates.shape)
+        for d, axis in enumerate(self.axes):
+            c = np.clip(coordinates[:, d], axis[0], axis[-1])
+            lows[:, d] = np.clip(np.searchsorted(axis, c, side='right') - 1, 0, len(axis) - 2)
+            fractions[:, d] = (c - axis[lows[:, d]]) / (axis[lows[:, d] + 1] - axis[lows[:, d]])
+        # Flat indices and weights of the 16 corners: (n, 16)
+        flat_strides = np.array(self.done.strides) // self.done.itemsize
+        corners = np.array(list(itertools.product((0, 1), repeat=4)))
+        indices = (lows @ flat_strides)[:, None] + corners @ flat_strides
+        weights = np.ones((len(coordinates), 1))
+        for d in range(4):
+            # Corner order of itertools.product: the first dimension varies the slowest
+            weights = (weights[:, :, None] * np.stack([1 - fractions[:, d], fractions[:, d]], axis=1)[:, None, :]
+                       ).reshape(len(coordinates), -1)
+        done = np.asarray(self.done).reshape(-1)[indices]
+        if not (done | (weights == 0)).all():
+            raise ValueError("The lattice table is missing points around these parameters, run the sweep")
+        values = np.asarray(self.table).reshape(-1, self.table.shape[-1])[indices]
+        return np.matmul(weights[:, None, :].astype(values.dtype), values)[:, 0].astype(np.float64)
+
+
+class LatticeTableSimulator:
+    # Simulator backend reading the table: same interface as NumpySimulator (simulate_array for VectorCustomEnv)
+
+    def __init__(self, env, folder, in_memory=True):
+        self.env = env
+        self.table = LatticeTable(folder, env, mode='r')
+        if in_memory:
+            # Random reads from RAM instead of the page cache
+            self.table.table = np.array(self.table.table)
+            self.table.done = np.array(self.table.done)
+        self.params = None
+
+    def simulate_array(self, params):
+        return self.table.lookup(params)
+
+    def simulate_many(self, list_of_params):
+        values = self.simulate_array(np.array(list(list_of_params), dtype=np.float64).reshape(-1, 4))
+        return [{key: float(value) for key, value in zip(STATE_KEYS, row)} for row in values]
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        return self.simulate_many([(nbr_trains, v_max, max_dwell, density_max_opt)])[0]
+
+    def write_to_octave(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        self.params = (nbr_trains, v_max, max_dwell, density_max_opt)
+
+    def run_octave(self):
+        pass
+
+    def read_from_octave(self):
+        return self.simulate(*self.params)
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    from logs import setup_logging, LOG_LEVELS
+    parser = argparse.ArgumentParser(description="Simulate a sub-lattice of the control parameters into a table")
+    parser.add_argument('folder')
+    parser.add_argument('--strides', type=int, nargs=4, metavar=tuple(PARAMETER_KEYS),
+                        help="of a new table, SWEEP_STRIDES if not given (an existing table keeps its strides)")
+    parser.add_argument('--backend', choices=('octave', 'numpy'), default='octave')
+    parser.add_argument('--files-context', help="folder of main.m for the octave backend")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk', type=int, default=SWEEP_CHUNK)
+    args = parser.parse_args()
+    setup_logging(levels=dict(LOG_LEVELS, **{__name__: 'INFO'}))
+
+    env = custom_env.CustomEnv()
+    table = LatticeTable(args.folder, env, args.strides)
+    if args.backend == 'numpy':
+        from numpy_simulator import NumpySimulator
+        simulator = NumpySimulator(env)
+    else:
+        from simulator_pool import SimulatorPool
+        simulator = SimulatorPool(args.files_context, workers=args.workers)
+    try:
+        table.sweep(simulator, args.chunk)
+    finally:
+        simulator.close()
+    print("Points simulated: %d / %d" % table.progress())
@@ -0,0 +1,117 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+#######################################
+# Logging #############################
+#######################################
+# The records are put in a queue by the calling thread and written by a listener thread,
+# training never waits for the terminal or the log file.
+# Levels per module (logger name = module name), "" for everything else.
+# LOG_LEVELS="octave_adapter=DEBUG,dqn=DEBUG" in the environment is added to them
+# (train=DEBUG: one JSON line per step, INFO: one per episode).
+LOG_LEVELS = {
+    '': 'WARNING',
+    'train': 'INFO',
+    'play': 'INFO',
+    'async_training': 'INFO',
+    'offline_train': 'INFO',
+    'sample_efficiency': 'INFO',
+    'distributed': 'INFO'
+}
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+#######################################
+
+LISTENER = None
+CONFIGURATION = None  # (path, levels) of the running listener
+
+
+def parse_levels(text):
+    # "octave_adapter=DEBUG,dqn=INFO" ==> {'octave_adapter': 'DEBUG', 'dqn': 'INFO'}
+    levels = {}
+    for item in text.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+        elif item.strip() != '':
+            levels[''] = item.strip().upper()
+    return levels
+
+
+def setup_logging(path=None, levels=None):
+    # path: also write the records to this file
+    # Called again with the same arguments: nothing changes, otherwise the previous setup is replaced
+    global LISTENER, CONFIGURATION
+    levels = dict(LOG_LEVELS if levels is None else levels)
+    levels.update(parse_levels(os.environ.get('LOG_LEVELS', '')))
+    if LISTENER is not None and CONFIGURATION == (path, levels):
+        return
+    stop_logging()
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path is not None:
+        handlers.append(logging.FileHandler(path))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    for name, level in levels.items():
+        logging.getLogger(name or None).setLevel(level)
+
+    LISTENER = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    LISTENER.start()
+    CONFIGURATION = (path, levels)
+
+
+def setup_process_logging():
+    # In a child process (e.g. the plotter): the queue of the parent has no listener here, the records
+    # are written directly to the terminal
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+
+
+def stop_logging():
+    # Writes the records still in the queue
+    global LISTENER, CONFIGURATION
+    if LISTENER is not None:
+        LISTENER.stop()
+        for handler in LISTENER.handlers:
+            handler.close()
+        LISTENER = None
+        CONFIGURATION = None
+
+
+atexit.register(stop_logging)
+
+
+def log_step(logger, episode, step, action, reward, epsilon, params, state):
+    # One JSON line per step (DEBUG): episode, step, action, reward, epsilon, parameters and state means
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    summary = {'episode': episode, 'step': step, 'action': action, 'reward': reward, 'epsilon': epsilon}
+    summary.update(params)
+    summary.update({key: value for key, value in state.items() if key.endswith('_mean')})
+    logger.debug("step %s", json.dumps(summary))
+
+
+def log_episode(logger, episode, steps, total_reward, epsilon, params, state):
+    # One JSON line per episode (INFO): total and mean reward, epsilon, last parameters and state means
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    summary = {'episode': episode, 'steps': steps, 'total_reward': total_reward,
+               'mean_reward': total_reward / steps if steps > 0 else 0.0, 'epsilon': epsilon}
+    summary.update(params)
+    summary.update({key: value for key, value in state.items() if key.endswith('_mean')})
+    logger.info("episode %s", json.dumps(summary))
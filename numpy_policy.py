@@ -0,0 +1,79 @@
+import sys
+import numpy as np
+
+from state_encoder import StateEncoder
+
+
+class NumpyPolicy:
+    # Forward pass of the DQN network (Dense relu layers + linear output) in plain NumPy,
+    # to select greedy actions without TensorFlow.
+
+    def __init__(self, weights, encoder=None):
+        self.set_weights(weights)
+        # StateEncoder normalizing the states as for the training, None for raw flattened states
+        self.encoder = encoder
+
+    def set_weights(self, weights):
+        # Keras order of Sequential.get_weights(): kernel and bias of each Dense layer
+        self.kernels = [np.asarray(kernel, dtype=np.float32) for kernel in weights[0::2]]
+        self.biases = [np.asarray(bias, dtype=np.float32) for bias in weights[1::2]]
+        self.input_dim = self.kernels[0].shape[0]
+
+    def get_weights(self):
+        weights = []
+        for kernel, bias in zip(self.kernels, self.biases):
+            weights += [kernel, bias]
+        return weights
+
+    def predict(self, inputs):
+        x = np.asarray(inputs, dtype=np.float32)
+        for kernel, bias in zip(self.kernels[:-1], self.biases[:-1]):
+            x = np.maximum(x @ kernel + bias, 0)
+        return x @ self.kernels[-1] + self.biases[-1]
+
+    def q_values(self, states):
+        # states: batch of DQN arrays (CustomEnv.convert_to_dqn_array), returns (batch, 81)
+        if self.encoder is None:
+            return self.predict(np.asarray(states, dtype=np.float32).reshape(-1, self.input_dim))
+        return self.predict(self.encoder.encode(states))
+
+    def actions(self, states):
+        return np.argmax(self.q_values(states), axis=1)
+
+    def action(self, state):
+        return int(self.actions(np.asarray(state)[None])[0])
+
+    def save(self, fn):
+        arrays = {}
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            arrays['kernel_' + str(i)] = kernel
+            arrays['bias_' + str(i)] = bias
+        if self.encoder is not None:
+            arrays.update(self.encoder.get_state())
+        np.savez(fn, **arrays)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as arrays:
+            weights = []
+            i = 0
+            while 'kernel_' + str(i) in arrays.files:
+                weights += [arrays['kernel_' + str(i)], arrays['bias_' + str(i)]]
+                i += 1
+            encoder = None
+            if 'encoder_mean' in arrays.files:
+                encoder = StateEncoder(arrays['encoder_mean'].shape)
+                encoder.set_state(arrays)
+        return cls(weights, encoder)
+
+
+def export_model(model_fn, fn):
+    # model saved by DQN.save_model ==> .npz of its Dense weights
+    # (without normalization, DQN.save_model exports the policy with it)
+    from tensorflow.keras.models import load_model
+    NumpyPolicy(load_model(model_fn).get_weights()).save(fn)
+
+
+if __name__ == "__main__":
+    # python numpy_policy.py model model.npz
+    export_model(sys.argv[1], sys.argv[2])
@@ -0,0 +1,154 @@
+import numpy as np
+
+from octave_adapter import STATE_KEYS
+
+#######################################
+# Line model ##########################
+#######################################
+# Ring line of NBR_BLOCKS blocks of BLOCK_LENGTH with NBR_STATIONS evenly spaced stations.
+# Trains run at v_max, keep SAFETY_BLOCKS free in front of them (block signaling) and
+# stop at every station, where passengers alight, board and the dwell time depends on both.
+NBR_BLOCKS = 150
+NBR_STATIONS = 25
+SAFETY_BLOCKS = 1
+TIME_STEP = 1  # s
+SIMULATION_TIME = 3600  # s
+WARM_UP_TIME = 900  # s, not included in the statistics
+DEMAND = 1.0  # mean flow of passengers arriving at a station (pass / s)
+ALIGHTING_RATE = 0.12  # part of the passengers of a train leaving it at each station
+MIN_DWELL = 15  # s
+BOARDING_TIME = 0.04  # s per passenger boarding or alighting
+PLATFORM_REFERENCE_DENSITY = 4  # density used for CustomEnv.PLATFORM_CAPACITY (pass / m2)
+#######################################
+
+# Recorded at each arrival of a train at a station, in the order of STATE_KEYS
+RECORDED = ('h_out', 'I', 'A', 'mu', 'Q', 'P', 'dwell')
+
+
+class NumpySimulator:
+    # Built-in replacement of the Octave simulator with the interface of OctaveAdapter.
+    # All the parameter sets of a batch are simulated together: arrays are (batch, trains)
+    # for the trains and (batch, stations) for the stations.
+
+    def __init__(self, env, simulation_time=SIMULATION_TIME, warm_up_time=WARM_UP_TIME):
+        self.env = env
+        self.simulation_time = simulation_time
+        self.warm_up_time = warm_up_time
+        self.station_blocks = np.arange(NBR_STATIONS) * (NBR_BLOCKS / NBR_STATIONS)
+        # Busier stations in the center of the line
+        self.demand = DEMAND * (0.4 + 1.2 * np.sin(np.pi * (np.arange(NBR_STATIONS) + 0.5) / NBR_STATIONS))
+        self.params = None
+        self.state = None
+
+    def simulate_array(self, params):
+        # params: (batch, 4) in the order of PARAMETER_KEYS
+        # returns: (batch, 14) in the order of STATE_KEYS
+        params = np.atleast_2d(np.asarray(params, dtype=np.float64))
+        batch = params.shape[0]
+        nbr_trains = np.rint(params[:, 0]).astype(np.int64)
+        speed = params[:, 1] * TIME_STEP / self.env.BLOCK_LENGTH  # blocks per time step
+        max_dwell = params[:, 2]
+        platform_capacity = self.env.PLATFORM_CAPACITY * params[:, 3] / PLATFORM_REFERENCE_DENSITY
+        train_capacity = self.env.TRAIN_CAPACITY
+
+        trains = np.arange(nbr_trains.max())
+        active = trains[None, :] < nbr_trains[:, None]
+        # Trains evenly spaced, train t + 1 is in front of train t
+        position = np.where(active, trains[None, :] * NBR_BLOCKS / nbr_trains[:, None], 0.0)
+        ahead = (trains[None, :] + 1) % nbr_trains[:, None]
+        next_station = np.ceil(position / (NBR_BLOCKS / NBR_STATIONS) - 1e-9).astype(np.int64) % NBR_STATIONS
+        dwell_left = np.zeros(position.shape)
+        load = np.zeros(position.shape)
+
+        waiting = np.zeros((batch, NBR_STATIONS))
+        arrived = np.zeros((batch, NBR_STATIONS))
+        last_departure = np.full((batch, NBR_STATIONS), np.nan)
+
+        sums = np.zeros((len(RECORDED), batch))
+        squares = np.zeros((len(RECORDED), batch))
+        counts = np.zeros((len(RECORDED), batch))
+
+        for time in np.arange(0, self.simulation_time, TIME_STEP):
+            # Passengers arriving on the platforms
+            waiting += self.demand * TIME_STEP
+            arrived += self.demand * TIME_STEP
+
+            # Trains at a station leave when their dwell time is over
+            dwelling = dwell_left > 0
+            dwell_left = np.maximum(dwell_left - TIME_STEP, 0)
+            departing = dwelling & (dwell_left == 0)
+            next_station = np.where(departing, (next_station + 1) % NBR_STATIONS, next_station)
+
+            # Running trains move, limited by the train ahead and stopping at the next station
+            gap = np.take_along_axis(position, ahead, axis=1) - position
+            gap[gap <= 0] += NBR_BLOCKS  # also a single train, which is its own train ahead
+            to_station = self.station_blocks[next_station] - position
+            to_station[to_station < 0] += NBR_BLOCKS
+            running = active & ~dwelling
+            move = np.minimum(np.minimum(speed[:, None], gap - SAFETY_BLOCKS), to_station)
+            move = np.where(running, np.maximum(move, 0), 0)
+            position += move
+            position[position >= NBR_BLOCKS] -= NBR_BLOCKS
+            arriving = running & (move >= to_station - 1e-9)
+
+            # Passengers exchange of the trains arriving at a station
+            b, t = np.nonzero(arriving)
+            if len(b) == 0:
+                continue
+            s = next_station[b, t]
+            alighting = load[b, t] * ALIGHTING_RATE
+            on_board = load[b, t] - alighting
+            willing = np.minimum(waiting[b, s], platform_capacity[b])
+            boarding_limit = np.maximum((max_dwell[b] - MIN_DWELL) / BOARDING_TIME - alighting, 0)
+            boarding = np.minimum(np.minimum(willing, train_capacity - on_board), boarding_limit)
+            dwell = np.clip(MIN_DWELL + BOARDING_TIME * (boarding + alighting), MIN_DWELL, max_dwell[b])
+            waiting[b, s] -= boarding
+            load[b, t] = on_board + boarding
+            dwell_left[b, t] = dwell
+            departure = time + dwell
+            headway = departure - last_departure[b, s]
+            last_departure[b, s] = departure
+            inflow = arrived[b, s]
+            arrived[b, s] = 0
+
+            if time < self.warm_up_time:
+                continue
+            values = np.stack((headway, inflow, willing, boarding, waiting[b, s], load[b, t], dwell))
+            # No headway for the first departure from a station
+            known = ~np.isnan(values)
+            index = (np.arange(len(RECORDED))[:, None] * batch + b[None, :])[known]
+            values = values[known]
+            sums += np.bincount(index, weights=values, minlength=sums.size).reshape(sums.shape)
+            squares += np.bincount(index, weights=values ** 2, minlength=sums.size).reshape(sums.shape)
+            counts += np.bincount(index, minlength=sums.size).reshape(sums.shape)
+
+        counts = np.maximum(counts, 1)
+        means = sums / counts
+        stds = np.sqrt(np.maximum(squares / counts - means ** 2, 0))
+        out = np.empty((batch, len(STATE_KEYS)))
+        out[:, 0::2] = means.T
+        out[:, 1::2] = stds.T
+        return out
+
+    def simulate_many(self, list_of_params):
+        list_of_params = list(list_of_params)
+        if len(list_of_params) == 0:
+            return []
+        out = self.simulate_array(list_of_params)
+        return [dict(zip(STATE_KEYS, row.tolist())) for row in out]
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        return self.simulate_many([(nbr_trains, v_max, max_dwell, density_max_opt)])[0]
+
+    # OctaveAdapter interface #############
+    def write_to_octave(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        self.params = (nbr_trains, v_max, max_dwell, density_max_opt)
+
+    def run_octave(self):
+        self.state = self.simulate(*self.params)
+
+    def read_from_octave(self):
+        return dict(self.state)
+
+    def close(self):
+        pass
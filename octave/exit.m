@@ -0,0 +1,6 @@
+% Shadows the built-in exit while main.m runs inside the adapter's session or main_batch.m:
+% the script stops there, the interpreter stays alive for the next simulation.
+% builtin('exit') still quits.
+function exit(varargin)
+  error('octave_adapter:exit', 'main.m called exit');
+end
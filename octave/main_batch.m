@@ -0,0 +1,39 @@
+% Runs main.m once for every <parameters> block of io/python_to_octave_batch.xml
+% and collects the results of io/octave_to_python.xml, in the same order, into
+% io/octave_to_python_batch.xml.
+% Written as a function so that its variables survive the clear calls of main.m.
+function main_batch()
+  batch = fileread('io/python_to_octave_batch.xml');
+  blocks = regexp(batch, '<parameters>.*?</parameters>', 'match');
+
+  results = cell(1, numel(blocks));
+  for i = 1:numel(blocks)
+    parameters_file = fopen('io/python_to_octave.xml', 'w');
+    fprintf(parameters_file, '%s\n', blocks{i});
+    fclose(parameters_file);
+
+    % A failed simulation must not return the previous result
+    if exist('io/octave_to_python.xml', 'file')
+      delete('io/octave_to_python.xml');
+    end
+    try
+      evalin('base', 'main');
+    catch err
+      % exit / quit at the end of main.m (exit.m, quit.m)
+      if ~strcmp(err.identifier, 'octave_adapter:exit')
+        rethrow(err);
+      end
+    end
+
+    result = fileread('io/octave_to_python.xml');
+    results{i} = regexprep(result, '<\?xml[^>]*\?>', '');
+  end
+
+  results_file = fopen('io/octave_to_python_batch.xml', 'w');
+  fprintf(results_file, '<?xml version="1.0" encoding="UTF-8"?>\n<batch>\n');
+  for i = 1:numel(results)
+    fprintf(results_file, '%s\n', strtrim(results{i}));
+  end
+  fprintf(results_file, '</batch>\n');
+  fclose(results_file);
+end
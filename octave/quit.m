@@ -0,0 +1,4 @@
+% Same as exit.m, for main.m scripts ending with quit.
+function quit(varargin)
+  error('octave_adapter:exit', 'main.m called quit');
+end
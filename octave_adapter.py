@@ -1,17 +1,160 @@
 import xml.etree.cElementTree as ET
+import logging
 import subprocess
+import threading
+import queue
+import uuid
+import os
+
+from timing import timed
+
+logger = logging.getLogger(__name__)
+
 # OCTAVE_EXEC = 'C:/Program Files/GNU Octave/Octave-7.1.0/mingw64/bin/octave.bat' # Octave 7
 OCTAVE_EXEC = 'C:/Program Files/GNU Octave/Octave-6.3.0/mingw64/bin/octave.bat' # Octave 6
+# Octave scripts shipped with this project (main_batch.m), added to the Octave path
+OCTAVE_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'octave')
+
+# Order of the values exchanged with the simulator
+PARAMETER_KEYS = ('nbr_trains', 'v_max', 'max_dwell', 'density_max_opt')
+STATE_KEYS = ('h_out_mean', 'h_out_std', 'I_mean', 'I_std', 'A_mean', 'A_std', 'mu_mean', 'mu_std',
+              'Q_mean', 'Q_std', 'P_mean', 'P_std', 'dwell_mean', 'dwell_std')
+
+# Keep one Octave interpreter alive and send it a command per step instead of
+# launching "octave --persist main.m" for every simulation.
+# exit / quit called by main.m are shadowed by octave/exit.m and octave/quit.m, they only stop the script.
+OCTAVE_SESSION = True
+EXIT_ERROR_ID = 'octave_adapter:exit'
+SESSION_TIMEOUT = 600  # s, max time for a single command (one simulation)
+SESSION_MAX_RESTARTS = 3
+
+
+class OctaveSessionError(RuntimeError):
+    pass
+
+
+class OctaveSession:
+
+    def __init__(self, octave_command, cwd, timeout=SESSION_TIMEOUT):
+        self.octave_command = octave_command
+        self.cwd = cwd
+        self.timeout = timeout
+        self.process = None
+        self.output = None
+        self.restarts = 0
+        self.token = uuid.uuid4().hex
+
+    def start(self):
+        logger.debug("Starting Octave session")
+        self.process = subprocess.Popen(self.octave_command + ['--no-gui', '--quiet', '--interactive'],
+                                        cwd=self.cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        self.output = queue.Queue()
+        reader = threading.Thread(target=self._read_output, args=(self.process.stdout, self.output), daemon=True)
+        reader.start()
+        # No prompt and no pager, so that the output only contains what we print
+        self._send("PS1(''); PS2(''); more off; addpath('" + OCTAVE_SCRIPTS.replace('\\', '/') + "');")
+        if not self.health_check():
+            raise OctaveSessionError("Octave session did not answer the health check")
+        logger.debug("Started Octave session")
+
+    def _read_output(self, stdout, output):
+        for line in iter(stdout.readline, ''):
+            output.put(line.rstrip('\r\n'))
+        output.put(None)
+
+    def _send(self, command):
+        try:
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise OctaveSessionError("Octave session is not reachable") from e
+
+    def _wait_for(self, marker):
+        lines = []
+        while True:
+            try:
+                line = self.output.get(timeout=self.timeout)
+            except queue.Empty:
+                # A stuck interpreter can not be recovered, kill it so that it gets restarted
+                self.process.kill()
+                raise OctaveSessionError("Octave session timed out after " + str(self.timeout) + " s")
+            if line is None:
+                # End of output: the interpreter is gone, make sure it is reaped
+                self.output.put(None)
+                self.process.wait()
+                raise OctaveSessionError("Octave session terminated unexpectedly")
+            if line.endswith(marker):
+                return lines
+            lines.append(line)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def health_check(self):
+        if not self.is_alive():
+            return False
+        marker = "ping_" + self.token
+        try:
+            self._send("disp('" + marker + "'); fflush(stdout);")
+            self._wait_for(marker)
+        except OctaveSessionError:
+            return False
+        return True
+
+    def restart(self):
+        logger.warning("Restarting Octave session")
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def ensure_started(self):
+        if not self.is_alive():
+            if self.process is None:
+                self.start()
+            else:
+                self.restart()
+
+    def execute(self, command):
+        self.ensure_started()
+        done_marker = "done_" + self.token
+        error_marker = "error_" + self.token
+        self._send("try, " + command + "; catch err, if ~strcmp(err.identifier, '" + EXIT_ERROR_ID + "'), "
+                   "disp(['" + error_marker + "' err.message]); end; end; disp('" + done_marker + "'); fflush(stdout);")
+        lines = self._wait_for(done_marker)
+        for line in lines:
+            if error_marker in line:
+                raise OctaveSessionError("Octave error: " + line.split(error_marker, 1)[1])
+        return lines
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                # exit itself is shadowed (octave/exit.m)
+                self._send("builtin('exit')")
+                self.process.wait(timeout=10)
+            except (OctaveSessionError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        self.process = None
 
 
 class OctaveAdapter:
 
-    def __init__(self, file_context):
+    def __init__(self, file_context, session=OCTAVE_SESSION, octave_exec=OCTAVE_EXEC):
         self.file_context = file_context
+        # octave_exec can also be a command list, e.g. stub_simulator.STUB_COMMAND
+        if isinstance(octave_exec, (list, tuple)):
+            self.octave_command = list(octave_exec)
+        else:
+            self.octave_command = [octave_exec]
+        self.session = None
+        if session:
+            self.session = OctaveSession(self.octave_command, file_context)
 
-    def write_to_octave(self, nbr_trains, v_max, max_dwell, density_max_opt):
-        # write to: python_to_octave.xml ########
-        print("------> Starting creating python_to_octave file")
+    def create_parameters_element(self, nbr_trains, v_max, max_dwell, density_max_opt):
         parameters_element = ET.Element("parameters")
         parameters_element.text = "\n\t"
 
@@ -30,40 +173,124 @@ class OctaveAdapter:
         density_max_opt_element = ET.SubElement(parameters_element, "density_max_opt")
         density_max_opt_element.text = str(density_max_opt)
         density_max_opt_element.tail = "\n"
+        return parameters_element
 
+    @timed('octave.write')
+    def write_to_octave(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        # write to: python_to_octave.xml ########
+        logger.debug("Starting creating python_to_octave file")
+        parameters_element = self.create_parameters_element(nbr_trains, v_max, max_dwell, density_max_opt)
         python_to_octave = ET.ElementTree(parameters_element)
         python_to_octave.write(self.file_context + "/io/python_to_octave.xml")
-        print("<------ Terminated creating python_to_octave file")
+        logger.debug("Terminated creating python_to_octave file")
+
+    @timed('octave.write_batch')
+    def write_batch_to_octave(self, list_of_params):
+        # write to: python_to_octave_batch.xml ##
+        # One <parameters> block per simulation, each one in the format of python_to_octave.xml
+        logger.debug("Starting creating python_to_octave_batch file")
+        batch_element = ET.Element("batch")
+        batch_element.text = "\n"
+        for params in list_of_params:
+            parameters_element = self.create_parameters_element(*params)
+            parameters_element.tail = "\n"
+            batch_element.append(parameters_element)
+        python_to_octave = ET.ElementTree(batch_element)
+        python_to_octave.write(self.file_context + "/io/python_to_octave_batch.xml")
+        logger.debug("Terminated creating python_to_octave_batch file")
 
 
+    def remove_output(self, name):
+        # A failed run must not leave the result of the previous one to be read
+        try:
+            os.remove(os.path.join(self.file_context, 'io', name))
+        except FileNotFoundError:
+            pass
+
+    @timed('octave.run')
     def run_octave(self):
-        print("------> Starting Octave code")
-        process = subprocess.Popen([OCTAVE_EXEC, '--persist', 'main.m'], cwd=self.file_context)
-        stdout, stderr = process.communicate()
-        process.wait()
-        print("<------ Terminated Octave code")
+        logger.debug("Starting Octave code")
+        self.remove_output('octave_to_python.xml')
+        if self.session is None:
+            process = subprocess.Popen(self.octave_command + ['--persist', 'main.m'], cwd=self.file_context)
+            stdout, stderr = process.communicate()
+            process.wait()
+        else:
+            self.run_in_session('main')
+        logger.debug("Terminated Octave code")
+
+    @timed('octave.run_batch')
+    def run_octave_batch(self):
+        # main_batch.m runs main.m once per <parameters> block inside a single interpreter
+        logger.debug("Starting Octave batch code")
+        self.remove_output('octave_to_python_batch.xml')
+        if self.session is None:
+            process = subprocess.Popen(self.octave_command + ['--no-gui', '--path', OCTAVE_SCRIPTS, '--eval', 'main_batch'],
+                                       cwd=self.file_context)
+            stdout, stderr = process.communicate()
+            process.wait()
+        else:
+            self.run_in_session('main_batch')
+        logger.debug("Terminated Octave batch code")
+
+    def run_in_session(self, command):
+        # main.m and the functions it calls are parsed on the first call and then stay
+        # loaded in the interpreter, the following calls only pay for the simulation itself
+        attempts = 0
+        while True:
+            try:
+                return self.session.execute(command)
+            except OctaveSessionError:
+                # Errors raised by main.m itself are not retried, only a dead or stuck interpreter is
+                if self.session.is_alive() and self.session.health_check():
+                    raise
+                attempts += 1
+                if attempts > SESSION_MAX_RESTARTS:
+                    raise
+                self.session.restart()
+
+    def close(self):
+        if self.session is not None:
+            self.session.stop()
 
 
+    def parse_state(self, element):
+        return {key: float(element.find(key).text) for key in STATE_KEYS}
+
+    @timed('octave.read')
     def read_from_octave(self):
         # read from: octave_to_python.xml #######
-        print("------> Starting reading octave_to_python file")
+        logger.debug("Starting reading octave_to_python file")
         octave_to_python = ET.parse(self.file_context + '/io/octave_to_python.xml')
-        octave_to_python_params = octave_to_python.getroot()
-        out = {
-            'h_out_mean': float(octave_to_python_params.find('h_out_mean').text),
-            'h_out_std': float(octave_to_python_params.find('h_out_std').text),
-            'I_mean': float(octave_to_python_params.find('I_mean').text),
-            'I_std': float(octave_to_python_params.find('I_std').text),
-            'A_mean': float(octave_to_python_params.find('A_mean').text),
-            'A_std': float(octave_to_python_params.find('A_std').text),
-            'mu_mean': float(octave_to_python_params.find('mu_mean').text),
-            'mu_std': float(octave_to_python_params.find('mu_std').text),
-            'Q_mean': float(octave_to_python_params.find('Q_mean').text),
-            'Q_std': float(octave_to_python_params.find('Q_std').text),
-            'P_mean': float(octave_to_python_params.find('P_mean').text),
-            'P_std': float(octave_to_python_params.find('P_std').text),
-            'dwell_mean': float(octave_to_python_params.find('dwell_mean').text),
-            'dwell_std': float(octave_to_python_params.find('dwell_std').text)
-        }
-        print("<------ Terminated reading octave_to_python file")
-        return out
\ No newline at end of file
+        out = self.parse_state(octave_to_python.getroot())
+        logger.debug("Terminated reading octave_to_python file")
+        return out
+
+    @timed('octave.read_batch')
+    def read_batch_from_octave(self):
+        # read from: octave_to_python_batch.xml #
+        # One <parameters> block per simulation, in the order of python_to_octave_batch.xml
+        logger.debug("Starting reading octave_to_python_batch file")
+        octave_to_python = ET.parse(self.file_context + '/io/octave_to_python_batch.xml')
+        out = [self.parse_state(element) for element in octave_to_python.getroot().findall('parameters')]
+        logger.debug("Terminated reading octave_to_python_batch file")
+        return out
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        self.write_to_octave(nbr_trains, v_max, max_dwell, density_max_opt)
+        self.run_octave()
+        return self.read_from_octave()
+
+    def simulate_many(self, list_of_params):
+        # list_of_params: (nbr_trains, v_max, max_dwell, density_max_opt) tuples
+        # returns one state (same format as read_from_octave) per tuple, in the same order
+        list_of_params = list(list_of_params)
+        if len(list_of_params) == 0:
+            return []
+        self.write_batch_to_octave(list_of_params)
+        self.run_octave_batch()
+        out = self.read_batch_from_octave()
+        if len(out) != len(list_of_params):
+            raise RuntimeError("Octave batch returned " + str(len(out)) + " results for "
+                               + str(len(list_of_params)) + " parameter sets")
+        return out
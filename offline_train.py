@@ -0,0 +1,76 @@
+import argparse
+import logging
+
+import custom_env
+from dqn import DQN
+from logs import setup_logging
+from replay_buffer import ReplayBuffer
+from transition_dataset import read_transitions, transition_arrays
+
+#######################################
+# Offline training ####################
+#######################################
+# python offline_train.py transitions_octave --alpha-headway 12 --updates 20000
+# Trains a new DQN only from the transitions saved by train.py (TRANSITIONS_FOLDER, or one run file), the rewards
+# are recomputed from the saved states with the given weights: no simulation at all.
+OFFLINE_UPDATES = 10000  # minibatch updates (replay + target_train)
+OFFLINE_BATCH_SIZE = 64
+OFFLINE_MODEL = 'model_offline'
+LOG_EVERY = 1000  # updates
+#######################################
+
+logger = logging.getLogger('offline_train')
+
+
+def compute_rewards(env, next_states, alpha_comfort=None, alpha_headway=None, alpha_waiting=None):
+    # Rewards of VectorCustomEnv.calculate_rewards, with other weights than the ALPHA_* of the environment
+    env = custom_env.VectorCustomEnv(0) if env is None else env
+    if alpha_comfort is not None:
+        env.ALPHA_COMFORT = alpha_comfort
+    if alpha_headway is not None:
+        env.ALPHA_HEADWAY = alpha_headway
+    if alpha_waiting is not None:
+        env.ALPHA_WAITING = alpha_waiting
+    return env.calculate_rewards(next_states)
+
+
+def train_offline(dataset_fn, updates=OFFLINE_UPDATES, batch_size=OFFLINE_BATCH_SIZE, model_fn=OFFLINE_MODEL,
+                  alpha_comfort=None, alpha_headway=None, alpha_waiting=None):
+    records = read_transitions(dataset_fn)
+    if len(records) == 0:
+        raise ValueError(dataset_fn + " holds no transition")
+    logger.info("Started offline training from %d transitions", len(records))
+    env = custom_env.VectorCustomEnv(len(records))
+    states, actions, next_states, dones = transition_arrays(records, env.INPUT_SHAPE)
+    rewards = compute_rewards(env, next_states, alpha_comfort, alpha_headway, alpha_waiting)
+    logger.info("Rewards: mean %.4f, min %.4f, max %.4f (alphas %s, %s, %s)", rewards.mean(), rewards.min(), rewards.max(),
+                env.ALPHA_COMFORT, env.ALPHA_HEADWAY, env.ALPHA_WAITING)
+
+    dqn_agent = DQN(env=env)
+    dqn_agent.batch_size = batch_size
+    # The whole dataset is the replay memory
+    dqn_agent.memory = ReplayBuffer(len(records), env.INPUT_SHAPE)
+    dqn_agent.remember(states, actions, rewards, next_states, dones)
+    for update in range(updates):
+        dqn_agent.replay()
+        dqn_agent.target_train()
+        if (update + 1) % LOG_EVERY == 0:
+            logger.info("Update %d / %d", update + 1, updates)
+    dqn_agent.save_model(model_fn)
+    logger.info("Ended offline training, model saved as %s", model_fn)
+    return dqn_agent
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a DQN from saved transitions with new reward weights")
+    parser.add_argument('dataset', help="transition file, or folder of them (TRANSITIONS_FOLDER of train.py)")
+    parser.add_argument('--updates', type=int, default=OFFLINE_UPDATES)
+    parser.add_argument('--batch-size', type=int, default=OFFLINE_BATCH_SIZE)
+    parser.add_argument('--model', default=OFFLINE_MODEL)
+    parser.add_argument('--alpha-comfort', type=float)
+    parser.add_argument('--alpha-headway', type=float)
+    parser.add_argument('--alpha-waiting', type=float)
+    args = parser.parse_args()
+    setup_logging()
+    train_offline(args.dataset, args.updates, args.batch_size, args.model,
+                  args.alpha_comfort, args.alpha_headway, args.alpha_waiting)
@@ -1,156 +1,207 @@
+import logging
+import argparse
+import csv
+import itertools
 import numpy as np
-import matplotlib.pyplot as plt
 import custom_env
-from dqn import DQN
-from octave_adapter import OctaveAdapter
+from numpy_policy import NumpyPolicy
+from octave_adapter import OctaveAdapter, PARAMETER_KEYS
+from numpy_simulator import NumpySimulator
+from simulator_pool import SimulatorPool
+from run_recorder import RunRecorder
+from plotting import Plotter
+from logs import setup_logging, log_step, log_episode
 from datetime import datetime
 import os
 
 FILES_CONTEXT = "D:/E/Master/Stage/customized code"
-FIGURE_COUNTER = 0
-RUNNING_TIME = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-TMP_FOLDER_NAME = "play_" + RUNNING_TIME
-tmp_folder_exists = os.path.exists(TMP_FOLDER_NAME)
-if not tmp_folder_exists:
-    os.makedirs(TMP_FOLDER_NAME)
-TMP_FOLDER = TMP_FOLDER_NAME + "/"
-print("All plots will be stored in folder", TMP_FOLDER_NAME)
-print("###########################################################################")
+MODEL = 'model'
+# Greedy actions from MODEL + '.npz' (written by DQN.save_model) computed with NumPy,
+# TensorFlow is only imported when this is False
+USE_NUMPY_POLICY = True
+# Files of a run, in its folder play_<running time>
+RUN_RECORD_NAME = "run_record.bin"
+# Batch evaluation (python play.py --grid 3 or --scenarios scenarios.csv): greedy rollouts of all
+# the scenarios stepped together, the simulations of a step run in parallel
+# "octave": SimulatorPool of main.m in FILES_CONTEXT, "numpy": numpy_simulator.py
+EVALUATION_BACKEND = "octave"
+EVALUATION_WORKERS = os.cpu_count()
+EVALUATION_RESULTS_NAME = "evaluation.csv"
+logger = logging.getLogger('play')
+
+def create_tmp_folder():
+    # Not at import: the plotter process imports this module again with the spawn start method (Windows)
+    running_time = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    tmp_folder_name = "play_" + running_time
+    if not os.path.exists(tmp_folder_name):
+        os.makedirs(tmp_folder_name)
+    return tmp_folder_name + "/"
 
 def play():
-    print("--> Started playing function")
+    tmp_folder = create_tmp_folder()
+    run_record_file = tmp_folder + RUN_RECORD_NAME
+    logger.info("Started playing, plots and records in folder %s", tmp_folder)
     env = custom_env.CustomEnv()
     episodes = 1
     print("----> Input starting state:")
     steps = int(input("------> Please enter number of steps:\n"))
-    dqn_agent = DQN(env=env)
-    dqn_agent.load_model('model')
-    dqn_agent.epsilon = 0
-    dqn_agent.epsilon_min = 0
-
-    statistics_shape = (episodes, steps + 1)
-    statistics_nbr_trains = np.zeros(statistics_shape)
-    statistics_v_max = np.zeros(statistics_shape)
-    statistics_max_dwell = np.zeros(statistics_shape)
-    statistics_density_max_opt = np.zeros(statistics_shape)
-    statistics_h_out_mean = np.zeros(statistics_shape)
-    statistics_I_mean = np.zeros(statistics_shape)
-    statistics_A_mean = np.zeros(statistics_shape)
-    statistics_mu_mean = np.zeros(statistics_shape)
-    statistics_Q_mean = np.zeros(statistics_shape)
-    statistics_P_mean = np.zeros(statistics_shape)
-    statistics_dwell_mean = np.zeros(statistics_shape)
+    recorder = RunRecorder(run_record_file)
+    plotter = Plotter(tmp_folder, run_record_file, episodes, steps)
+    if USE_NUMPY_POLICY:
+        policy = NumpyPolicy.load(MODEL + '.npz')
+        dqn_agent = None
+    else:
+        from dqn import DQN
+        dqn_agent = DQN(env=env)
+        dqn_agent.load_model(MODEL)
+        dqn_agent.epsilon = 0
+        dqn_agent.epsilon_min = 0
 
     octave_adapter = OctaveAdapter(FILES_CONTEXT)
-
-    nbr_trains = int(input(f'------> Please enter number of trains between ({env.MIN_NBR_TRAINS}, {env.MAX_NBR_TRAINS}):\n'))
-    if nbr_trains < env.MIN_NBR_TRAINS or nbr_trains > env.MAX_NBR_TRAINS:
-        raise ValueError('Number of trains value is not acceptable.')
-    v_max = float(input(f'------> Please enter maximum speed between ({env.MIN_V_MAX}, {env.MAX_V_MAX}):\n'))
-    if v_max < env.MIN_V_MAX or v_max > env.MAX_V_MAX:
-        raise ValueError('Max speed value is not acceptable.')
-    max_dwell = float(input(f'------> Please enter max dwell time between ({env.MIN_MAX_DWELL}, {env.MAX_MAX_DWELL}):\n'))
-    if max_dwell < env.MIN_MAX_DWELL or max_dwell > env.MAX_MAX_DWELL:
-        raise ValueError('Max dwell value is not acceptable.')
-    density_max_opt = float(input(f'------> Please enter maximum optimal density time between ({env.MIN_DENSITY_MAX_OPT}, {env.MAX_DENSITY_MAX_OPT}):\n'))
-    if density_max_opt < env.MIN_DENSITY_MAX_OPT or density_max_opt > env.MAX_DENSITY_MAX_OPT:
-        raise ValueError('Maximum optimal density value is not acceptable.')
-
-    print(f'<---- Input starting state:\n'
-          f'      nbr_trains = {nbr_trains}\n'
-          f'      v_max = {v_max}\n'
-          f'      max_dwell = {max_dwell}\n'
-          f'      density_max_opt = {density_max_opt}')
-
-    octave_adapter.write_to_octave(nbr_trains, v_max, max_dwell, density_max_opt)
-    octave_adapter.run_octave()
-    current_state = octave_adapter.read_from_octave()
-
-    episode = 0
-
-    # Statistics arrays
-    update_statistics(episode, 0, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                      statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                      statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                      statistics_dwell_mean, nbr_trains, v_max, max_dwell, density_max_opt, current_state)
-
+    try:
+        nbr_trains = int(input(f'------> Please enter number of trains between ({env.MIN_NBR_TRAINS}, {env.MAX_NBR_TRAINS}):\n'))
+        if nbr_trains < env.MIN_NBR_TRAINS or nbr_trains > env.MAX_NBR_TRAINS:
+            raise ValueError('Number of trains value is not acceptable.')
+        v_max = float(input(f'------> Please enter maximum speed between ({env.MIN_V_MAX}, {env.MAX_V_MAX}):\n'))
+        if v_max < env.MIN_V_MAX or v_max > env.MAX_V_MAX:
+            raise ValueError('Max speed value is not acceptable.')
+        max_dwell = float(input(f'------> Please enter max dwell time between ({env.MIN_MAX_DWELL}, {env.MAX_MAX_DWELL}):\n'))
+        if max_dwell < env.MIN_MAX_DWELL or max_dwell > env.MAX_MAX_DWELL:
+            raise ValueError('Max dwell value is not acceptable.')
+        density_max_opt = float(input(f'------> Please enter maximum optimal density time between ({env.MIN_DENSITY_MAX_OPT}, {env.MAX_DENSITY_MAX_OPT}):\n'))
+        if density_max_opt < env.MIN_DENSITY_MAX_OPT or density_max_opt > env.MAX_DENSITY_MAX_OPT:
+            raise ValueError('Maximum optimal density value is not acceptable.')
+
+        print(f'<---- Input starting state:\n'
+              f'      nbr_trains = {nbr_trains}\n'
+              f'      v_max = {v_max}\n'
+              f'      max_dwell = {max_dwell}\n'
+              f'      density_max_opt = {density_max_opt}')
+
+        octave_adapter.write_to_octave(nbr_trains, v_max, max_dwell, density_max_opt)
+        octave_adapter.run_octave()
+        current_state = octave_adapter.read_from_octave()
+
+        episode = 0
+
+        recorder.record(episode, 0, nbr_trains, v_max, max_dwell, density_max_opt, current_state)
+        total_reward = 0.0
+
+        for step in range(steps):
+            if dqn_agent is None:
+                action = policy.action(env.convert_to_dqn_array(current_state))
+                logger.debug("Taking action: %d => %s", action, env.MAPPING[env.ACTIONS[action]])
+            else:
+                action = dqn_agent.action(env.convert_to_dqn_array(current_state))
+
+            new_state, new_params, reward, done, done_reason = env.step(octave_adapter, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action)
+            if dqn_agent is not None:
+                dqn_agent.remember(env.convert_to_dqn_array(current_state), action,
+                                   reward, env.convert_to_dqn_array(new_state), done)
+                if dqn_agent.replay():  # internally iterates default (prediction) model
+                    dqn_agent.target_train()  # iterates target model
+
+            current_state = new_state
+            nbr_trains = new_params['nbr_trains']
+            v_max = new_params['v_max']
+            max_dwell = new_params['max_dwell']
+            density_max_opt = new_params['density_max_opt']
+
+            recorder.record(episode, step + 1, nbr_trains, v_max, max_dwell, density_max_opt, current_state,
+                            action, reward, dqn_agent.epsilon if dqn_agent is not None else 0)
+            log_step(logger, episode, step + 1, action, reward, dqn_agent.epsilon if dqn_agent is not None else 0,
+                     new_params, current_state)
+            total_reward += reward
+        log_episode(logger, episode, steps, total_reward, dqn_agent.epsilon if dqn_agent is not None else 0,
+                    {'nbr_trains': nbr_trains, 'v_max': v_max, 'max_dwell': max_dwell, 'density_max_opt': density_max_opt},
+                    current_state)
+    finally:
+        octave_adapter.close()
+
+    recorder.close()
+    plotter.plot_episode(episode)
+    plotter.close()
+
+    logger.info("Ended playing")
+
+def read_scenarios(fn):
+    # CSV file with a nbr_trains, v_max, max_dwell, density_max_opt header, one scenario per row
+    with open(fn, newline='') as f:
+        return [(int(float(row['nbr_trains'])), float(row['v_max']), float(row['max_dwell']), float(row['density_max_opt']))
+                for row in csv.DictReader(f)]
+
+def scenario_grid(env, points):
+    # points values of each parameter from MIN to MAX (on the control lattice) ==> points ** 4 scenarios
+    values = [np.linspace(env.MIN_NBR_TRAINS, env.MAX_NBR_TRAINS, points),
+              np.linspace(env.MIN_V_MAX, env.MAX_V_MAX, points),
+              np.linspace(env.MIN_MAX_DWELL, env.MAX_MAX_DWELL, points),
+              np.linspace(env.MIN_DENSITY_MAX_OPT, env.MAX_DENSITY_MAX_OPT, points)]
+    return [env.snap_to_lattice(*params) for params in itertools.product(*values)]
+
+def evaluate(policy, scenarios, steps, simulator):
+    # Greedy actions only, nothing is learned. Returns one summary per scenario.
+    env = custom_env.VectorCustomEnv(len(scenarios))
+    states = env.reset(simulator, scenarios)
+    rewards = np.zeros((len(scenarios), steps))
     for step in range(steps):
-        print("----> Starting step #", step, "################################################")
-        action = dqn_agent.action(env.convert_to_dqn_array(current_state))
-
-        new_state, new_params, reward, done, done_reason = env.step(octave_adapter, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action)
-        dqn_agent.remember(env.convert_to_dqn_array(current_state), action,
-                           reward, env.convert_to_dqn_array(new_state), done)
-        if dqn_agent.replay():  # internally iterates default (prediction) model
-            dqn_agent.target_train()  # iterates target model
-
-        current_state = new_state
-        nbr_trains = new_params['nbr_trains']
-        v_max = new_params['v_max']
-        max_dwell = new_params['max_dwell']
-        density_max_opt = new_params['density_max_opt']
-
-        update_statistics(episode, step + 1, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                      statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                      statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                      statistics_dwell_mean, nbr_trains, v_max, max_dwell, density_max_opt, current_state)
-        print("<---- Ending step #", step)
-
-    plot_episode_statistics(episode, steps, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                            statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                            statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                            statistics_dwell_mean)
-
-    print("<-- Ended playing function")
-
-def update_statistics(episode, column, statistics_nbr_trains, statistics_v_max, statistics_max_dwell, statistics_density_max_opt,
-                      statistics_h_out_mean, statistics_I_mean, statistics_A_mean, statistics_mu_mean, statistics_Q_mean,
-                      statistics_P_mean, statistics_dwell_mean,
-                      nbr_trains, v_max, max_dwell, density_max_opt, current_state):
-    statistics_nbr_trains[episode, column] = nbr_trains
-    statistics_v_max[episode, column] = v_max
-    statistics_max_dwell[episode, column] = max_dwell
-    statistics_density_max_opt[episode, column] = density_max_opt
-    statistics_h_out_mean[episode, column] = current_state['h_out_mean']
-    statistics_I_mean[episode, column] = current_state['I_mean']
-    statistics_A_mean[episode, column] = current_state['A_mean']
-    statistics_mu_mean[episode, column] = current_state['mu_mean']
-    statistics_Q_mean[episode, column] = current_state['Q_mean']
-    statistics_P_mean[episode, column] = current_state['P_mean']
-    statistics_dwell_mean[episode, column] = current_state['dwell_mean']
-
-def plot_episode_statistics(episode, steps, statistics_nbr_trains, statistics_v_max,
-                            statistics_max_dwell, statistics_density_max_opt, statistics_h_out_mean,
-                            statistics_I_mean, statistics_A_mean, statistics_mu_mean, statistics_Q_mean,
-                            statistics_P_mean, statistics_dwell_mean):
-    single_plot_2D(episode, steps, get_figure_id(), statistics_nbr_trains, "NBR trains", 'NBR trains Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_v_max, "V Max", 'V Max Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_max_dwell, "Max dwell", 'Max dwell Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_density_max_opt, "Density max Opt", 'Density max Opt Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_h_out_mean, "H_out mean", 'Headway mean Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_I_mean, "I_mean", 'Nbr of pass. in st. Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_A_mean, "A_mean", 'Flow of pass. willing to enter Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_mu_mean, "mu_mean", 'Flow of pass. bearding on Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_Q_mean, "Q_mean", 'Nbr of pass. waiting Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_P_mean, "P_mean", 'Nbr of pass. on the train Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_dwell_mean, "dwell_mean", 'Dwell time (s) Statistics')
-
-def single_plot_2D(episode, steps, figure, statistics_array, label, title):
-    x_axis = list(range(steps + 1))
-    fig = plt.figure(figure)
-    plt.plot(x_axis, statistics_array[episode, :].T, label=label)
-    plt.xlabel('Steps')
-    plt.ylabel(label)
-    plt.title(str(episode) + ': ' + title)
-    plt.legend()
-    fig.savefig(TMP_FOLDER + str(figure) + "_" + label + ".png")
-    plt.show()
-
-def get_figure_id():
-    global FIGURE_COUNTER
-    figure_id = FIGURE_COUNTER
-    FIGURE_COUNTER = FIGURE_COUNTER + 1
-    return figure_id
+        actions = policy.actions(states)
+        states, params, rewards[:, step], dones, done_reason = env.step(simulator, actions)
+        logger.info("Evaluation step %d / %d: mean reward %.4f", step + 1, steps, rewards[:, step].mean())
+    final_params = [env.snap_to_lattice(*params) for params in env.simulator_params(env.params).tolist()]
+    summaries = []
+    for i, scenario in enumerate(scenarios):
+        summary = {'scenario': i}
+        summary.update({key: value for key, value in zip(PARAMETER_KEYS, scenario)})
+        summary.update({'final_' + key: value for key, value in zip(PARAMETER_KEYS, final_params[i])})
+        summary.update({
+            'mean_reward': rewards[i].mean() if steps > 0 else 0.0,
+            'total_reward': rewards[i].sum(),
+            'final_h_out_mean': states[i, 0, 0],
+            'final_Q_mean': states[i, 4, 0],
+            'final_P_mean': states[i, 5, 0]
+        })
+        summaries.append(summary)
+    return summaries
+
+def write_results(fn, summaries):
+    with open(fn, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(summaries[0].keys()))
+        writer.writeheader()
+        writer.writerows(summaries)
+
+def create_evaluation_simulator(env, workers):
+    if EVALUATION_BACKEND == "numpy":
+        return NumpySimulator(env)
+    return SimulatorPool(FILES_CONTEXT, workers=workers)
+
+def play_scenarios(scenarios, steps, workers=EVALUATION_WORKERS, results_fn=None):
+    # results_fn: EVALUATION_RESULTS_NAME in a new run folder if not given
+    if len(scenarios) == 0:
+        raise ValueError("No scenario to evaluate (empty scenarios file or --grid 0)")
+    results_fn = results_fn if results_fn is not None else create_tmp_folder() + EVALUATION_RESULTS_NAME
+    logger.info("Started evaluating %d scenarios, %d steps", len(scenarios), steps)
+    policy = NumpyPolicy.load(MODEL + '.npz')
+    simulator = create_evaluation_simulator(custom_env.CustomEnv(), workers)
+    try:
+        summaries = evaluate(policy, scenarios, steps, simulator)
+    finally:
+        simulator.close()
+    write_results(results_fn, summaries)
+    logger.info("Ended evaluating, results in %s", results_fn)
+    return summaries
 
 if __name__ == "__main__":
-    play()
+    parser = argparse.ArgumentParser(description="Interactive play, or batch evaluation with --scenarios / --grid")
+    parser.add_argument('--scenarios', help="CSV file of starting states (nbr_trains, v_max, max_dwell, density_max_opt)")
+    parser.add_argument('--grid', type=int, help="evaluate a grid of GRID values per parameter")
+    parser.add_argument('--steps', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=EVALUATION_WORKERS)
+    parser.add_argument('--output', help="results CSV file, " + EVALUATION_RESULTS_NAME + " in the run folder if not given")
+    args = parser.parse_args()
+    setup_logging()
+    if args.scenarios is None and args.grid is None:
+        play()
+    else:
+        env = custom_env.CustomEnv()
+        scenarios = read_scenarios(args.scenarios) if args.scenarios is not None else scenario_grid(env, args.grid)
+        play_scenarios(scenarios, args.steps if args.steps is not None else env.MAX_STEPS, args.workers, args.output)
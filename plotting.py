@@ -0,0 +1,171 @@
+import logging
+import multiprocessing
+import queue
+
+import numpy as np
+
+from logs import setup_process_logging
+from run_recorder import load_statistics
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Plots of the recorded runs ##########
+#######################################
+# headless: the figures are rendered (Agg backend, no window) by a worker process reading the
+# record file, training never waits for them. Otherwise they are shown as they are made.
+PLOT_HEADLESS = True
+PLOT_EPISODE_EVERY = 1  # episodes between two per-episode plots, 0: only the plots of the full run
+#######################################
+
+# Recorded field, label, title
+STATISTICS_PLOTS = [
+    ('nbr_trains', "NBR trains", 'NBR trains Statistics'),
+    ('v_max', "V Max", 'V Max Statistics'),
+    ('max_dwell', "Max dwell", 'Max dwell Statistics'),
+    ('density_max_opt', "Density max Opt", 'Density max Opt Statistics'),
+    ('h_out_mean', "H_out mean", 'Headway mean Statistics'),
+    ('I_mean', "I_mean", 'Nbr of pass. in st. Statistics'),
+    ('A_mean', "A_mean", 'Flow of pass. willing to enter Statistics'),
+    ('mu_mean', "mu_mean", 'Flow of pass. bearding on Statistics'),
+    ('Q_mean', "Q_mean", 'Nbr of pass. waiting Statistics'),
+    ('P_mean', "P_mean", 'Nbr of pass. on the train Statistics'),
+    ('dwell_mean', "dwell_mean", 'Dwell time (s) Statistics')
+]
+
+
+def pyplot(headless):
+    import matplotlib
+    if headless:
+        matplotlib.use('Agg', force=True)
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_episode_statistics(plt, folder, episode, steps, statistics, show=False):
+    for field, label, title in STATISTICS_PLOTS:
+        single_plot_2D(plt, folder, episode, steps, statistics[field], label, title, show)
+
+
+def plot_full_statistics(plt, folder, episodes, steps, statistics, show=False):
+    for field, label, title in STATISTICS_PLOTS:
+        single_plot_3D(plt, folder, episodes, steps, statistics[field], label, title, show)
+
+
+def single_plot_2D(plt, folder, episode, steps, statistics_array, label, title, show=False):
+    x_axis = list(range(steps + 1))
+    fig = plt.figure()
+    plt.plot(x_axis, statistics_array[episode, :].T, label=label)
+    plt.xlabel('Steps')
+    plt.ylabel(label)
+    plt.title(str(episode) + ': ' + title)
+    plt.legend()
+    fig.savefig(folder + "episode_" + str(episode) + "_" + label + ".png")
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def single_plot_3D(plt, folder, episodes, steps, statistics_array, label, title, show=False):
+    from matplotlib import cm
+    x_axis = range(episodes)
+    y_axis = range(steps + 1)
+    X, Y = np.meshgrid(x_axis, y_axis)
+    fig = plt.figure()
+    ax = plt.axes(projection='3d')
+    surf = ax.plot_surface(X.T, Y.T, statistics_array, rstride=1, cstride=1,
+                cmap=cm.coolwarm, edgecolor='none')
+    plt.xlabel('Episodes')
+    plt.ylabel('Steps')
+    plt.title(title)
+    fig.colorbar(surf, shrink=0.5, aspect=5)
+    fig.savefig(folder + "full_" + label + ".png")
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def render(jobs, folder, record_file, episodes, steps):
+    # Worker process: the jobs waiting together are rendered from one read of the record file.
+    # A failed job is logged and skipped, the next ones are still rendered
+    setup_process_logging()
+    plt = pyplot(headless=True)
+    running = True
+    while running:
+        batch = [jobs.get()]
+        try:
+            while True:
+                batch.append(jobs.get_nowait())
+        except queue.Empty:
+            pass
+        if None in batch:
+            running = False
+            batch = batch[:batch.index(None)]
+        if len(batch) == 0:
+            continue
+        try:
+            statistics = load_statistics(record_file, episodes, steps)
+        except Exception:
+            logger.exception("Plotter: cannot read %s, plots %s skipped", record_file, batch)
+            continue
+        for episode in batch:
+            try:
+                if episode == 'full':
+                    plot_full_statistics(plt, folder, episodes, steps, statistics)
+                else:
+                    plot_episode_statistics(plt, folder, episode, steps, statistics)
+            except Exception:
+                logger.exception("Plotter: plots of %s failed", "the full run" if episode == 'full' else "episode " + str(episode))
+
+
+class Plotter:
+    # Plots of a run recorded by a RunRecorder in record_file, the figures are saved in folder.
+    # The recorder must be flushed before asking for the plots of what it recorded.
+
+    def __init__(self, folder, record_file, episodes, steps, headless=PLOT_HEADLESS, episode_every=PLOT_EPISODE_EVERY):
+        self.folder = folder
+        self.record_file = record_file
+        self.episodes = episodes
+        self.steps = steps
+        self.headless = headless
+        self.episode_every = episode_every
+        self.worker = None
+        if headless:
+            # Started before the caller's simulator threads. With the spawn start method (Windows), the
+            # worker imports the caller's main module again: it must do nothing else at import
+            self.jobs = multiprocessing.Queue()
+            self.worker = multiprocessing.Process(target=render, name='plotter', daemon=True,
+                                                  args=(self.jobs, folder, record_file, episodes, steps))
+            self.worker.start()
+
+    def worker_alive(self):
+        # The worker can still die (killed, out of memory): no more jobs are sent to it then
+        if self.worker is not None and not self.worker.is_alive():
+            logger.error("Plotter process ended (exit code %s), no more plots", self.worker.exitcode)
+            self.worker = None
+        return self.worker is not None
+
+    def plot_episode(self, episode):
+        if self.episode_every <= 0 or (episode + 1) % self.episode_every != 0:
+            return
+        if self.headless:
+            if self.worker_alive():
+                self.jobs.put(episode)
+        else:
+            plot_episode_statistics(pyplot(headless=False), self.folder, episode, self.steps,
+                                    load_statistics(self.record_file, self.episodes, self.steps), show=True)
+
+    def plot_full(self):
+        if self.headless:
+            if self.worker_alive():
+                self.jobs.put('full')
+        else:
+            plot_full_statistics(pyplot(headless=False), self.folder, self.episodes, self.steps,
+                                 load_statistics(self.record_file, self.episodes, self.steps), show=True)
+
+    def close(self):
+        # Waits for the figures still being rendered
+        if self.worker_alive():
+            self.jobs.put(None)
+            self.worker.join()
+            self.worker = None
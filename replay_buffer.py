@@ -0,0 +1,215 @@
+import numpy as np
+
+
+class ReplayBuffer:
+    # Fixed capacity ring buffer of transitions, stored in preallocated float32 arrays.
+    # Once full, the oldest transitions are overwritten.
+
+    def __init__(self, capacity, state_shape):
+        self.capacity = capacity
+        self.state_shape = tuple(state_shape)
+        self.states = np.zeros((capacity,) + self.state_shape, dtype=np.float32)
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros((capacity,) + self.state_shape, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.float32)
+        self.position = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, state, action, reward, next_state, done):
+        i = self.position
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.dones[i] = done
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        count = len(actions)
+        indices = (self.position + np.arange(count)) % self.capacity
+        self.states[indices] = states
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        self.next_states[indices] = next_states
+        self.dones[indices] = dones
+        self.position = int((self.position + count) % self.capacity)
+        self.size = min(self.size + count, self.capacity)
+
+    def sample_indices(self, batch_size):
+        # Uniform sampling (with replacement) of batch_size transitions
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def get(self, indices):
+        return (self.states[indices], self.actions[indices], self.rewards[indices],
+                self.next_states[indices], self.dones[indices])
+
+    def sample(self, batch_size):
+        return self.get(self.sample_indices(batch_size))
+
+    def n_step(self, indices, n, gamma):
+        # n-step returns of the transitions at indices: the transitions stored after each one are followed
+        # while they continue its trajectory (next state of one == state of the next, not done, not overwritten).
+        # Interleaved trajectories (async actors, imagined transitions) end the return early, its bootstrap
+        # is then discounted by gamma^k of the k transitions followed.
+        # ==> returns, last next states, last dones, discounts of the bootstrap Q values
+        indices = np.asarray(indices)
+        returns = self.rewards[indices].astype(np.float64)
+        last = indices
+        discounts = np.full(len(indices), gamma)
+        running = self.dones[indices] == 0
+        for _ in range(n - 1):
+            following = (last + 1) % self.capacity
+            running &= following != self.position
+            running &= (self.next_states[last] == self.states[following]).reshape(len(indices), -1).all(axis=1)
+            if not running.any():
+                break
+            returns += np.where(running, discounts * self.rewards[following], 0)
+            discounts = np.where(running, discounts * gamma, discounts)
+            last = np.where(running, following, last)
+            running &= self.dones[last] == 0
+        return returns, self.next_states[last], self.dones[last], discounts
+
+    def clear(self):
+        self.position = 0
+        self.size = 0
+
+    def get_state(self):
+        # Copy of the stored transitions, for a checkpoint
+        return {
+            'memory_states': np.copy(self.states[:self.size]),
+            'memory_actions': np.copy(self.actions[:self.size]),
+            'memory_rewards': np.copy(self.rewards[:self.size]),
+            'memory_next_states': np.copy(self.next_states[:self.size]),
+            'memory_dones': np.copy(self.dones[:self.size]),
+            'memory_position': np.array(self.position)
+        }
+
+    def set_state(self, state):
+        size = len(state['memory_actions'])
+        if size > self.capacity:
+            raise ValueError("The saved memory holds " + str(size) + " transitions, the capacity is " + str(self.capacity))
+        self.states[:size] = state['memory_states']
+        self.actions[:size] = state['memory_actions']
+        self.rewards[:size] = state['memory_rewards']
+        self.next_states[:size] = state['memory_next_states']
+        self.dones[:size] = state['memory_dones']
+        self.size = size
+        self.position = int(state['memory_position']) % self.capacity
+
+
+class SumTree:
+    # Binary tree in an array: leaf i (priority of transition i) is at capacity_pow2 + i,
+    # each node holds the sum of its two children, the root (node 1) the total.
+    # Updates and proportional sampling are vectorized over a batch, O(log n) each.
+
+    def __init__(self, capacity):
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.depth = self.leaves.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[self.leaves + np.asarray(indices)]
+
+    def update_one(self, index, priority):
+        # Single leaf (add): plain Python is faster than the vectorized update
+        node = self.leaves + index
+        self.tree[node] = priority
+        node //= 2
+        while node >= 1:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node //= 2
+
+    def update(self, indices, priorities):
+        # With repeated indices the last priority is kept
+        nodes = self.leaves + np.asarray(indices)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        # Leaf index of each value in [0, total): the first leaf whose cumulative sum exceeds it
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values >= self.tree[left]
+            values -= np.where(right, self.tree[left], 0)
+            nodes = left + right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    # Proportional prioritized replay: transition i is sampled with probability p_i^alpha / sum(p^alpha),
+    # p_i = |TD error| + epsilon, new transitions get the highest priority seen so far.
+    # sample also returns the indices (for update_priorities) and the importance-sampling weights
+    # (N * P(i))^-beta / max, beta going from beta to 1 over beta_steps samples.
+
+    def __init__(self, capacity, state_shape, alpha=0.6, beta=0.4, beta_steps=100000, epsilon=1e-6):
+        super().__init__(capacity, state_shape)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = (1.0 - beta) / beta_steps
+        self.epsilon = epsilon
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def add(self, state, action, reward, next_state, done):
+        i = self.position
+        super().add(state, action, reward, next_state, done)
+        self.tree.update_one(i, self.max_priority ** self.alpha)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        indices = (self.position + np.arange(len(actions))) % self.capacity
+        super().add_batch(states, actions, rewards, next_states, dones)
+        self.tree.update(indices, np.full(len(indices), self.max_priority ** self.alpha))
+
+    def sample(self, batch_size):
+        # One value per equal segment of the total (stratified sampling)
+        total = self.tree.total()
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * total / batch_size
+        indices = np.minimum(self.tree.find(values), self.size - 1)
+        probabilities = self.tree.get(indices) / total
+        weights = (self.size * probabilities) ** -self.beta
+        weights /= weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return (self.states[indices], self.actions[indices], self.rewards[indices],
+                self.next_states[indices], self.dones[indices], indices, weights.astype(np.float32))
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(indices, priorities ** self.alpha)
+
+    def clear(self):
+        super().clear()
+        self.tree = SumTree(self.capacity)
+        self.max_priority = 1.0
+
+    def get_state(self):
+        state = super().get_state()
+        state['memory_priorities'] = self.tree.get(np.arange(self.size))
+        state['memory_max_priority'] = np.array(self.max_priority)
+        state['memory_beta'] = np.array(self.beta)
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.tree = SumTree(self.capacity)
+        if 'memory_priorities' in state:
+            self.tree.update(np.arange(self.size), state['memory_priorities'])
+            self.max_priority = float(state['memory_max_priority'])
+            self.beta = float(state['memory_beta'])
+        else:
+            # Saved from a uniform memory
+            self.tree.update(np.arange(self.size), np.full(self.size, self.max_priority ** self.alpha))
@@ -0,0 +1,120 @@
+import json
+import struct
+
+import numpy as np
+
+from octave_adapter import PARAMETER_KEYS, STATE_KEYS
+
+#######################################
+# Record files ########################
+#######################################
+# Header: MAGIC, header length (uint32), JSON of the dtype, padded to HEADER_ALIGNMENT bytes
+# then fixed size records, appended and flushed while the run goes on.
+# A partially written last record is ignored by the readers.
+MAGIC = b'RECFILE1'
+HEADER_ALIGNMENT = 64
+FLUSH_EVERY = 50  # records
+#######################################
+
+# One record per step of a run (step 0: starting state, no action)
+RUN_RECORD_DTYPE = np.dtype([('episode', np.int32), ('step', np.int32)]
+                            + [(key, np.float64) for key in PARAMETER_KEYS]
+                            + [(key, np.float64) for key in STATE_KEYS]
+                            + [('action', np.int32), ('reward', np.float64), ('epsilon', np.float64)])
+
+
+class RecordFile:
+    # Append-only file of records of a NumPy structured dtype, readable with read_records
+    # (memory-mapped) while it is still being written.
+    # append: size, bytes of the existing file to keep (e.g. saved with a checkpoint), all of it if None
+
+    def __init__(self, path, dtype, flush_every=FLUSH_EVERY, append=False, size=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.flush_every = flush_every
+        self.buffer = np.zeros(flush_every, dtype=self.dtype)
+        self.buffered = 0
+        if append:
+            with open(path, 'r+b') as f:
+                truncate(f, read_header(path)[1], self.dtype, size)
+            # Every write goes to the end of the file
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(header(self.dtype))
+            self.file.flush()
+
+    def append(self, record):
+        self.buffer[self.buffered] = record
+        self.buffered += 1
+        if self.buffered == self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffered > 0:
+            self.file.write(self.buffer[:self.buffered].tobytes())
+            self.buffered = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def truncate(f, offset, dtype, size=None):
+    # Keeps the header (offset bytes) and the whole records of the first size bytes: appending after
+    # a partially written record would shift every record that follows
+    end = f.seek(0, 2)
+    if size is not None:
+        end = min(end, size)
+    f.truncate(offset + max(0, end - offset) // dtype.itemsize * dtype.itemsize)
+
+
+def header(dtype):
+    descr = json.dumps(np.lib.format.dtype_to_descr(dtype)).encode()
+    length = len(MAGIC) + 4 + len(descr)
+    padding = -length % HEADER_ALIGNMENT
+    return MAGIC + struct.pack('<I', length + padding) + descr + b' ' * padding
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a record file")
+        length = struct.unpack('<I', f.read(4))[0]
+        descr = json.loads(f.read(length - len(MAGIC) - 4).decode())
+    # JSON turns the (name, type) tuples of the description into lists
+    return np.lib.format.descr_to_dtype([tuple(field) for field in descr]), length
+
+
+def read_records(path):
+    # Memory-mapped view of the complete records written (and flushed) so far
+    dtype, offset = read_header(path)
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        count = (f.tell() - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+class RunRecorder(RecordFile):
+    # Every step of train() / play(): parameters, the 14 state values, action, reward and epsilon
+
+    def __init__(self, path, flush_every=FLUSH_EVERY, append=False):
+        super().__init__(path, RUN_RECORD_DTYPE, flush_every, append)
+
+    def record(self, episode, step, nbr_trains, v_max, max_dwell, density_max_opt, state,
+               action=-1, reward=np.nan, epsilon=np.nan):
+        self.append((episode, step, nbr_trains, v_max, max_dwell, density_max_opt)
+                    + tuple(state[key] for key in STATE_KEYS) + (action, reward, epsilon))
+
+
+def load_statistics(path, episodes, steps):
+    # Recorded fields as (episodes, steps + 1) arrays, zeros where nothing was recorded yet
+    records = read_records(path)
+    statistics = {}
+    for field in RUN_RECORD_DTYPE.names[2:]:
+        statistics[field] = np.zeros((episodes, steps + 1))
+        statistics[field][records['episode'], records['step']] = records[field]
+    return statistics
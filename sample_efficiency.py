@@ -0,0 +1,183 @@
+import argparse
+import json
+import logging
+from random import randint, uniform
+
+import numpy as np
+
+import custom_env
+from dqn import DQN
+from logs import setup_logging
+from seeding import seed_everything
+
+#######################################
+# Sample efficiency ###################
+#######################################
+# python sample_efficiency.py --backend lattice --seeds 0 1 2 --output sample_efficiency.json
+# Trains one DQN per configuration and seed, the greedy policy is evaluated every EVALUATE_EVERY
+# episodes on fixed scenarios. Reported: the simulator calls of the training (the evaluation ones
+# are not counted) before the mean evaluation reward reaches the target.
+# Without --target, the target is the lowest of the best mean rewards of the configurations
+# (a reward every configuration reached).
+CONFIGURATIONS = {
+    'dqn': {'double': False, 'n_step': 1},
+    'double_dqn': {'double': True, 'n_step': 1},
+    'double_dqn_3_step': {'double': True, 'n_step': 3}
+}
+EPISODES = 50
+STEPS = 50
+EVALUATE_EVERY = 2  # episodes
+EVALUATION_SCENARIOS = 16
+EVALUATION_STEPS = 10
+#######################################
+
+logger = logging.getLogger('sample_efficiency')
+
+
+class CountingSimulator:
+    # Counts the simulations asked to the simulator
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.calls = 0
+        self.params = None
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        self.calls += 1
+        return self.simulator.simulate(nbr_trains, v_max, max_dwell, density_max_opt)
+
+    def simulate_many(self, list_of_params):
+        list_of_params = list(list_of_params)
+        self.calls += len(list_of_params)
+        return self.simulator.simulate_many(list_of_params)
+
+    def write_to_octave(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        self.params = (nbr_trains, v_max, max_dwell, density_max_opt)
+
+    def run_octave(self):
+        pass
+
+    def read_from_octave(self):
+        return self.simulate(*self.params)
+
+    def close(self):
+        self.simulator.close()
+
+
+def random_params(env):
+    # Same starting states as train.py
+    return (randint(env.MIN_NBR_TRAINS, env.MAX_NBR_TRAINS), round(uniform(env.MIN_V_MAX, env.MAX_V_MAX), 2),
+            round(uniform(env.MIN_MAX_DWELL, env.MAX_MAX_DWELL), 2),
+            round(uniform(env.MIN_DENSITY_MAX_OPT, env.MAX_DENSITY_MAX_OPT), 2))
+
+
+def evaluate(policy, scenarios, steps, simulator):
+    # Mean reward of the greedy rollouts of all the scenarios
+    env = custom_env.VectorCustomEnv(len(scenarios))
+    states = env.reset(simulator, scenarios)
+    rewards = np.zeros((len(scenarios), steps))
+    for step in range(steps):
+        states, params, rewards[:, step], dones, done_reason = env.step(simulator, policy.actions(states))
+    return float(rewards.mean())
+
+
+def run(configuration, seed, simulator, scenarios, episodes=EPISODES, steps=STEPS, evaluate_every=EVALUATE_EVERY):
+    # One training, returns the evaluations: [(simulator calls, mean reward)]
+    seed_everything(seed)
+    env = custom_env.CustomEnv()
+    dqn_agent = DQN(env=env, **CONFIGURATIONS[configuration])
+    counter = CountingSimulator(simulator)
+    evaluations = []
+    for episode in range(episodes):
+        params = random_params(env)
+        current_state = counter.simulate(*params)
+        for step in range(steps):
+            action = dqn_agent.action(env.convert_to_dqn_array(current_state))
+            new_state, new_params, reward, done, done_reason = env.step(counter, current_state, *params, action)
+            dqn_agent.remember(env.convert_to_dqn_array(current_state), action,
+                               reward, env.convert_to_dqn_array(new_state), done)
+            if dqn_agent.replay():
+                dqn_agent.target_train()
+            current_state = new_state
+            params = (new_params['nbr_trains'], new_params['v_max'], new_params['max_dwell'],
+                      new_params['density_max_opt'])
+        if (episode + 1) % evaluate_every == 0 or episode + 1 == episodes:
+            reward = evaluate(dqn_agent.policy, scenarios, EVALUATION_STEPS, simulator)
+            evaluations.append((counter.calls, reward))
+            logger.info("%s seed %d, episode %d: %d simulator calls, evaluation mean reward %.4f",
+                        configuration, seed, episode + 1, counter.calls, reward)
+    return evaluations
+
+
+def calls_to_reach(evaluations, target):
+    # Simulator calls of the first evaluation at or above target, None if never reached
+    for calls, reward in evaluations:
+        if reward >= target:
+            return calls
+    return None
+
+
+def compare(simulator, seeds, episodes=EPISODES, steps=STEPS, target=None, configurations=tuple(CONFIGURATIONS)):
+    env = custom_env.CustomEnv()
+    seed_everything(max(seeds) + 1)
+    scenarios = [env.snap_to_lattice(*random_params(env)) for _ in range(EVALUATION_SCENARIOS)]
+    runs = {name: {seed: run(name, seed, simulator, scenarios, episodes, steps) for seed in seeds}
+            for name in configurations}
+    if target is None:
+        target = min(max(reward for evaluations in runs[name].values() for calls, reward in evaluations)
+                     for name in configurations)
+    results = {'target': target, 'episodes': episodes, 'steps': steps, 'configurations': {}}
+    for name in configurations:
+        reached = [calls_to_reach(evaluations, target) for evaluations in runs[name].values()]
+        results['configurations'][name] = {
+            'settings': CONFIGURATIONS[name],
+            # per seed
+            'calls_to_target': reached,
+            'median_calls_to_target': float(np.median([c for c in reached if c is not None]))
+            if any(c is not None for c in reached) else None,
+            'final_reward': float(np.mean([evaluations[-1][1] for evaluations in runs[name].values()])),
+            'evaluations': {str(seed): evaluations for seed, evaluations in runs[name].items()}
+        }
+    return results
+
+
+def create_simulator(env, backend, files_context=None, lattice_folder=None):
+    if backend == 'lattice':
+        from lattice_table import LatticeTableSimulator
+        return LatticeTableSimulator(env, lattice_folder)
+    if backend == 'numpy':
+        from numpy_simulator import NumpySimulator
+        return NumpySimulator(env)
+    from octave_adapter import OctaveAdapter
+    return OctaveAdapter(files_context)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulator calls needed by DQN, Double DQN and n-step returns "
+                                                 "to reach a target evaluation reward")
+    parser.add_argument('--backend', choices=('octave', 'numpy', 'lattice'), default='lattice')
+    parser.add_argument('--files-context', help="folder of main.m for the octave backend")
+    parser.add_argument('--lattice-table', default='lattice_table', help="table folder for the lattice backend")
+    parser.add_argument('--configurations', default=','.join(CONFIGURATIONS),
+                        help="comma separated list of " + ', '.join(CONFIGURATIONS))
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--episodes', type=int, default=EPISODES)
+    parser.add_argument('--steps', type=int, default=STEPS)
+    parser.add_argument('--target', type=float)
+    parser.add_argument('--output', default='sample_efficiency.json')
+    args = parser.parse_args()
+    setup_logging()
+
+    simulator = create_simulator(custom_env.CustomEnv(), args.backend, args.files_context, args.lattice_table)
+    try:
+        results = compare(simulator, args.seeds, args.episodes, args.steps, args.target,
+                          [name for name in args.configurations.split(',') if name in CONFIGURATIONS])
+    finally:
+        simulator.close()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Target mean reward: %.4f" % results['target'])
+    for name, result in results['configurations'].items():
+        print("%-20s calls to target %-24s median %-10s final reward %.4f" % (
+            name, result['calls_to_target'], result['median_calls_to_target'], result['final_reward']))
+    print("Results written to", args.output)
@@ -0,0 +1,14 @@
+import random
+
+import numpy as np
+
+
+def seed_everything(seed):
+    # Python, NumPy and TensorFlow (when installed) random generators, for reproducible runs
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import tensorflow as tf
+        tf.random.set_seed(seed)
+    except ImportError:
+        pass
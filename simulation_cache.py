@@ -0,0 +1,181 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from octave_adapter import STATE_KEYS
+
+CACHE_MAX_ENTRIES = 1000000
+CACHE_MEMORY_ENTRIES = 100000
+EVICTION_INTERVAL = 1000  # number of new entries between two size checks
+ACCESS_FLUSH_INTERVAL = 100  # hits between two writes of their last_access times
+
+
+class SimulationCache:
+    # Results of the simulator keyed on the control lattice point of the parameters
+    # (see CustomEnv.lattice_indices), stored in a sqlite file with LRU eviction.
+    # A bounded in memory LRU sits in front of the file for repeated visits.
+    # shared=True: several processes (concurrent runs) can use the same file.
+
+    def __init__(self, env, path, max_entries=CACHE_MAX_ENTRIES, memory_entries=CACHE_MEMORY_ENTRIES, shared=False):
+        self.env = env
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        # last_access times of the hits not written yet
+        self.accesses = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.new_entries = 0
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        if shared:
+            # Readers do not block the writer, the sqlite file lock serializes writers
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                "key TEXT PRIMARY KEY, state TEXT NOT NULL, last_access REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.connection.commit()
+
+    def snap(self, params):
+        return self.env.snap_to_lattice(*params)
+
+    def key(self, params):
+        indices = self.env.lattice_indices(*params)
+        return hashlib.sha1(",".join(str(index) for index in indices).encode()).hexdigest()
+
+    def _remember(self, key, state):
+        self.memory[key] = state
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, params):
+        key = self.key(params)
+        with self.lock:
+            state = self.memory.get(key)
+            if state is not None:
+                self.memory.move_to_end(key)
+                self._touch(key)
+                self.hits += 1
+                return dict(state)
+            row = self.connection.execute("SELECT state FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._touch(key)
+            values = json.loads(row[0])
+            state = {state_key: values[i] for i, state_key in enumerate(STATE_KEYS)}
+            self._remember(key, state)
+            self.hits += 1
+            return dict(state)
+
+    def put(self, params, state):
+        key = self.key(params)
+        values = json.dumps([state[state_key] for state_key in STATE_KEYS])
+        with self.lock:
+            self._remember(key, dict(state))
+            self.accesses.pop(key, None)
+            self.connection.execute("INSERT OR REPLACE INTO results (key, state, last_access) VALUES (?, ?, ?)",
+                                    (key, values, time.time()))
+            self.connection.commit()
+            self.new_entries += 1
+            if self.new_entries % EVICTION_INTERVAL == 0:
+                self._evict()
+
+    def _touch(self, key):
+        # Memory hits too: the hottest entries are answered from memory, the disk LRU must not evict them
+        self.accesses[key] = time.time()
+        if len(self.accesses) >= ACCESS_FLUSH_INTERVAL:
+            self._flush_accesses()
+            self.connection.commit()
+
+    def _flush_accesses(self):
+        self.connection.executemany("UPDATE results SET last_access = ? WHERE key = ?",
+                                    [(last_access, key) for key, last_access in self.accesses.items()])
+        self.accesses.clear()
+
+    def _evict(self):
+        # The evicted entries are the least recently used ones, pending accesses included
+        self._flush_accesses()
+        self.connection.commit()
+        count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        self.connection.execute("DELETE FROM results WHERE key IN "
+                                "(SELECT key FROM results ORDER BY last_access LIMIT ?)", (count - self.max_entries,))
+        self.connection.commit()
+        self.evictions += count - self.max_entries
+
+    def statistics(self):
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests > 0 else 0.0,
+            'evictions': self.evictions,
+            'entries': entries
+        }
+
+    def close(self):
+        with self.lock:
+            self._evict()
+            self.connection.close()
+
+
+class CachedSimulator:
+    # Same interface as OctaveAdapter, the simulator only runs for parameters missing from the cache.
+    # Parameters are snapped to the control lattice, so the simulated values always match the cache key.
+
+    def __init__(self, simulator, cache):
+        self.simulator = simulator
+        self.cache = cache
+        self.params = None
+        self.state = None
+
+    def write_to_octave(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        self.params = self.cache.snap((nbr_trains, v_max, max_dwell, density_max_opt))
+        self.state = self.cache.get(self.params)
+        if self.state is None:
+            self.simulator.write_to_octave(*self.params)
+
+    def run_octave(self):
+        if self.state is None:
+            self.simulator.run_octave()
+
+    def read_from_octave(self):
+        if self.state is None:
+            self.state = self.simulator.read_from_octave()
+            self.cache.put(self.params, self.state)
+        return dict(self.state)
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        # Does not use the state of write/run/read, can be called from several threads
+        params = self.cache.snap((nbr_trains, v_max, max_dwell, density_max_opt))
+        state = self.cache.get(params)
+        if state is None:
+            state = self.simulator.simulate(*params)
+            self.cache.put(params, state)
+        return dict(state)
+
+    def simulate_many(self, list_of_params):
+        snapped = [self.cache.snap(params) for params in list_of_params]
+        out = [self.cache.get(params) for params in snapped]
+        # Each missing lattice point is simulated once, even if it is requested several times
+        missing = list(OrderedDict.fromkeys(params for params, state in zip(snapped, out) if state is None))
+        if len(missing) > 0:
+            results = dict(zip(missing, self.simulator.simulate_many(missing)))
+            for params, state in results.items():
+                self.cache.put(params, state)
+            out = [state if state is not None else dict(results[params]) for params, state in zip(snapped, out)]
+        return out
+
+    def close(self):
+        self.simulator.close()
+        self.cache.close()
@@ -0,0 +1,78 @@
+import logging
+import os
+import queue
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from octave_adapter import OctaveAdapter, OCTAVE_EXEC, OCTAVE_SESSION
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatorPool:
+    # Runs simulations in parallel, each worker owns an OctaveAdapter working in a
+    # private copy of the simulator folder (main.m, its dependencies and its own io/),
+    # so that the io/*.xml files of two simulations never collide.
+    # The Octave processes do the work, threads are enough to drive them.
+
+    def __init__(self, file_context, workers=None, scratch_dir=None, session=OCTAVE_SESSION, octave_exec=OCTAVE_EXEC):
+        self.workers = workers if workers is not None else os.cpu_count()
+        logger.debug("Starting simulator pool of %d workers", self.workers)
+        self.scratch_dir = tempfile.mkdtemp(prefix='simulator_pool_', dir=scratch_dir)
+        self.adapters = []
+        self.idle_adapters = queue.Queue()
+        for worker in range(self.workers):
+            worker_context = os.path.join(self.scratch_dir, 'worker_' + str(worker))
+            shutil.copytree(file_context, worker_context,
+                            ignore=shutil.ignore_patterns('io', 'tmp_*', 'play_*', '.git'))
+            os.makedirs(os.path.join(worker_context, 'io'))
+            adapter = OctaveAdapter(worker_context, session=session, octave_exec=octave_exec)
+            self.adapters.append(adapter)
+            self.idle_adapters.put(adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        logger.info("Started simulator pool of %d workers in %s", self.workers, self.scratch_dir)
+
+    def _run(self, function, *args):
+        adapter = self.idle_adapters.get()
+        try:
+            return function(adapter, *args)
+        finally:
+            self.idle_adapters.put(adapter)
+
+    def submit(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        # Future of one state (same format as OctaveAdapter.read_from_octave)
+        return self.executor.submit(self._run, OctaveAdapter.simulate, nbr_trains, v_max, max_dwell, density_max_opt)
+
+    def submit_many(self, list_of_params):
+        # Future of the list of states, the whole list is run as one batch by a single worker
+        return self.executor.submit(self._run, OctaveAdapter.simulate_many, list(list_of_params))
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        return self.submit(nbr_trains, v_max, max_dwell, density_max_opt).result()
+
+    def simulate_many(self, list_of_params):
+        # Splits the list in one batch per worker and keeps the order of the results
+        list_of_params = list(list_of_params)
+        if len(list_of_params) == 0:
+            return []
+        chunk_size = -(-len(list_of_params) // self.workers)
+        futures = [self.submit_many(list_of_params[i:i + chunk_size])
+                   for i in range(0, len(list_of_params), chunk_size)]
+        out = []
+        for future in futures:
+            out.extend(future.result())
+        return out
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for adapter in self.adapters:
+            adapter.close()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        logger.debug("Closed simulator pool")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
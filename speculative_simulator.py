@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class SpeculativeSimulator:
+    # Simulates in the background the parameters reached by the k actions with the highest
+    # Q values while the agent decides (and trains), so that the step after the choice only
+    # waits for the simulation if the chosen action was not one of them.
+    # The simulator must accept concurrent simulate calls (SimulatorPool, NumpySimulator and
+    # CachedSimulator in front of them). Unused speculations are cancelled when they have not
+    # started yet; the running ones finish and, with a CachedSimulator, stay in its cache.
+    # k: train.SPECULATIVE_K
+
+    def __init__(self, simulator, env, k, workers=None):
+        self.simulator = simulator
+        self.env = env
+        self.k = k
+        self.executor = ThreadPoolExecutor(max_workers=workers if workers is not None else k)
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.speculated = 0
+        self.cancelled = 0
+        self.wasted = 0
+
+    def speculate(self, params, q_values):
+        # params: current (nbr_trains, v_max, max_dwell, density_max_opt), q_values: (81,) of the current state
+        self.discard()
+        for action in np.argsort(q_values)[::-1][:self.k]:
+            new_params = self.env.apply_action(*params, int(action))
+            key = self.env.lattice_indices(*new_params)
+            if key not in self.pending:
+                self.pending[key] = self.executor.submit(self.simulator.simulate, *new_params)
+                self.speculated += 1
+
+    def discard(self):
+        for future in self.pending.values():
+            if future.cancel():
+                self.cancelled += 1
+            else:
+                self.wasted += 1
+        self.pending = {}
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        future = self.pending.pop(self.env.lattice_indices(nbr_trains, v_max, max_dwell, density_max_opt), None)
+        if future is not None:
+            self.hits += 1
+            state = future.result()
+        else:
+            self.misses += 1
+            state = self.simulator.simulate(nbr_trains, v_max, max_dwell, density_max_opt)
+        self.discard()
+        return state
+
+    def simulate_many(self, list_of_params):
+        return self.simulator.simulate_many(list_of_params)
+
+    def statistics(self):
+        steps = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / steps if steps > 0 else 0.0,
+            'speculated': self.speculated,
+            'cancelled': self.cancelled,
+            # simulations run for nothing (not counting the ones still cached)
+            'wasted': self.wasted,
+            'wasted_per_step': self.wasted / steps if steps > 0 else 0.0
+        }
+
+    def close(self):
+        self.discard()
+        self.executor.shutdown(wait=True)
+        self.simulator.close()
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class StateEncoder:
+    # DQN arrays of CustomEnv.convert_to_dqn_array, one (7, 2) state or a (batch, 7, 2) batch,
+    # ==> (batch, 14) float32 network inputs, normalized with the running mean / std of the
+    # states seen so far (raw values go from ~1 for h_out_std to ~1700 for A_std).
+
+    def __init__(self, state_shape, epsilon=1e-8):
+        self.size = int(np.prod(state_shape))
+        self.epsilon = epsilon
+        self.count = 0
+        self.mean = np.zeros(self.size)
+        self.var = np.ones(self.size)
+
+    def flatten(self, states):
+        return np.asarray(states, dtype=np.float64).reshape(-1, self.size)
+
+    def update(self, states):
+        # Merge the mean / variance of the batch into the running ones (parallel variance formula)
+        flat = self.flatten(states)
+        count = flat.shape[0]
+        if count == 0:
+            return
+        mean = flat.mean(axis=0)
+        var = flat.var(axis=0)
+        total = self.count + count
+        delta = mean - self.mean
+        if self.count == 0:
+            self.var = var
+        else:
+            self.var = (self.var * self.count + var * count + delta ** 2 * self.count * count / total) / total
+        self.mean = self.mean + delta * count / total
+        self.count = total
+
+    def encode(self, states):
+        flat = self.flatten(states)
+        return ((flat - self.mean) / np.sqrt(self.var + self.epsilon)).astype(np.float32)
+
+    def get_state(self):
+        return {'encoder_count': np.array(self.count), 'encoder_mean': self.mean, 'encoder_var': self.var}
+
+    def set_state(self, state):
+        self.count = int(state['encoder_count'])
+        self.mean = np.array(state['encoder_mean'], dtype=np.float64)
+        self.var = np.array(state['encoder_var'], dtype=np.float64)
@@ -0,0 +1,122 @@
+import math
+import os
+import re
+import sys
+import time
+import xml.etree.cElementTree as ET
+
+# Stand-in for the Octave simulator, to run OctaveAdapter / SimulatorPool without Octave.
+# It accepts the same command lines as the adapter gives to Octave:
+#   python stub_simulator.py --persist main.m                  ==> one simulation
+#   python stub_simulator.py --no-gui --eval main_batch         ==> io/python_to_octave_batch.xml
+#   python stub_simulator.py --no-gui --quiet --interactive     ==> session, commands read from stdin
+# and reads / writes the io/*.xml files of its working directory, like main.m.
+# The values are a cheap closed form of the parameters, not a traffic simulation.
+STUB_COMMAND = [sys.executable, os.path.abspath(__file__)]
+
+# Emulated cost of one simulation (s), e.g. STUB_SIMULATOR_DELAY=0.5
+DELAY = float(os.environ.get('STUB_SIMULATOR_DELAY', '0'))
+
+LINE_LENGTH = 150 * 200  # m
+NBR_STATIONS = 25
+DEMAND = 1.2  # pass / s / station
+PLATFORM_SURFACE = 270  # m2
+TRAIN_CAPACITY = 174.5 * 4  # pass
+
+
+def simulate(nbr_trains, v_max, max_dwell, density_max_opt):
+    if DELAY > 0:
+        time.sleep(DELAY)
+    dwell_mean = min(max_dwell, 12 + 0.35 * max_dwell)
+    h_out_mean = (LINE_LENGTH / v_max + NBR_STATIONS * dwell_mean) / nbr_trains
+    I_mean = DEMAND * h_out_mean
+    A_mean = min(I_mean * 4.5, PLATFORM_SURFACE * density_max_opt)
+    mu_mean = min(A_mean, TRAIN_CAPACITY) * 0.2
+    Q_mean = max(0.0, A_mean - mu_mean)
+    P_mean = min(TRAIN_CAPACITY, mu_mean * NBR_STATIONS / 8)
+    return {
+        'h_out_mean': h_out_mean,
+        'h_out_std': 0.01 * h_out_mean * (1 + math.sin(nbr_trains)),
+        'I_mean': I_mean,
+        'I_std': 1.7 * I_mean,
+        'A_mean': A_mean,
+        'A_std': 2.7 * A_mean,
+        'mu_mean': mu_mean,
+        'mu_std': 1.7 * mu_mean,
+        'Q_mean': Q_mean,
+        'Q_std': 1.9 * Q_mean,
+        'P_mean': P_mean,
+        'P_std': 2.0 * P_mean,
+        'dwell_mean': dwell_mean,
+        'dwell_std': 0.4 * dwell_mean
+    }
+
+
+def parse_parameters(element):
+    return (int(float(element.find('nbr_trains').text)), float(element.find('v_max').text),
+            float(element.find('max_dwell').text), float(element.find('density_max_opt').text))
+
+
+def state_element(state):
+    element = ET.Element("parameters")
+    element.text = "\n    "
+    for key, value in state.items():
+        child = ET.SubElement(element, key)
+        child.text = str(round(value, 4))
+        child.tail = "\n    "
+    child.tail = "\n"
+    return element
+
+
+def run_main():
+    params = parse_parameters(ET.parse('io/python_to_octave.xml').getroot())
+    with open('io/octave_to_python.xml', 'wb') as f:
+        ET.ElementTree(state_element(simulate(*params))).write(f, encoding='UTF-8', xml_declaration=True)
+
+
+def run_main_batch():
+    batch = ET.parse('io/python_to_octave_batch.xml').getroot()
+    batch_element = ET.Element("batch")
+    batch_element.text = "\n"
+    for element in batch.findall('parameters'):
+        result = state_element(simulate(*parse_parameters(element)))
+        result.tail = "\n"
+        batch_element.append(result)
+    with open('io/octave_to_python_batch.xml', 'wb') as f:
+        ET.ElementTree(batch_element).write(f, encoding='UTF-8', xml_declaration=True)
+
+
+def run_command(command):
+    if re.search(r'\bmain_batch\b', command):
+        run_main_batch()
+    elif re.search(r'\bmain\b', command):
+        run_main()
+
+
+def run_session():
+    # Only understands the commands sent by OctaveSession
+    for line in sys.stdin:
+        if line.strip() in ('exit', 'quit', "builtin('exit')"):
+            break
+        error = None
+        command = re.match(r'try, (.*?); catch', line)
+        try:
+            if command is not None:
+                run_command(command.group(1))
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        error_marker = re.search(r"disp\(\['([^']*)' err\.message\]\)", line)
+        if error is not None and error_marker is not None:
+            print(error_marker.group(1) + error, flush=True)
+        for marker in re.findall(r"disp\('([^']*)'\)", line):
+            print(marker, flush=True)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if '--interactive' in args:
+        run_session()
+    elif '--eval' in args:
+        run_command(args[args.index('--eval') + 1])
+    else:
+        run_main()
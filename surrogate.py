@@ -0,0 +1,221 @@
+import threading
+from random import random
+
+import numpy as np
+
+from octave_adapter import STATE_KEYS
+
+#######################################
+# Surrogate simulator #################
+#######################################
+# kNN regression of the 14 outputs of the simulator on the control lattice indices
+# (CustomEnv.lattice_indices), fitted online with every real simulation.
+# A prediction is trusted when its nearest known point is close enough and its neighbours agree,
+# otherwise the real simulator runs (and its result is added to the surrogate).
+SURROGATE_NEIGHBOURS = 8
+SURROGATE_MIN_SAMPLES = 50  # real simulations before any prediction is trusted
+SURROGATE_MAX_DISTANCE = 4.0  # lattice steps to the nearest known point
+SURROGATE_MAX_SPREAD = 0.1  # relative std of the outputs of the neighbours
+SURROGATE_AUDIT_RATE = 0.05  # trusted predictions checked against the simulator, for the error
+DYNA_STEPS = 8  # imagined transitions per real step
+DYNA_UPDATES = 1  # extra replay updates per planning
+#######################################
+
+
+def relative_errors(predictions, states):
+    # Mean over the 14 outputs of |prediction - state| / (|state| + 1)
+    return (np.abs(predictions - states) / (np.abs(states) + 1)).mean(axis=-1)
+
+
+class KNNSurrogate:
+
+    def __init__(self, env, neighbours=SURROGATE_NEIGHBOURS, min_samples=SURROGATE_MIN_SAMPLES,
+                 max_distance=SURROGATE_MAX_DISTANCE, max_spread=SURROGATE_MAX_SPREAD):
+        self.env = env
+        self.neighbours = neighbours
+        self.min_samples = min_samples
+        self.max_distance = max_distance
+        self.max_spread = max_spread
+        self.lock = threading.Lock()
+        self.rows = {}  # lattice indices ==> row
+        self.points = np.zeros((1024, 4))
+        self.states = np.zeros((1024, len(STATE_KEYS)))
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def indices(self, params):
+        # (n, 4) simulator order parameters ==> (n, 4) lattice indices
+        return np.array([self.env.lattice_indices(*p) for p in np.asarray(params, dtype=np.float64).tolist()],
+                        dtype=np.float64).reshape(-1, 4)
+
+    def add(self, params, state):
+        # params: (nbr_trains, v_max, max_dwell, density_max_opt), state: simulator dict
+        key = self.env.lattice_indices(*params)
+        values = [state[key_] for key_ in STATE_KEYS]
+        with self.lock:
+            row = self.rows.get(key)
+            if row is None:
+                if self.size == len(self.points):
+                    self.points = np.concatenate([self.points, np.zeros_like(self.points)])
+                    self.states = np.concatenate([self.states, np.zeros_like(self.states)])
+                row = self.rows[key] = self.size
+                self.points[row] = key
+                self.size += 1
+            self.states[row] = values
+
+    def predict(self, params):
+        # (n, 4) parameters ==> (n, 14) predicted states (STATE_KEYS order), (n,) trusted
+        points = self.indices(params)
+        with self.lock:
+            known_points = self.points[:self.size]
+            known_states = self.states[:self.size]
+        if len(known_points) == 0:
+            return np.zeros((len(points), len(STATE_KEYS))), np.zeros(len(points), dtype=bool)
+        k = min(self.neighbours, len(known_points))
+        distances = np.sqrt(((points[:, None, :] - known_points[None, :, :]) ** 2).sum(axis=2))
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        neighbour_states = known_states[nearest]
+        # Inverse distance weighting, a known point is returned as it is
+        weights = 1 / np.maximum(nearest_distances, 1e-9)
+        weights /= weights.sum(axis=1, keepdims=True)
+        predictions = (weights[:, :, None] * neighbour_states).sum(axis=1)
+        spread = (neighbour_states.std(axis=1) / (np.abs(predictions) + 1)).max(axis=1)
+        exact = nearest_distances.min(axis=1) == 0
+        trusted = exact | ((len(known_points) >= self.min_samples)
+                           & (nearest_distances.min(axis=1) <= self.max_distance)
+                           & (spread <= self.max_spread))
+        return predictions, trusted
+
+    def predict_state(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        predictions, trusted = self.predict([(nbr_trains, v_max, max_dwell, density_max_opt)])
+        return {key: float(value) for key, value in zip(STATE_KEYS, predictions[0])}, bool(trusted[0])
+
+    def sample(self, count):
+        # count known (params, state array) pairs, for planning
+        with self.lock:
+            rows = np.random.randint(0, self.size, size=count)
+            points = self.points[rows]
+            states = self.states[rows]
+        params = np.array([self.env.lattice_params(p) for p in points.astype(int).tolist()])
+        return params, states
+
+
+class SurrogateSimulator:
+    # Same interface as the other simulators: the surrogate answers when it is trusted,
+    # the real simulator otherwise.
+
+    def __init__(self, simulator, surrogate, audit_rate=SURROGATE_AUDIT_RATE):
+        self.simulator = simulator
+        self.surrogate = surrogate
+        self.audit_rate = audit_rate
+        self.lock = threading.Lock()
+        self.real = 0
+        self.imagined = 0
+        self.planned = 0
+        self.audited = 0
+        # Sums of the relative errors of the predictions compared to the simulator
+        self.error_untrusted = [0.0, 0]
+        self.error_trusted = [0.0, 0]
+        self.params = None
+        # False when the last simulate call was answered by the surrogate
+        self.last_real = True
+
+    def simulate(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        params = (nbr_trains, v_max, max_dwell, density_max_opt)
+        predicted, trusted = self.surrogate.predict_state(*params)
+        audit = trusted and random() < self.audit_rate
+        if trusted and not audit:
+            with self.lock:
+                self.imagined += 1
+            self.last_real = False
+            return predicted
+        # Not trusted: fall back to the simulator, audit: check a trusted prediction
+        enough_samples = len(self.surrogate) >= self.surrogate.min_samples
+        state = self.simulator.simulate(*params)
+        error = float(relative_errors(np.array([predicted[key] for key in STATE_KEYS]),
+                                      np.array([state[key] for key in STATE_KEYS])))
+        with self.lock:
+            self.real += 1
+            if audit:
+                self.audited += 1
+                self.error_trusted[0] += error
+                self.error_trusted[1] += 1
+            elif enough_samples:
+                self.error_untrusted[0] += error
+                self.error_untrusted[1] += 1
+        self.surrogate.add(params, state)
+        self.last_real = True
+        return state
+
+    def simulate_many(self, list_of_params):
+        list_of_params = list(list_of_params)
+        states = self.simulator.simulate_many(list_of_params)
+        with self.lock:
+            self.real += len(states)
+        for params, state in zip(list_of_params, states):
+            self.surrogate.add(params, state)
+        return states
+
+    def write_to_octave(self, nbr_trains, v_max, max_dwell, density_max_opt):
+        self.params = (nbr_trains, v_max, max_dwell, density_max_opt)
+
+    def run_octave(self):
+        pass
+
+    def read_from_octave(self):
+        return self.simulate(*self.params)
+
+    def statistics(self):
+        with self.lock:
+            steps = self.real + self.imagined + self.planned
+            return {
+                'real': self.real,
+                'imagined': self.imagined,
+                'planned': self.planned,
+                # real simulations / all the transitions the DQN learned from
+                'real_ratio': self.real / steps if steps > 0 else 0.0,
+                'audited': self.audited,
+                # mean relative error where the simulator was used instead / of the audited predictions
+                'error_untrusted': self.error_untrusted[0] / self.error_untrusted[1] if self.error_untrusted[1] > 0 else None,
+                'error_trusted': self.error_trusted[0] / self.error_trusted[1] if self.error_trusted[1] > 0 else None
+            }
+
+    def close(self):
+        self.simulator.close()
+
+
+class DynaPlanner:
+    # Imagined transitions between real steps: known points of the surrogate, random actions,
+    # next states predicted by the surrogate (only the trusted ones are kept).
+
+    def __init__(self, surrogate_simulator, vector_env, steps=DYNA_STEPS, updates=DYNA_UPDATES):
+        self.simulator = surrogate_simulator
+        self.surrogate = surrogate_simulator.surrogate
+        self.env = vector_env
+        self.steps = steps
+        self.updates = updates
+
+    def plan(self, dqn_agent):
+        if len(self.surrogate) < self.surrogate.min_samples or self.steps <= 0:
+            return 0
+        params, states = self.surrogate.sample(self.steps)
+        actions = np.random.randint(0, len(self.env.ACTIONS), size=self.steps)
+        # Simulator order ==> mapping order for apply_actions, and back
+        next_params = self.env.simulator_params(self.env.apply_actions(params[:, self.env.FROM_SIMULATOR], actions))
+        next_states, trusted = self.surrogate.predict(next_params)
+        count = int(trusted.sum())
+        if count == 0:
+            return 0
+        states = states[trusted].reshape((-1,) + tuple(self.env.INPUT_SHAPE))
+        next_states = next_states[trusted].reshape((-1,) + tuple(self.env.INPUT_SHAPE))
+        rewards = self.env.calculate_rewards(next_states)
+        dqn_agent.remember(states, actions[trusted], rewards, next_states, np.zeros(count))
+        for _ in range(self.updates):
+            if dqn_agent.replay():
+                dqn_agent.target_train()
+        with self.simulator.lock:
+            self.simulator.planned += count
+        return count
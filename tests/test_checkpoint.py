@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pytest
+
+from checkpoint import Checkpointer, latest_checkpoint, list_checkpoints, load_checkpoint, run_folder
+from run_recorder import read_records
+
+
+def test_save_and_prune(tmp_path):
+    folder = run_folder('tmp_a', str(tmp_path))
+    record = tmp_path / 'record.bin'
+    record.write_bytes(b'0123456789')
+    checkpointer = Checkpointer(folder, keep=3)
+    for i in range(5):
+        checkpointer.save('checkpoint_%06d' % i, {'episode': i}, {'record.bin': (str(record), 4 + i)})
+    checkpointer.close()
+    assert list_checkpoints(folder) == ['checkpoint_000002', 'checkpoint_000003', 'checkpoint_000004']
+    assert not any(name.endswith('.tmp') for name in os.listdir(folder))
+    assert load_checkpoint(os.path.join(folder, 'checkpoint_000003')) == {'episode': 3}
+    # Only the size given when saving
+    assert (tmp_path / 'tmp_a' / 'checkpoint_000003' / 'record.bin').read_bytes() == b'0123456'
+
+
+def test_prune_keeps_the_other_runs(tmp_path):
+    a = Checkpointer(run_folder('tmp_a', str(tmp_path)), keep=1)
+    b = Checkpointer(run_folder('tmp_b', str(tmp_path)), keep=1)
+    for i in range(3):
+        a.save('checkpoint_%06d' % i, {'run': 'a', 'episode': i})
+    b.save('checkpoint_%06d' % 0, {'run': 'b', 'episode': 0})
+    a.close()
+    b.close()
+    assert list_checkpoints(run_folder('tmp_a', str(tmp_path))) == ['checkpoint_000002']
+    assert list_checkpoints(run_folder('tmp_b', str(tmp_path))) == ['checkpoint_000000']
+
+
+def test_latest_checkpoint(tmp_path):
+    assert latest_checkpoint(str(tmp_path / 'missing')) is None
+    for run, count in (('tmp_2024_01_01_00_00_00', 3), ('tmp_2024_01_02_00_00_00', 1), ('tmp_2024_01_03_00_00_00', 0)):
+        checkpointer = Checkpointer(run_folder(run, str(tmp_path)))
+        for i in range(count):
+            checkpointer.save('checkpoint_%06d' % (i + 1), {'episode': i + 1})
+        checkpointer.close()
+    # Most recent run having a checkpoint
+    assert latest_checkpoint(str(tmp_path)) == os.path.join(str(tmp_path), 'tmp_2024_01_02_00_00_00', 'checkpoint_000001')
+    # Latest one of a run folder
+    assert latest_checkpoint(run_folder('tmp_2024_01_01_00_00_00', str(tmp_path))) == \
+        os.path.join(str(tmp_path), 'tmp_2024_01_01_00_00_00', 'checkpoint_000003')
+
+
+def test_resume(tmp_path, monkeypatch):
+    pytest.importorskip('tensorflow')
+    import train
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(train, 'SIMULATOR_BACKEND', 'numpy')
+    episodes, steps = 3, 4
+
+    os.makedirs('tmp_a')
+    train.train(episodes, steps, tmp_folder='tmp_a/')
+    os.makedirs('tmp_b')
+    resume = os.path.join(run_folder('tmp_a'), 'checkpoint_000001')
+    train.train(resume=resume, tmp_folder='tmp_b/')
+
+    # Continued from the checkpoint as the first run did
+    first = read_records('tmp_a/' + train.RUN_RECORD_NAME)
+    resumed = read_records('tmp_b/' + train.RUN_RECORD_NAME)
+    assert len(resumed) == len(first) == episodes * (steps + 1)
+    for field in ('episode', 'step', 'nbr_trains', 'v_max', 'max_dwell', 'density_max_opt', 'action'):
+        np.testing.assert_array_equal(resumed[field], first[field])
+    # Its checkpoints and transitions continue the ones of the resumed run
+    assert list_checkpoints(run_folder('tmp_a')) == ['checkpoint_000001', 'checkpoint_000002', 'checkpoint_000003']
+    assert not os.path.exists(run_folder('tmp_b'))
+    assert os.listdir(train.TRANSITIONS_FOLDER) == ['tmp_a.bin']
+    assert load_checkpoint(latest_checkpoint())['episode'] == episodes
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from run_recorder import RecordFile, read_header, read_records
+
+DTYPE = np.dtype([('step', np.int32), ('value', np.float64)])
+
+
+def write(path, steps, append=False, size=None, flush_every=4):
+    f = RecordFile(path, DTYPE, flush_every=flush_every, append=append, size=size)
+    for step in steps:
+        f.append((step, step * 0.5))
+    f.close()
+
+
+def test_records_readable_while_written(tmp_path):
+    path = str(tmp_path / 'records.bin')
+    f = RecordFile(path, DTYPE, flush_every=4)
+    for step in range(6):
+        f.append((step, step * 0.5))
+    # Only the flushed records
+    assert read_records(path)['step'].tolist() == [0, 1, 2, 3]
+    f.close()
+    records = read_records(path)
+    assert records['step'].tolist() == list(range(6))
+    assert records['value'].tolist() == [step * 0.5 for step in range(6)]
+
+
+def test_append(tmp_path):
+    path = str(tmp_path / 'records.bin')
+    write(path, range(3))
+    write(path, range(3, 5), append=True)
+    assert read_records(path)['step'].tolist() == [0, 1, 2, 3, 4]
+
+
+def test_append_drops_a_partial_record(tmp_path):
+    path = str(tmp_path / 'records.bin')
+    write(path, range(3))
+    with open(path, 'ab') as f:
+        f.write(b'torn')
+    write(path, [7], append=True)
+    assert read_records(path)['step'].tolist() == [0, 1, 2, 7]
+    assert (os.path.getsize(path) - read_header(path)[1]) % DTYPE.itemsize == 0
+
+
+def test_append_truncates_to_size(tmp_path):
+    path = str(tmp_path / 'records.bin')
+    write(path, range(2))
+    size = os.path.getsize(path)
+    # Written after the checkpoint of size bytes, then dropped when resuming from it
+    write(path, range(2, 5), append=True)
+    write(path, [9], append=True, size=size)
+    assert read_records(path)['step'].tolist() == [0, 1, 9]
+
+
+def test_transitions_of_a_folder(tmp_path):
+    from transition_dataset import TransitionDataset, read_transitions
+    folder = str(tmp_path / 'transitions')
+    states = np.ones((3, 7, 2))
+    for run, count in (('tmp_a', 2), ('tmp_b', 3)):
+        dataset = TransitionDataset(os.path.join(folder, run + '.bin'))
+        dataset.add_batch(np.zeros((count, 4)), states[:count], np.arange(count), np.zeros((count, 4)),
+                          states[:count], np.zeros(count))
+        dataset.close()
+    assert read_transitions(folder)['action'].tolist() == [0, 1, 0, 1, 2]
+    # Another format
+    write(str(tmp_path / 'records.bin'), range(2))
+    with pytest.raises(ValueError):
+        TransitionDataset(str(tmp_path / 'records.bin'))
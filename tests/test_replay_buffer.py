@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, SumTree
+
+STATE_SHAPE = (7, 2)
+
+
+def transitions(count, start=0):
+    states = np.arange(start, start + count, dtype=np.float32)[:, None, None] * np.ones(STATE_SHAPE, dtype=np.float32)
+    return states, np.arange(count) % 3, np.arange(count, dtype=np.float32), states + 1, np.zeros(count)
+
+
+def test_ring_buffer_overwrites_the_oldest():
+    memory = ReplayBuffer(5, STATE_SHAPE)
+    states, actions, rewards, next_states, dones = transitions(3)
+    memory.add_batch(states, actions, rewards, next_states, dones)
+    for i in range(3, 7):
+        memory.add(states[0] * 0 + i, i % 3, float(i), states[0] * 0 + i + 1, 0)
+    assert len(memory) == 5
+    assert memory.position == 2
+    # 0 and 1 overwritten by 5 and 6
+    assert sorted(memory.rewards.tolist()) == [2, 3, 4, 5, 6]
+    assert (memory.sample_indices(100) < 5).all()
+
+
+def test_get_state_round_trip():
+    memory = PrioritizedReplayBuffer(8, STATE_SHAPE)
+    memory.add_batch(*transitions(6))
+    memory.update_priorities(np.arange(6), np.linspace(0.1, 2.0, 6))
+    restored = PrioritizedReplayBuffer(8, STATE_SHAPE)
+    restored.set_state(memory.get_state())
+    assert len(restored) == 6 and restored.position == memory.position
+    np.testing.assert_array_equal(restored.states[:6], memory.states[:6])
+    np.testing.assert_allclose(restored.tree.get(np.arange(6)), memory.tree.get(np.arange(6)))
+    assert restored.tree.total() == pytest.approx(memory.tree.total())
+
+
+def assert_sums(tree):
+    # Every node is the sum of its two children
+    for node in range(1, tree.leaves):
+        assert tree.tree[node] == pytest.approx(tree.tree[2 * node] + tree.tree[2 * node + 1])
+
+
+def test_sum_tree_sums():
+    rng = np.random.RandomState(0)
+    tree = SumTree(13)
+    assert tree.leaves == 16
+    priorities = rng.random_sample(13)
+    for i, priority in enumerate(priorities):
+        tree.update_one(i, priority)
+    assert_sums(tree)
+    indices = np.array([1, 4, 4, 12])
+    tree.update(indices, np.array([0.5, 0.1, 2.0, 3.0]))
+    priorities[[1, 4, 12]] = [0.5, 2.0, 3.0]  # last priority of a repeated index
+    np.testing.assert_allclose(tree.get(np.arange(13)), priorities)
+    assert tree.total() == pytest.approx(priorities.sum())
+    assert_sums(tree)
+
+
+def test_sum_tree_find():
+    tree = SumTree(4)
+    tree.update(np.arange(4), np.array([1.0, 0.0, 2.0, 1.0]))
+    # Cumulative sums: [0, 1) ==> 0, [1, 3) ==> 2 (leaf 1 is empty), [3, 4) ==> 3
+    np.testing.assert_array_equal(tree.find([0.0, 0.99, 1.0, 2.99, 3.0, 3.99]), [0, 0, 2, 2, 3, 3])
+
+
+def test_prioritized_sampling_follows_the_priorities():
+    np.random.seed(0)
+    memory = PrioritizedReplayBuffer(4, STATE_SHAPE, alpha=1.0)
+    memory.add_batch(*transitions(4))
+    memory.update_priorities(np.arange(4), np.array([1.0, 0.0, 0.0, 3.0]))
+    counts = np.zeros(4)
+    for _ in range(200):
+        indices = memory.sample(8)[5]
+        counts += np.bincount(indices, minlength=4)
+    # |TD error| + epsilon: almost never the zero ones, 3 times more the last one than the first
+    assert counts[1] + counts[2] < 5
+    assert counts[3] / counts[0] == pytest.approx(3, rel=0.1)
+    assert memory.max_priority == pytest.approx(3.0, rel=1e-3)
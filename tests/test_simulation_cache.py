@@ -0,0 +1,69 @@
+import pytest
+
+import custom_env
+import simulation_cache
+from numpy_simulator import NumpySimulator
+from simulation_cache import SimulationCache, CachedSimulator
+
+
+class CountingSimulator(NumpySimulator):
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.calls = 0  # simulated points
+
+    def simulate_many(self, list_of_params):
+        self.calls += len(list_of_params)
+        return super().simulate_many(list_of_params)
+
+
+@pytest.fixture
+def env():
+    return custom_env.CustomEnv()
+
+
+def params(i):
+    return (20 + i, 20.0, 30.0, 3.0)
+
+
+def test_hits_do_not_simulate(env, tmp_path):
+    simulator = CountingSimulator(env)
+    cached = CachedSimulator(simulator, SimulationCache(env, str(tmp_path / 'cache.sqlite')))
+    first = cached.simulate(*params(0))
+    assert cached.simulate(*params(0)) == first
+    assert simulator.calls == 1
+    cached.close()
+    # Kept in the file for the next runs
+    cache = SimulationCache(env, str(tmp_path / 'cache.sqlite'), memory_entries=0)
+    assert cache.get(cache.snap(params(0))) == first
+    cache.close()
+
+
+def test_eviction_keeps_the_recently_used(env, tmp_path, monkeypatch):
+    monkeypatch.setattr(simulation_cache, 'EVICTION_INTERVAL', 2)
+    path = str(tmp_path / 'cache.sqlite')
+    cache = SimulationCache(env, path, max_entries=4, memory_entries=100)
+    cached = CachedSimulator(NumpySimulator(env), cache)
+    cached.simulate(*params(0))
+    for i in range(1, 10):
+        cached.simulate(*params(i))
+        # Always answered from memory, its last access must still reach the file
+        cached.simulate(*params(0))
+    cache.close()
+    assert cache.evictions > 0
+
+    cache = SimulationCache(env, path, memory_entries=0)
+    assert cache.statistics()['entries'] == 4
+    assert cache.get(cache.snap(params(0))) is not None
+    assert cache.get(cache.snap(params(9))) is not None
+    assert cache.get(cache.snap(params(1))) is None
+    cache.close()
+
+
+def test_simulate_many_simulates_each_point_once(env, tmp_path):
+    simulator = CountingSimulator(env)
+    cached = CachedSimulator(simulator, SimulationCache(env, str(tmp_path / 'cache.sqlite')))
+    states = cached.simulate_many([params(0), params(1), params(0)])
+    assert states[0] == states[2]
+    assert simulator.calls == 2
+    cached.close()
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+import stub_simulator
+from octave_adapter import OctaveAdapter, STATE_KEYS
+from simulator_pool import SimulatorPool
+from stub_simulator import STUB_COMMAND
+
+PARAMS = [(20, 20.0, 30.0, 3.0), (80, 15.0, 16.0, 2.0), (148, 22.0, 45.0, 5.0), (60, 5.0, 25.0, 4.0)]
+
+
+@pytest.fixture
+def context(tmp_path):
+    # Simulator folder of the stub: only io/ is needed
+    os.makedirs(tmp_path / 'io')
+    return str(tmp_path)
+
+
+def assert_state(state, params):
+    expected = stub_simulator.simulate(*params)
+    assert set(state) == set(STATE_KEYS)
+    # Written with 4 decimals
+    for key in STATE_KEYS:
+        assert state[key] == pytest.approx(expected[key], abs=1e-4)
+
+
+@pytest.mark.parametrize('session', [True, False])
+def test_adapter_simulate(context, session):
+    adapter = OctaveAdapter(context, session=session, octave_exec=STUB_COMMAND)
+    try:
+        assert_state(adapter.simulate(*PARAMS[0]), PARAMS[0])
+        for state, params in zip(adapter.simulate_many(PARAMS), PARAMS):
+            assert_state(state, params)
+    finally:
+        adapter.close()
+
+
+@pytest.mark.parametrize('session', [True, False])
+def test_pool_keeps_the_order(context, session):
+    list_of_params = PARAMS * 3
+    with SimulatorPool(context, workers=3, session=session, octave_exec=STUB_COMMAND) as pool:
+        states = pool.simulate_many(list_of_params)
+        assert len(states) == len(list_of_params)
+        for state, params in zip(states, list_of_params):
+            assert_state(state, params)
+        assert_state(pool.simulate(*PARAMS[2]), PARAMS[2])
+        assert pool.simulate_many([]) == []
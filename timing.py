@@ -0,0 +1,131 @@
+import functools
+import json
+import os
+import threading
+import time
+from array import array
+
+import numpy as np
+
+#######################################
+# Timing of the phases of a step ######
+#######################################
+# TIMING=1 in the environment enables the spans. Disabled, the decorated functions are
+# left untouched and span() returns a shared object that does nothing.
+TIMING = os.environ.get('TIMING', '0') == '1'
+MAX_TRACE_EVENTS = 1000000  # events kept for the trace, the durations are all kept
+#######################################
+
+
+class Timer:
+    # Durations of every span, per name, and the first MAX_TRACE_EVENTS spans for a Chrome trace
+
+    def __init__(self, max_trace_events=MAX_TRACE_EVENTS):
+        self.lock = threading.Lock()
+        self.max_trace_events = max_trace_events
+        self.origin = time.perf_counter()
+        self.durations = {}
+        self.events = []
+
+    def record(self, name, start, end):
+        with self.lock:
+            durations = self.durations.get(name)
+            if durations is None:
+                durations = self.durations[name] = array('d')
+            durations.append(end - start)
+            if len(self.events) < self.max_trace_events:
+                self.events.append((name, start, end, threading.get_ident()))
+
+    def summary(self):
+        # name ==> count, total, mean, p50, p95, p99 (seconds)
+        with self.lock:
+            durations = {name: np.frombuffer(values, dtype=np.float64).copy() for name, values in self.durations.items()}
+        out = {}
+        for name, values in sorted(durations.items()):
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            out[name] = {
+                'count': len(values),
+                'total': float(values.sum()),
+                'mean': float(values.mean()),
+                'p50': float(p50),
+                'p95': float(p95),
+                'p99': float(p99)
+            }
+        return out
+
+    def print_summary(self):
+        print("<-- Timing (ms)")
+        print("      %-30s %7s %10s %10s %10s %10s %10s" % ('', 'count', 'total', 'mean', 'p50', 'p95', 'p99'))
+        for name, values in self.summary().items():
+            print("      %-30s %7d %10.1f %10.3f %10.3f %10.3f %10.3f" % (
+                name, values['count'], values['total'] * 1000, values['mean'] * 1000,
+                values['p50'] * 1000, values['p95'] * 1000, values['p99'] * 1000))
+
+    def dump_trace(self, path):
+        # Chrome trace event format (chrome://tracing, ui.perfetto.dev), complete events in microseconds
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        trace = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                  'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+                 for name, start, end, tid in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def clear(self):
+        with self.lock:
+            self.durations = {}
+            self.events = []
+
+
+TIMER = Timer()
+
+
+class Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        TIMER.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name):
+    # with span('phase'): ...
+    return Span(name) if TIMING else NO_SPAN
+
+
+def timed(name):
+    # Decorator, decided once when the function is defined
+    def decorator(function):
+        if not TIMING:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                TIMER.record(name, start, time.perf_counter())
+        return wrapper
+    return decorator
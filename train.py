@@ -1,180 +1,254 @@
-import math
+import logging
+import argparse
+import shutil
 from random import randint, uniform
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import cm
 import custom_env
 from dqn import DQN
 from octave_adapter import OctaveAdapter
+from numpy_simulator import NumpySimulator
+from lattice_table import LatticeTableSimulator
+from simulation_cache import SimulationCache, CachedSimulator
+from simulator_pool import SimulatorPool
+from async_training import train_async
+from run_recorder import RunRecorder
+from transition_dataset import TransitionDataset
+from plotting import Plotter
+from speculative_simulator import SpeculativeSimulator
+from surrogate import KNNSurrogate, SurrogateSimulator, DynaPlanner
+from timing import TIMING, TIMER, span
+from logs import setup_logging, log_step, log_episode
+from checkpoint import (Checkpointer, CHECKPOINT_EVERY, CHECKPOINT_PREFIX, STATE_FILE, latest_checkpoint,
+                        load_checkpoint, rng_state, run_folder, set_rng_state)
 from datetime import datetime
 import os
 
 FILES_CONTEXT = "D:/E/Master/Stage/customized code"
-FIGURE_COUNTER = 0
-RUNNING_TIME = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-TMP_FOLDER_NAME = "tmp_" + RUNNING_TIME
-tmp_folder_exists = os.path.exists(TMP_FOLDER_NAME)
-if not tmp_folder_exists:
-    os.makedirs(TMP_FOLDER_NAME)
-TMP_FOLDER = TMP_FOLDER_NAME + "/"
-print("All plots will be stored in folder", TMP_FOLDER_NAME)
-print("###########################################################################")
-
-def train():
-    print("--> Started training function")
+# "octave": main.m in FILES_CONTEXT, "numpy": built-in simulator (numpy_simulator.py), no Octave needed
+# "lattice": table precomputed by lattice_table.py in LATTICE_TABLE_FOLDER (interpolated, no simulation)
+SIMULATOR_BACKEND = "octave"
+LATTICE_TABLE_FOLDER = "lattice_table"
+# Results of the simulator already computed, kept between runs (one file per backend)
+SIMULATION_CACHE_FILE = "simulation_cache_" + SIMULATOR_BACKEND + ".sqlite"
+# > 0: asynchronous training (async_training.py), the actors simulate while the network trains
+ASYNC_ACTORS = 0
+# > 0: the parameters of the SPECULATIVE_K best actions are simulated while the agent decides and trains
+SPECULATIVE_K = 0
+# True: simulations are answered by a surrogate (surrogate.py) fitted on the real ones when it is
+# trusted, and imagined transitions train the DQN between the real steps (Dyna)
+SURROGATE = False
+# True: transitions replayed according to their TD error (PrioritizedReplayBuffer) instead of uniformly
+PRIORITIZED_REPLAY = False
+# Double DQN targets and n-step returns (DQN.replay), sample_efficiency.py compares them
+DOUBLE_DQN = True
+N_STEP = 1
+# Every simulated transition is appended to <run name>.bin in this folder (one file per run, a resumed
+# run continues its file), offline_train.py trains from them with other reward weights without simulating again
+TRANSITIONS_FOLDER = "transitions_" + SIMULATOR_BACKEND
+# Files of a run, in its folder tmp_<running time>
+RUN_RECORD_NAME = "run_record.bin"
+# Chrome / Perfetto trace of the run, written when timing.TIMING is enabled (TIMING=1)
+TRACE_NAME = "trace.json"
+# Log records also written in the run folder
+LOG_NAME = "train.log"
+logger = logging.getLogger('train')
+
+def create_tmp_folder():
+    # Not at import: the plotter process imports this module again with the spawn start method (Windows)
+    # Its name also names the run (checkpoints): runs started in the same second get a suffix
+    running_time = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    tmp_folder_name = "tmp_" + running_time
+    suffix = 1
+    while True:
+        try:
+            os.makedirs(tmp_folder_name)
+            break
+        except FileExistsError:
+            tmp_folder_name = "tmp_" + running_time + "_" + str(suffix)
+            suffix += 1
+    return tmp_folder_name + "/"
+
+def run_name(tmp_folder):
+    return os.path.basename(os.path.normpath(tmp_folder))
+
+def train(episodes=None, steps=None, resume=None, tmp_folder=None):
+    # resume: checkpoint folder, the training continues after the last episode it saved, and its next
+    # checkpoints are saved with the ones of the resumed run
+    # tmp_folder: run folder (create_tmp_folder), a new one if not given
+    tmp_folder = tmp_folder if tmp_folder is not None else create_tmp_folder()
+    run_record_file = tmp_folder + RUN_RECORD_NAME
+    logger.info("Started training, plots and records in folder %s", tmp_folder)
     env = custom_env.CustomEnv()
-    episodes = env.MAX_EPISODES
-    steps = env.MAX_STEPS
-    dqn_agent = DQN(env=env)
-
-    statistics_shape = (episodes, steps + 1)
-    statistics_nbr_trains = np.zeros(statistics_shape)
-    statistics_v_max = np.zeros(statistics_shape)
-    statistics_max_dwell = np.zeros(statistics_shape)
-    statistics_density_max_opt = np.zeros(statistics_shape)
-    statistics_h_out_mean = np.zeros(statistics_shape)
-    statistics_I_mean = np.zeros(statistics_shape)
-    statistics_A_mean = np.zeros(statistics_shape)
-    statistics_mu_mean = np.zeros(statistics_shape)
-    statistics_Q_mean = np.zeros(statistics_shape)
-    statistics_P_mean = np.zeros(statistics_shape)
-    statistics_dwell_mean = np.zeros(statistics_shape)
-
-    octave_adapter = OctaveAdapter(FILES_CONTEXT)
-    for episode in range(episodes):
+    checkpoint = None
+    if resume is not None:
+        checkpoint = load_checkpoint(resume)
+        episodes = checkpoint['episodes']
+        steps = checkpoint['steps']
+        # The steps recorded so far continue in this run folder
+        shutil.copyfile(os.path.join(resume, RUN_RECORD_NAME), run_record_file)
+        logger.info("Resuming %s at episode #%d", resume, checkpoint['episode'])
+    episodes = episodes if episodes is not None else env.MAX_EPISODES
+    steps = steps if steps is not None else env.MAX_STEPS
+    # Every step is appended to run_record_file, the plots are made from it
+    recorder = RunRecorder(run_record_file, append=checkpoint is not None)
+    plotter = Plotter(tmp_folder, run_record_file, episodes, steps)
+    dqn_agent = DQN(env=env, prioritized=PRIORITIZED_REPLAY, double=DOUBLE_DQN, n_step=N_STEP)
+    checkpoint_folder = os.path.dirname(os.path.normpath(resume)) if resume is not None else run_folder(run_name(tmp_folder))
+    checkpointer = Checkpointer(checkpoint_folder)
+    # On resume, the transitions written after the checkpoint are dropped (they are simulated again)
+    transitions_file = os.path.join(TRANSITIONS_FOLDER, run_name(checkpoint_folder) + ".bin")
+    transitions = TransitionDataset(transitions_file, size=checkpoint.get('transitions_size') if checkpoint else None)
+
+    if SPECULATIVE_K > 0:
+        simulator = create_simulator(env, workers=SPECULATIVE_K + 1)
+        speculative_simulator = octave_adapter = SpeculativeSimulator(simulator, env, SPECULATIVE_K)
+    else:
+        simulator = create_simulator(env)
+        octave_adapter = simulator
+    if SURROGATE:
+        octave_adapter = SurrogateSimulator(octave_adapter, KNNSurrogate(env))
+        planner = DynaPlanner(octave_adapter, custom_env.VectorCustomEnv(0))
+
+    if checkpoint is None:
+        # Random starting state for the beginning each episode
+        # They do not depend on the training, so all of them are simulated in one batch
+        starting_params = []
+        for episode in range(episodes):
+            nbr_trains = randint(env.MIN_NBR_TRAINS, env.MAX_NBR_TRAINS)
+            v_max = round(uniform(env.MIN_V_MAX, env.MAX_V_MAX), 2)
+            max_dwell = round(uniform(env.MIN_MAX_DWELL, env.MAX_MAX_DWELL), 2)
+            density_max_opt = round(uniform(env.MIN_DENSITY_MAX_OPT, env.MAX_DENSITY_MAX_OPT), 2)
+            starting_params.append((nbr_trains, v_max, max_dwell, density_max_opt))
+        starting_states = octave_adapter.simulate_many(starting_params)
+        first_episode = 0
+    else:
+        starting_params = checkpoint['starting_params']
+        starting_states = checkpoint['starting_states']
+        dqn_agent.set_state(checkpoint['dqn'])
+        set_rng_state(checkpoint['rng'])
+        first_episode = checkpoint['episode']
+
+    for episode in range(first_episode, episodes):
     #for episode in range(1):
-        print("----> Starting episode #", episode, "################################################")
+        logger.debug("Starting episode #%d", episode)
 
-        # Random starting state for the beginning each episode
-        nbr_trains = randint(env.MIN_NBR_TRAINS, env.MAX_NBR_TRAINS)
-        v_max = round(uniform(env.MIN_V_MAX, env.MAX_V_MAX), 2)
-        max_dwell = round(uniform(env.MIN_MAX_DWELL, env.MAX_MAX_DWELL), 2)
-        density_max_opt = round(uniform(env.MIN_DENSITY_MAX_OPT, env.MAX_DENSITY_MAX_OPT), 2)
-        octave_adapter.write_to_octave(nbr_trains, v_max, max_dwell, density_max_opt)
-        octave_adapter.run_octave()
-        current_state = octave_adapter.read_from_octave()
-
-        # Statistics arrays
-        update_statistics(episode, 0, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                          statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                          statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                          statistics_dwell_mean, nbr_trains, v_max, max_dwell, density_max_opt, current_state)
+        nbr_trains, v_max, max_dwell, density_max_opt = starting_params[episode]
+        current_state = starting_states[episode]
+        if SPECULATIVE_K > 0:
+            speculate(env, dqn_agent, speculative_simulator, current_state, starting_params[episode])
+
+        recorder.record(episode, 0, nbr_trains, v_max, max_dwell, density_max_opt, current_state,
+                        epsilon=dqn_agent.epsilon)
+        total_reward = 0.0
 
         for step in range(steps):
-            print("----> Starting step #", step, "################################################")
-            action = dqn_agent.action(env.convert_to_dqn_array(current_state))
-
-            new_state, new_params, reward, done, done_reason = env.step(octave_adapter, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action)
-            dqn_agent.remember(env.convert_to_dqn_array(current_state), action,
-                               reward, env.convert_to_dqn_array(new_state), done)
-            if dqn_agent.replay():  # internally iterates default (prediction) model
-                dqn_agent.target_train()  # iterates target model
-
-            current_state = new_state
-            nbr_trains = new_params['nbr_trains']
-            v_max = new_params['v_max']
-            max_dwell = new_params['max_dwell']
-            density_max_opt = new_params['density_max_opt']
-
-            update_statistics(episode, step + 1, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                          statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                          statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                          statistics_dwell_mean, nbr_trains, v_max, max_dwell, density_max_opt, current_state)
-            print("<---- Ending step #", step)
-
-        print("<---- Ending episode #", episode)
-        
-        plot_episode_statistics(episode, steps, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                                statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                                statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                                statistics_dwell_mean)
+            with span('train.step'):
+                action = dqn_agent.action(env.convert_to_dqn_array(current_state))
+
+                new_state, new_params, reward, done, done_reason = env.step(octave_adapter, current_state, nbr_trains, v_max, max_dwell, density_max_opt, action)
+                if SPECULATIVE_K > 0:
+                    # Next simulations run during the training below
+                    speculate(env, dqn_agent, speculative_simulator, new_state,
+                              (new_params['nbr_trains'], new_params['v_max'], new_params['max_dwell'], new_params['density_max_opt']))
+                if not SURROGATE or octave_adapter.last_real:
+                    transitions.add((nbr_trains, v_max, max_dwell, density_max_opt), current_state, action,
+                                    (new_params['nbr_trains'], new_params['v_max'], new_params['max_dwell'],
+                                     new_params['density_max_opt']), new_state, done)
+                dqn_agent.remember(env.convert_to_dqn_array(current_state), action,
+                                   reward, env.convert_to_dqn_array(new_state), done)
+                if dqn_agent.replay():  # internally iterates default (prediction) model
+                    dqn_agent.target_train()  # iterates target model
+                if SURROGATE:
+                    with span('train.planning'):
+                        planner.plan(dqn_agent)
+
+                current_state = new_state
+                nbr_trains = new_params['nbr_trains']
+                v_max = new_params['v_max']
+                max_dwell = new_params['max_dwell']
+                density_max_opt = new_params['density_max_opt']
+
+                recorder.record(episode, step + 1, nbr_trains, v_max, max_dwell, density_max_opt, current_state,
+                                action, reward, dqn_agent.epsilon)
+                log_step(logger, episode, step + 1, action, reward, dqn_agent.epsilon, new_params, current_state)
+                total_reward += reward
+
+        logger.info("Ended episode #%d", episode)
+        log_episode(logger, episode, steps, total_reward, dqn_agent.epsilon,
+                    {'nbr_trains': nbr_trains, 'v_max': v_max, 'max_dwell': max_dwell, 'density_max_opt': density_max_opt},
+                    current_state)
+        with span('train.plot'):
+            recorder.flush()
+            transitions.flush()
+            plotter.plot_episode(episode)
+
+        if (episode + 1) % CHECKPOINT_EVERY == 0 or episode + 1 == episodes:
+            with span('train.checkpoint'):
+                checkpointer.save(CHECKPOINT_PREFIX + "%06d" % (episode + 1), {
+                    'episode': episode + 1,  # next episode to run
+                    'episodes': episodes,
+                    'steps': steps,
+                    'starting_params': starting_params,
+                    'starting_states': starting_states,
+                    'dqn': dqn_agent.get_state(),
+                    'rng': rng_state(),
+                    'transitions_size': os.path.getsize(transitions_file)
+                }, {RUN_RECORD_NAME: (run_record_file, os.path.getsize(run_record_file))})
 
     dqn_agent.save_model('model')
-    print("<-- Ended training function")
-    plot_full_statistics(episodes, steps, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                         statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                         statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                         statistics_dwell_mean)
-
-def update_statistics(episode, column, statistics_nbr_trains, statistics_v_max, statistics_max_dwell, statistics_density_max_opt,
-                      statistics_h_out_mean, statistics_I_mean, statistics_A_mean, statistics_mu_mean, statistics_Q_mean,
-                      statistics_P_mean, statistics_dwell_mean,
-                      nbr_trains, v_max, max_dwell, density_max_opt, current_state):
-    statistics_nbr_trains[episode, column] = nbr_trains
-    statistics_v_max[episode, column] = v_max
-    statistics_max_dwell[episode, column] = max_dwell
-    statistics_density_max_opt[episode, column] = density_max_opt
-    statistics_h_out_mean[episode, column] = current_state['h_out_mean']
-    statistics_I_mean[episode, column] = current_state['I_mean']
-    statistics_A_mean[episode, column] = current_state['A_mean']
-    statistics_mu_mean[episode, column] = current_state['mu_mean']
-    statistics_Q_mean[episode, column] = current_state['Q_mean']
-    statistics_P_mean[episode, column] = current_state['P_mean']
-    statistics_dwell_mean[episode, column] = current_state['dwell_mean']
-
-def plot_episode_statistics(episode, steps, statistics_nbr_trains, statistics_v_max,
-                            statistics_max_dwell, statistics_density_max_opt, statistics_h_out_mean,
-                            statistics_I_mean, statistics_A_mean, statistics_mu_mean, statistics_Q_mean,
-                            statistics_P_mean, statistics_dwell_mean):
-    single_plot_2D(episode, steps, get_figure_id(), statistics_nbr_trains, "NBR trains", 'NBR trains Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_v_max, "V Max", 'V Max Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_max_dwell, "Max dwell", 'Max dwell Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_density_max_opt, "Density max Opt", 'Density max Opt Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_h_out_mean, "H_out mean", 'Headway mean Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_I_mean, "I_mean", 'Nbr of pass. in st. Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_A_mean, "A_mean", 'Flow of pass. willing to enter Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_mu_mean, "mu_mean", 'Flow of pass. bearding on Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_Q_mean, "Q_mean", 'Nbr of pass. waiting Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_P_mean, "P_mean", 'Nbr of pass. on the train Statistics')
-    single_plot_2D(episode, steps, get_figure_id(), statistics_dwell_mean, "dwell_mean", 'Dwell time (s) Statistics')
-
-def single_plot_2D(episode, steps, figure, statistics_array, label, title):
-    x_axis = list(range(steps + 1))
-    fig = plt.figure(figure)
-    plt.plot(x_axis, statistics_array[episode, :].T, label=label)
-    plt.xlabel('Steps')
-    plt.ylabel(label)
-    plt.title(str(episode) + ': ' + title)
-    plt.legend()
-    fig.savefig(TMP_FOLDER + str(figure) + "_" + label + ".png")
-    plt.show()
-
-def plot_full_statistics(episodes, steps, statistics_nbr_trains, statistics_v_max, statistics_max_dwell,
-                         statistics_density_max_opt, statistics_h_out_mean, statistics_I_mean,
-                         statistics_A_mean, statistics_mu_mean, statistics_Q_mean, statistics_P_mean,
-                         statistics_dwell_mean):
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_nbr_trains, "NBR trains", 'NBR trains Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_v_max, "V Max", 'V Max Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_max_dwell, "Max dwell", 'Max dwell Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_density_max_opt, "Density max Opt", 'Density max Opt Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_h_out_mean, "H_out mean", 'Headway mean Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_I_mean, "I_mean", 'Nbr of pass. in st. Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_A_mean, "A_mean", 'Flow of pass. willing to enter Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_mu_mean, "mu_mean", 'Flow of pass. bearding on Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_Q_mean, "Q_mean", 'Nbr of pass. waiting Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_P_mean, "P_mean", 'Nbr of pass. on the train Statistics')
-    single_plot_3D(episodes, steps, get_figure_id(), statistics_dwell_mean, "dwell_mean", 'Dwell time (s) Statistics')
-
-def single_plot_3D(episodes, steps, figure, statistics_array, label, title):
-    x_axis = range(episodes)
-    y_axis = range(steps + 1)
-    X, Y = np.meshgrid(x_axis, y_axis)
-    fig = plt.figure(figure)
-    ax = plt.axes(projection='3d')
-    surf = ax.plot_surface(X.T, Y.T, statistics_array, rstride=1, cstride=1,
-                cmap=cm.coolwarm, edgecolor='none')
-    plt.xlabel('Episodes')
-    plt.ylabel('Steps')
-    plt.title(title)
-    fig.colorbar(surf, shrink=0.5, aspect=5)
-    fig.savefig(TMP_FOLDER + str(figure) + "_" + label + ".png")
-    plt.show()
-
-def get_figure_id():
-    global FIGURE_COUNTER
-    figure_id = FIGURE_COUNTER
-    FIGURE_COUNTER = FIGURE_COUNTER + 1
-    return figure_id
+    if hasattr(simulator, 'cache'):
+        logger.info("Simulation cache: %s", simulator.cache.statistics())
+    if SPECULATIVE_K > 0:
+        logger.info("Speculative simulations: %s", speculative_simulator.statistics())
+    if SURROGATE:
+        logger.info("Surrogate: %s", octave_adapter.statistics())
+    octave_adapter.close()
+    recorder.close()
+    transitions.close()
+    checkpointer.close()
+    if TIMING:
+        TIMER.print_summary()
+        TIMER.dump_trace(tmp_folder + TRACE_NAME)
+    logger.info("Ended training")
+    plotter.plot_full()
+    plotter.close()
+
+def speculate(env, dqn_agent, speculative_simulator, state, params):
+    q_values = dqn_agent.policy.q_values(env.convert_to_dqn_array(state)[None])[0]
+    speculative_simulator.speculate(params, q_values)
+
+def create_simulator(env, workers=1):
+    if SIMULATOR_BACKEND == "lattice":
+        # Nothing to cache, a lookup is cheaper than the cache
+        return LatticeTableSimulator(env, LATTICE_TABLE_FOLDER)
+    if SIMULATOR_BACKEND == "numpy":
+        simulator = NumpySimulator(env)
+    elif workers > 1:
+        # One isolated Octave worker per concurrent simulation
+        simulator = SimulatorPool(FILES_CONTEXT, workers=workers)
+    else:
+        simulator = OctaveAdapter(FILES_CONTEXT)
+    return CachedSimulator(simulator, SimulationCache(env, SIMULATION_CACHE_FILE))
 
 if __name__ == "__main__":
-    train()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', nargs='?', const='latest', default=None,
+                        help="checkpoint folder to continue from, or run folder of checkpoints (its latest one), "
+                             "the latest one of the most recent run if not given")
+    args = parser.parse_args()
+    if ASYNC_ACTORS > 0 and args.resume is not None:
+        raise ValueError("--resume is not supported by the asynchronous training (ASYNC_ACTORS > 0)")
+    tmp_folder = create_tmp_folder()
+    setup_logging(tmp_folder + LOG_NAME)
+    if ASYNC_ACTORS > 0:
+        dqn_agent = train_async(ASYNC_ACTORS, create_simulator,
+                                transitions_fn=os.path.join(TRANSITIONS_FOLDER, run_name(tmp_folder) + ".bin"))
+        dqn_agent.save_model('model')
+    else:
+        resume = args.resume
+        if resume == 'latest':
+            resume = latest_checkpoint()
+        elif resume is not None and not os.path.exists(os.path.join(resume, STATE_FILE)):
+            resume = latest_checkpoint(resume)
+        if args.resume is not None and resume is None:
+            raise ValueError("No checkpoint to resume from")
+        train(resume=resume, tmp_folder=tmp_folder)
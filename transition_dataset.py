@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+
+from octave_adapter import PARAMETER_KEYS, STATE_KEYS
+from run_recorder import RecordFile, FLUSH_EVERY, read_header, read_records
+
+# Raw simulator transitions, without reward: the reward is recomputed when training from them
+# (offline_train.py), so that the reward weights can change without simulating again
+TRANSITION_DTYPE = np.dtype([(key, np.float64) for key in PARAMETER_KEYS]
+                            + [(key, np.float64) for key in STATE_KEYS]
+                            + [('action', np.int32)]
+                            + [('next_' + key, np.float64) for key in PARAMETER_KEYS]
+                            + [('next_' + key, np.float64) for key in STATE_KEYS]
+                            + [('done', np.uint8)])
+
+
+class TransitionDataset(RecordFile):
+    # Append-only, one file per run (read_transitions reads a folder of them)
+    # size: bytes of the existing file to keep (saved with a checkpoint, the transitions written after it
+    # are simulated again when resuming)
+
+    def __init__(self, path, flush_every=FLUSH_EVERY, size=None):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        append = os.path.exists(path) and os.path.getsize(path) > 0
+        if append and read_header(path)[0] != TRANSITION_DTYPE:
+            raise ValueError(path + " holds records of another format")
+        super().__init__(path, TRANSITION_DTYPE, flush_every, append, size)
+
+    def add(self, params, state, action, next_params, next_state, done):
+        # params, next_params: (nbr_trains, v_max, max_dwell, density_max_opt), states: simulator dicts
+        self.append(tuple(params) + tuple(state[key] for key in STATE_KEYS) + (action,)
+                    + tuple(next_params) + tuple(next_state[key] for key in STATE_KEYS) + (done,))
+
+
+    def add_batch(self, params, states, actions, next_params, next_states, dones):
+        # params, next_params: (n, 4) simulator order, states, next_states: (n, 7, 2) DQN arrays (STATE_KEYS order)
+        self.flush()
+        records = np.zeros(len(actions), dtype=self.dtype)
+        params, next_params = np.asarray(params).reshape(-1, 4), np.asarray(next_params).reshape(-1, 4)
+        states = np.asarray(states).reshape(len(records), -1)
+        next_states = np.asarray(next_states).reshape(len(records), -1)
+        for i, key in enumerate(PARAMETER_KEYS):
+            records[key] = params[:, i]
+            records['next_' + key] = next_params[:, i]
+        for i, key in enumerate(STATE_KEYS):
+            records[key] = states[:, i]
+            records['next_' + key] = next_states[:, i]
+        records['action'] = actions
+        records['done'] = dones
+        self.file.write(records.tobytes())
+
+
+def read_transitions(path):
+    # One dataset file, or a folder of them ==> all their records
+    if not os.path.isdir(path):
+        return read_records(path)
+    records = [read_records(os.path.join(path, name)) for name in sorted(os.listdir(path)) if name.endswith('.bin')]
+    return np.concatenate(records) if len(records) > 0 else np.zeros(0, dtype=TRANSITION_DTYPE)
+
+
+def transition_arrays(records, state_shape):
+    # ==> states, actions, next_states, dones as for DQN.remember (states: (n, 7, 2) DQN arrays,
+    # STATE_KEYS is the order of convert_to_dqn_array)
+    states = np.stack([records[key] for key in STATE_KEYS], axis=1).reshape((-1,) + tuple(state_shape))
+    next_states = np.stack([records['next_' + key] for key in STATE_KEYS], axis=1).reshape((-1,) + tuple(state_shape))
+    return states, np.asarray(records['action']), next_states, np.asarray(records['done'], dtype=np.float32)